@@ -1,20 +1,56 @@
-from fastapi import Header, Request, HTTPException
+from typing import AsyncIterator
+
+from fastapi import Depends, Header, Request, HTTPException
 from redis.asyncio.client import Redis
 
 from app.auth import validate_rfzo
 from app.config import settings
-from app.db.keys import intern_session_key, intern_key
+from app.db.keys import intern_session_key, intern_key, intern_wrote_key
+from app.db.redis import ReadReplicas
+from app.services.admission import AdmissionRejectedError, InferenceGate, InternBusyError, admit
+from app.services.ml.registry import ModelLease, ModelRegistry
+from app.services.ml.similarity import SimilarityIndex
+from app.services.stages import ClientDisconnectedError, StageMetrics
+from app.services.storage.record_cache import RecordCache
+
+async def get_model(request: Request) -> AsyncIterator[ModelLease]:
+    # Leases the active version for the whole request, so a hot-swap never
+    # unloads a model that is still predicting.
+    registry: ModelRegistry = request.app.state.models
+    if registry.active_version is None:
+        raise HTTPException(status_code=503, detail="No model version is active")
+    async with registry.acquire() as lease:
+        yield lease
+
+def get_model_registry(request: Request) -> ModelRegistry:
+    return request.app.state.models
+
+def get_inference_gate(request: Request) -> InferenceGate:
+    return request.app.state.inference_gate
+
+def get_stage_metrics(request: Request) -> StageMetrics:
+    return request.app.state.stage_metrics
+
+def get_record_cache(request: Request) -> RecordCache:
+    return request.app.state.record_cache
 
-import tensorflow as tf
+def get_similarity_index(request: Request) -> SimilarityIndex:
+    return request.app.state.similarity_index
 
-def get_model(request: Request) -> tf.keras.Model: #type:ignore
-    return request.app.state.model
 
 def get_redis(request: Request) -> Redis:
-    return request.app.state.redis  # decode_responses=True
+    return request.app.state.redis  # decode_responses=True; blobs via app.db.redis.get_bytes
 
-def get_redis_bin(request: Request) -> Redis:
-    return request.app.state.redis_bin  # decode_responses=False
+def get_read_replicas(request: Request) -> ReadReplicas:
+    return request.app.state.replicas
+
+def get_read_redis(request: Request) -> Redis:
+    # a healthy read replica, or the primary (none healthy, or the request
+    # must see its own writes: see require_intern). Pair with get_redis as
+    # the `primary` fallback of the storage read functions.
+    if getattr(request.state, "read_primary", False):
+        return request.app.state.redis
+    return request.app.state.replicas.reader()
 
 def require_admin(x_rfzo: str | None = Header(default=None, alias="X-RFZO")) -> None:
     validate_rfzo(provided=x_rfzo, expected=settings.ADMIN_RFZO)
@@ -32,8 +68,45 @@ async def require_intern(
     if not student_id:
         raise HTTPException(status_code=401, detail="Invalid or expired session")
 
-    # extra safety: intern still exists
-    if not await redis.exists(intern_key(student_id)):
+    # extra safety: intern still exists; and whether they saved something
+    # moments ago, in which case their reads skip the replicas
+    pipe = redis.pipeline(transaction=False)
+    pipe.exists(intern_key(student_id))
+    pipe.exists(intern_wrote_key(student_id))
+    exists, wrote = await pipe.execute()
+    if not exists:
         raise HTTPException(status_code=401, detail="Intern no longer exists")
+    request.state.read_primary = bool(wrote)
+
+    return student_id
+
 
-    return student_id
\ No newline at end of file
+def get_intern_read_redis(request: Request, student_id: str = Depends(require_intern)) -> Redis:
+    """get_read_redis for intern routes, once require_intern has checked for recent saves."""
+    return get_read_redis(request)
+
+
+async def admit_inference(
+    request: Request,
+    student_id: str = Depends(require_intern),
+) -> AsyncIterator[None]:
+    # 429 if this intern already has a request running (any worker),
+    # 503 if this worker's inference queue is saturated,
+    # 499 if the client went away while the request was still queued
+    try:
+        async with admit(
+            request.app.state.redis,
+            request.app.state.inference_gate,
+            student_id=student_id,
+            per_intern_limit=settings.PROCESS_MAX_INFLIGHT_PER_INTERN,
+            ttl_seconds=settings.PROCESS_INFLIGHT_TTL_SECONDS,
+            is_disconnected=request.is_disconnected,
+        ):
+            yield
+    except AdmissionRejectedError as e:
+        status = 429 if isinstance(e, InternBusyError) else 503
+        raise HTTPException(status_code=status, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except ClientDisconnectedError as e:
+        if e.stage == "queue":
+            request.app.state.stage_metrics.record_cancel("queue")
+        raise HTTPException(status_code=499, detail=str(e))
@@ -0,0 +1,32 @@
+from fastapi import Request, Response
+from redis.asyncio.client import Redis
+
+from app.services.storage.versions import collection_etag
+
+# Conditional GETs for the polled list endpoints. The ETag comes from the
+# collection's version counter (see storage/versions.py), so an unchanged
+# poll costs one GET and a 304 instead of a rebuilt listing.
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    # weak comparison, as RFC 9110 asks for If-None-Match
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+async def check_etag(request: Request, response: Response, redis: Redis, version_key: str) -> Response | None:
+    """
+    Returns a 304 to send as-is when the client's copy is current;
+    otherwise sets ETag on `response` and returns None.
+    """
+    etag = await collection_etag(redis, version_key)
+    # no-cache: browsers may keep the listing but must revalidate every poll
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -0,0 +1,58 @@
+from collections.abc import AsyncIterator, Callable, Iterable, Mapping
+
+from fastapi import Response
+from fastapi.responses import StreamingResponse
+from pydantic_core import to_json
+
+# Fast path for large list responses. Building a Pydantic model per item and
+# letting FastAPI validate and dump the whole list through response_model
+# costs more CPU than reading the records, and holds every item (twice)
+# until the last one is serialized. Here each item is a plain dict with the
+# response model's fields, encoded by pydantic-core's JSON serializer (the
+# one FastAPI itself uses, so the bytes are the same), and the array is sent
+# page by page as the pipelined reads come back. Endpoints keep their
+# response_model, so OpenAPI is unchanged.
+
+JSON = "application/json"
+
+
+def json_response(items: Iterable, *, convert: Callable[[dict], dict], headers: Mapping[str, str] | None = None) -> Response:
+    """A JSON array of convert(item), without response_model validation."""
+    return Response(to_json([convert(x) for x in items]), media_type=JSON, headers=headers)
+
+
+async def stream_json_array(
+    pages: AsyncIterator[list],
+    *,
+    convert: Callable[[dict], dict],
+    headers: Mapping[str, str] | None = None,
+) -> Response:
+    """
+    A JSON array of convert(item) for every item of every page, sent as each
+    page arrives. The first page is read before the response starts, so the
+    errors a listing raises up front (unknown intern, ...) still reach the
+    endpoint's except clauses and become proper error responses.
+    """
+    try:
+        first = await anext(pages)
+    except StopAsyncIteration:
+        return Response(b"[]", media_type=JSON, headers=headers)
+
+    async def body() -> AsyncIterator[bytes]:
+        sep = b"["
+        try:
+            page = first
+            while True:
+                if page:
+                    # to_json(list) is "[a,b]"; strip the brackets to splice pages
+                    yield sep + to_json([convert(x) for x in page])[1:-1]
+                    sep = b","
+                try:
+                    page = await anext(pages)
+                except StopAsyncIteration:
+                    break
+        finally:
+            await pages.aclose()  # type:ignore
+        yield b"]" if sep == b"," else b"[]"
+
+    return StreamingResponse(body(), media_type=JSON, headers=headers)
@@ -1,9 +1,295 @@
-from fastapi import APIRouter, Depends
+import logging
 
-from app.api.dependencies import require_admin
+from fastapi import APIRouter, Depends, HTTPException, Query
+from redis.asyncio.client import Redis
+
+from app.api.dependencies import get_inference_gate, get_model_registry, get_read_replicas, get_record_cache, get_similarity_index, get_stage_metrics, get_redis, require_admin
+from app.config import settings
+from app.db.keys import lock_key
+from app.db.redis import ReadReplicas
+from app.schemas.admin import ModelDeployRequest, PurgeRequest
+from app.services import jobs
+from app.services import reinference
+from app.services.admission import InferenceGate
+from app.services.ml import registry as model_registry
+from app.services.ml.registry import ModelRegistry
+from app.services.ml.similarity import SimilarityIndex
+from app.services.stages import StageMetrics
+from app.services.storage import purge as purge_store
+from app.services.storage import sweeper
+from app.services.storage import usage as usage_store
+from app.services.storage.record_cache import RecordCache
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(dependencies=[Depends(require_admin)])
 
 @router.get("/ping")
 async def admin_ping():
-    return {"status": "ok", "role": "admin"}
\ No newline at end of file
+    return {"status": "ok", "role": "admin"}
+
+
+@router.get("/jobs/{job_id}", response_model=dict)
+async def get_job(job_id: str, redis: Redis = Depends(get_redis)):
+    try:
+        return await jobs.get_job(redis, job_id)
+    except jobs.JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+async def _sweep_job(redis: Redis, job_id: str) -> None:
+    await jobs.update_job(redis, job_id, status="running")
+    try:
+        await sweeper.sweep(redis, job_id=job_id)
+        await jobs.update_job(redis, job_id, status="completed")
+    except sweeper.SweepInProgressError as e:
+        await jobs.update_job(redis, job_id, status="skipped", error=str(e))
+    except Exception as e:
+        await jobs.update_job(redis, job_id, status="failed", error=str(e))
+        raise
+
+
+@router.post("/sweep", response_model=dict, status_code=202)
+async def trigger_sweep(redis: Redis = Depends(get_redis)):
+    """
+    Starts an index consistency sweep in the background; poll /admin/jobs/{job_id}.
+    """
+    job_id = await jobs.create_job(redis, kind="index_sweep")
+    jobs.run_in_background(_sweep_job(redis, job_id))
+    return {"status": "accepted", "job_id": job_id}
+
+
+async def _purge_job(redis: Redis, job_id: str, payload: PurgeRequest) -> None:
+    await jobs.update_job(redis, job_id, status="running")
+    try:
+        await purge_store.purge(
+            redis,
+            student_ids=payload.student_ids,
+            student_id_prefix=payload.student_id_prefix,
+            created_from=payload.created_from.timestamp() if payload.created_from else None,
+            created_to=payload.created_to.timestamp() if payload.created_to else None,
+            job_id=job_id,
+        )
+        await jobs.update_job(redis, job_id, status="completed")
+    except purge_store.NothingToPurgeError as e:
+        await jobs.update_job(redis, job_id, status="skipped", error=str(e))
+    except Exception as e:
+        await jobs.update_job(redis, job_id, status="failed", error=str(e))
+        raise
+
+
+@router.post("/purge", response_model=dict, status_code=202)
+async def trigger_purge(
+    payload: PurgeRequest,
+    redis: Redis = Depends(get_redis),
+):
+    """
+    Cascade purge of interns (by id or cohort prefix) and their records, or of
+    records in a created_at range. Runs in the background; poll /admin/jobs/{job_id}.
+    """
+    if not payload.student_ids and not payload.student_id_prefix \
+            and payload.created_from is None and payload.created_to is None:
+        raise HTTPException(status_code=422, detail="Select interns or a date range to purge")
+
+    job_id = await jobs.create_job(redis, kind="purge", params=payload.model_dump(mode="json"))
+    jobs.run_in_background(_purge_job(redis, job_id, payload))
+    return {"status": "accepted", "job_id": job_id}
+
+
+@router.get("/models", response_model=dict)
+async def list_models(
+    models: ModelRegistry = Depends(get_model_registry),
+    redis: Redis = Depends(get_redis),
+):
+    """
+    Versions loaded in this worker, plus the version all workers are converging on.
+    """
+    return {**models.describe(), "desired": await model_registry.get_desired_model(redis)}
+
+
+async def _deploy_job(redis: Redis, models: ModelRegistry, job_id: str, payload: ModelDeployRequest) -> None:
+    await jobs.update_job(redis, job_id, status="running")
+    try:
+        await models.load(payload.version, payload.path, **model_registry.load_options())
+        if payload.activate:
+            previous = models.activate(payload.version)
+            await model_registry.set_desired_model(redis, version=payload.version, path=payload.path)
+            await jobs.update_job(redis, job_id, status="completed", previous_version=previous or "")
+        else:
+            await jobs.update_job(redis, job_id, status="completed")
+    except Exception as e:
+        await jobs.update_job(redis, job_id, status="failed", error=str(e))
+        raise
+
+
+@router.post("/models", response_model=dict, status_code=202)
+async def deploy_model(
+    payload: ModelDeployRequest,
+    models: ModelRegistry = Depends(get_model_registry),
+    redis: Redis = Depends(get_redis),
+):
+    """
+    Loads and warms a model version in the background while the current one keeps
+    serving, then (optionally) switches traffic to it; the old version is unloaded
+    once its in-flight requests finish. Other workers follow within
+    MODEL_SYNC_INTERVAL_SECONDS. Poll /admin/jobs/{job_id}.
+    """
+    known = models.status(payload.version)
+    if known is not None and known[0] in ("loading", "ready"):
+        raise HTTPException(status_code=409, detail=f"Model version {payload.version} is already {known[0]}")
+
+    job_id = await jobs.create_job(redis, kind="model_deploy", params=payload.model_dump(mode="json"))
+    jobs.run_in_background(_deploy_job(redis, models, job_id, payload))
+    return {"status": "accepted", "job_id": job_id}
+
+
+async def _reinference_job(
+    redis: Redis,
+    models: ModelRegistry,
+    gate: InferenceGate,
+    job_id: str,
+    batch_size: int | None,
+    *,
+    resumed: bool,
+) -> None:
+    # run_reinference marks the job running once it holds the lock
+    try:
+        summary = await reinference.run_reinference(redis, models, job_id=job_id, gate=gate, batch_size=batch_size)
+        await jobs.update_job(
+            redis, job_id,
+            status="completed",
+            model_versions=",".join(summary["model_versions"]),
+            records_per_second=str(summary["records_per_second"]),
+            elapsed_seconds=str(summary["elapsed_seconds"]),
+        )
+    except reinference.ReinferenceInProgressError as e:
+        if resumed:
+            # another run got the lock after the endpoint checked; that run may
+            # be this very job, so its hash is left alone
+            logger.warning("Re-inference job %s not resumed: %s", job_id, e)
+        else:
+            await jobs.update_job(redis, job_id, status="skipped", error=str(e))
+    except Exception as e:
+        await jobs.update_job(redis, job_id, status="failed", error=str(e))
+        raise
+
+
+@router.post("/models/reinfer", response_model=dict, status_code=202)
+async def trigger_reinference(
+    batch_size: int | None = Query(None, ge=1, le=256),
+    resume: str | None = Query(None, description="Job id of an interrupted run to continue (keeps its counters)."),
+    models: ModelRegistry = Depends(get_model_registry),
+    gate: InferenceGate = Depends(get_inference_gate),
+    redis: Redis = Depends(get_redis),
+):
+    """
+    Re-runs every stored record that isn't on the active model version yet
+    (prediction, Grad-CAM, thumbnails, embedding), keeping the previous
+    prediction in prev_* fields. Yields to live /process traffic on this
+    worker. Poll /admin/jobs/{job_id} for progress and throughput.
+    """
+    if models.active_version is None:
+        raise HTTPException(status_code=503, detail="No model version is active")
+
+    if resume is not None:
+        try:
+            job = await jobs.get_job(redis, resume)
+        except jobs.JobNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        if job["kind"] != "reinference":
+            raise HTTPException(status_code=409, detail=f"Job {resume} is not a re-inference job")
+        if await redis.exists(lock_key("reinference")):
+            # still running (here or after a restart of another worker): resuming
+            # would only report a skip onto the live run's job hash
+            raise HTTPException(status_code=409, detail="A re-inference job is already running")
+        job_id = resume
+    else:
+        job_id = await jobs.create_job(redis, kind="reinference", params={"batch_size": batch_size})
+
+    jobs.run_in_background(_reinference_job(redis, models, gate, job_id, batch_size, resumed=resume is not None))
+    return {"status": "accepted", "job_id": job_id, "model_version": models.active_version}
+
+
+@router.post("/models/{version}/activate", response_model=dict)
+async def activate_model(
+    version: str,
+    models: ModelRegistry = Depends(get_model_registry),
+    redis: Redis = Depends(get_redis),
+):
+    """
+    Switches traffic to an already loaded version (e.g. one deployed with activate=false).
+    """
+    try:
+        previous = models.activate(version)
+    except model_registry.ModelNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except model_registry.ModelNotReadyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    known = models.status(version)
+    await model_registry.set_desired_model(redis, version=version, path=known[1] if known else "")
+    return {"status": "activated", "version": version, "previous_version": previous}
+
+
+@router.delete("/models/{version}", response_model=dict)
+async def unload_model(version: str, models: ModelRegistry = Depends(get_model_registry)):
+    try:
+        models.unload(version)
+    except model_registry.ModelNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except (model_registry.ModelInUseError, model_registry.ModelNotReadyError) as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "unloading", "version": version}
+
+
+@router.get("/inference", response_model=dict)
+async def inference_load(
+    gate: InferenceGate = Depends(get_inference_gate),
+    metrics: StageMetrics = Depends(get_stage_metrics),
+):
+    """
+    This worker's admission queue (running/waiting requests, rejections) and
+    /process stage timings, including compute saved by dropping requests
+    whose client disconnected.
+    """
+    return {**gate.snapshot(), "pipeline": metrics.snapshot()}
+
+
+@router.get("/storage", response_model=dict)
+async def storage_report(
+    sample: int = Query(20, ge=0, le=500, description="Random records to check with MEMORY USAGE."),
+    top: int = Query(20, ge=1, le=500),
+    redis: Redis = Depends(get_redis),
+):
+    """
+    Image bytes tracked per intern and globally, quota usage, and a MEMORY USAGE
+    sample comparing tracked sizes with what Redis actually allocates.
+    """
+    return await usage_store.storage_report(
+        redis,
+        sample=sample,
+        top=top,
+        per_intern_quota=settings.STORAGE_QUOTA_PER_INTERN_BYTES,
+        total_quota=settings.STORAGE_QUOTA_TOTAL_BYTES,
+    )
+
+
+@router.get("/cache", response_model=dict)
+async def record_cache_stats(cache: RecordCache = Depends(get_record_cache)):
+    """
+    This worker's record metadata cache: size, hit rate, evictions and
+    invalidations received from other workers.
+    """
+    return cache.snapshot()
+
+
+@router.get("/replicas", response_model=dict)
+async def read_replica_status(replicas: ReadReplicas = Depends(get_read_replicas)):
+    """Configured read replicas, the ones this worker currently reads from, and failovers."""
+    return replicas.snapshot()
+
+
+@router.get("/similarity", response_model=dict)
+async def similarity_index_stats(index: SimilarityIndex = Depends(get_similarity_index)):
+    """This worker's similar-case index: size, partitions, memory."""
+    return index.snapshot()
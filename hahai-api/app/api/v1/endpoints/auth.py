@@ -4,7 +4,7 @@ from pydantic import BaseModel
 from redis.asyncio.client import Redis
 
 from app.api.dependencies import get_redis
-from app.db.keys import intern_key, intern_session_key
+from app.db.keys import intern_key, intern_session_key, intern_sessions_key
 from app.config import settings
 
 router = APIRouter()
@@ -18,6 +18,11 @@ async def intern_login(payload: InternLogin, redis: Redis = Depends(get_redis)):
         raise HTTPException(status_code=403, detail="Unknown student_id")
 
     token = str(uuid.uuid4())
-    await redis.set(intern_session_key(token), payload.student_id, ex=settings.SESSION_TTL_SECONDS)
+    pipe = redis.pipeline(transaction=False)  # session and intern keys live in different slots
+    pipe.set(intern_session_key(token), payload.student_id, ex=settings.SESSION_TTL_SECONDS)
+    # reverse index so an intern's sessions can be revoked (e.g. on purge)
+    pipe.sadd(intern_sessions_key(payload.student_id), token)
+    pipe.expire(intern_sessions_key(payload.student_id), settings.SESSION_TTL_SECONDS)
+    await pipe.execute()
 
     return {"token": token}
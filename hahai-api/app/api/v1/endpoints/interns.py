@@ -1,7 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, File, HTTPException, Query, Request, Response, UploadFile, status
 from redis.asyncio.client import Redis
 
-from app.api.dependencies import get_redis, require_admin
+from app.api.dependencies import get_read_redis, get_redis, require_admin
+from app.api.etags import check_etag
+from app.db.keys import INTERNS_VERSION_KEY
+from app.config import settings
 from app.schemas.intern import InternCreate, InternOut
 from app.services.storage import interns as intern_store
 
@@ -26,12 +29,47 @@ async def create_intern(payload: InternCreate, redis: Redis = Depends(get_redis)
         raise HTTPException(status_code=409, detail=str(e))
 
 
+@router.post(
+    "/bulk",
+    response_model=dict,
+    dependencies=[Depends(require_admin)],
+)
+async def create_interns_bulk(
+    roster: UploadFile = File(..., description="CSV (student_id,name,surname header) or JSON list."),
+    dry_run: bool = Query(False, description="Validate and report without creating anything."),
+    redis: Redis = Depends(get_redis),
+):
+    """
+    Onboards a cohort in one request. Existing and repeated student_ids are
+    skipped, not errors; `results` has one entry per roster row.
+    """
+    data = await roster.read()
+    try:
+        rows = intern_store.parse_roster(data, filename=roster.filename or "", content_type=roster.content_type or "")
+    except intern_store.RosterFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(rows) > settings.ROSTER_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"Roster has {len(rows)} rows (max {settings.ROSTER_MAX_ROWS})")
+
+    results = await intern_store.create_interns_bulk(
+        redis, rows,
+        batch_size=settings.IMPORT_BATCH_SIZE,
+        dry_run=dry_run,
+    )
+    counts: dict[str, int] = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    return {"rows": len(results), "dry_run": dry_run, "counts": counts, "results": results}
+
+
 @router.get(
     "",
     response_model=list[InternOut],
     dependencies=[Depends(require_admin)],
 )
-async def list_interns(redis: Redis = Depends(get_redis)):
+async def list_interns(request: Request, response: Response, redis: Redis = Depends(get_read_redis)):
+    if not_modified := await check_etag(request, response, redis, INTERNS_VERSION_KEY):
+        return not_modified
     return await intern_store.list_interns(redis)
 
 
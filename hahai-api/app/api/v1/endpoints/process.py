@@ -1,70 +1,128 @@
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
+from fastapi import APIRouter, Depends, File, HTTPException, Query, Request, Response, UploadFile
 from redis.asyncio.client import Redis
-import tensorflow as tf
 
-from app.api.dependencies import get_model, get_redis, get_redis_bin, require_intern
+from app.api.dependencies import admit_inference, get_model, get_redis, get_stage_metrics, require_intern
 from app.config import settings
-from app.services.ml.preprocessing import format_img_for_model_input
-from app.services.ml.model import predict_binary
-from app.services.ml.gradcam import generate_gradcam
+from app.services.ml.preprocessing import format_img_for_model_input, make_thumbnails
+from app.services.ml.model import predict_binary, predict_binary_tta
+from app.services.ml.gradcam import encode_overlay_png, gradcam_overlay_and_embedding
+from app.services.ml.registry import ModelLease
+from app.services.ml.similarity import encode_embedding
+from app.services.stages import ClientDisconnectedError, StageMetrics, StageRunner
 from app.services.storage.records import create_temp_record, cancel_temp_record, TempRecordOwnershipError
 
 router = APIRouter()
 
+def _gradcam_png(model, *, batch_x, img_bgr_512):
+    overlay, embedding = gradcam_overlay_and_embedding(
+        model,
+        batch_x=batch_x,
+        img_bgr_512=img_bgr_512,
+        target_layer_name=settings.ENCODER_LAST_CONV_LAYER,
+        alpha=settings.GRADCAM_ALPHA,
+    )
+    return overlay, encode_overlay_png(overlay), encode_embedding(embedding)
+
+
+def _preview_thumbnails(img_bgr_512, overlay):
+    opts = dict(
+        sizes=settings.THUMBNAIL_SIZES,
+        output_format=settings.THUMBNAIL_FORMAT,
+        quality=settings.THUMBNAIL_QUALITY,
+    )
+    xray_thumbs, thumb_ct = make_thumbnails(img_bgr_512, **opts)
+    gradcam_thumbs, _ = make_thumbnails(overlay, **opts)
+    return xray_thumbs, gradcam_thumbs, thumb_ct
+
+
 @router.post("")
 async def start_processing(
+    request: Request,
     xray: UploadFile = File(...),
+    tta: bool | None = Query(None, description="Override TTA_ENABLED for this request."),
     student_id: str = Depends(require_intern),
-    model: tf.keras.Model = Depends(get_model), #type:ignore
+    _admitted: None = Depends(admit_inference),
+    lease: ModelLease = Depends(get_model),
+    metrics: StageMetrics = Depends(get_stage_metrics),
     redis: Redis = Depends(get_redis),
-    redis_bin: Redis = Depends(get_redis_bin),
 ):
     raw_bytes = await xray.read()
     if not raw_bytes:
         raise HTTPException(status_code=400, detail="Empty xray upload")
 
-    # 1) preprocess (standardize to 512 and build model input)
-    img_bgr_512, batch_x, xray_bytes_out, xray_ct = format_img_for_model_input(
-        raw_bytes,
-        image_size=settings.IMAGE_SIZE,
-        output_format="jpg",
-        jpg_quality=95,
-    )
+    # CPU-bound stages run in worker threads so this event loop keeps
+    # answering (and fast-rejecting) other requests meanwhile. Between stages
+    # we stop if the client has gone away, so an abandoned request frees its
+    # slot early and never writes a temp record.
+    stages = StageRunner(metrics, request.is_disconnected)
+    model = lease.model
+    use_tta = settings.TTA_ENABLED if tta is None else tta
+    pred_spread = None
 
-    # 2) predict
-    pred_label, pred_accuracy, _p = predict_binary(model, batch_x)
+    try:
+        # 1) preprocess (standardize to 512 and build model input)
+        img_bgr_512, batch_x, xray_bytes_out, xray_ct = await stages.run(
+            "preprocess", format_img_for_model_input,
+            raw_bytes,
+            image_size=settings.IMAGE_SIZE,
+            output_format="jpg",
+            jpg_quality=95,
+        )
 
-    # 3) gradcam overlay
-    gradcam_bytes = generate_gradcam(
-        model,
-        batch_x=batch_x,
-        img_bgr_512=img_bgr_512,
-        target_layer_name=settings.ENCODER_LAST_CONV_LAYER,
-        alpha=settings.GRADCAM_ALPHA,
-    )
-    gradcam_ct = "image/png"  # change to image/jpeg if you encode gradcam as jpg
-
-    # 4) store temp keys under record:{temp_id}*
-    temp_id = await create_temp_record(
-        redis, redis_bin,
-        student_id=student_id,
-        pred_label=pred_label,
-        pred_accuracy=pred_accuracy,
-        xray_bytes=xray_bytes_out,
-        xray_content_type=xray_ct,
-        gradcam_bytes=gradcam_bytes,
-        gradcam_content_type=gradcam_ct,
-        ttl_seconds= 10 * 60,
-    )
+        # 2) predict (optionally averaged over augmented views in one batch)
+        if use_tta and settings.TTA_VIEWS:
+            pred_label, pred_accuracy, _p, pred_spread = await stages.run(
+                "predict", predict_binary_tta, model, batch_x, views=settings.TTA_VIEWS,
+            )
+        else:
+            pred_label, pred_accuracy, _p = await stages.run("predict", predict_binary, model, batch_x)
+
+        # 3) gradcam overlay (+ embedding for similar-case search, same forward pass)
+        overlay, gradcam_bytes, embedding = await stages.run(
+            "gradcam", _gradcam_png, model, batch_x=batch_x, img_bgr_512=img_bgr_512,
+        )
+        gradcam_ct = "image/png"  # change to image/jpeg if you encode gradcam as jpg
+
+        # 3b) preview thumbnails for list/history views
+        xray_thumbs, gradcam_thumbs, thumb_ct = await stages.run(
+            "thumbnails", _preview_thumbnails, img_bgr_512, overlay,
+        )
+
+        # 4) store temp keys under record:{temp_id}*
+        temp_id = await stages.run(
+            "store", create_temp_record,
+            redis,
+            offload=False,
+            student_id=student_id,
+            pred_label=pred_label,
+            pred_accuracy=pred_accuracy,
+            xray_bytes=xray_bytes_out,
+            xray_content_type=xray_ct,
+            gradcam_bytes=gradcam_bytes,
+            gradcam_content_type=gradcam_ct,
+            xray_thumbs=xray_thumbs,
+            gradcam_thumbs=gradcam_thumbs,
+            thumb_content_type=thumb_ct,
+            embedding=embedding,
+            model_version=lease.version,
+            ttl_seconds= 10 * 60,
+        )
+    except ClientDisconnectedError:
+        # nobody is listening; 499 only shows up in access logs
+        return Response(status_code=499)
+    stages.finish()
 
     return {
         "temp_id": temp_id,
         "pred_label": pred_label,
         "pred_accuracy": pred_accuracy,
+        "pred_spread": pred_spread,  # std of p(positive) across TTA views, percentage points
+        "model_version": lease.version,
         # reuse existing /records image routes
         "xray_url": f"/api/v1/records/{temp_id}/xray",
         "gradcam_url": f"/api/v1/records/{temp_id}/gradcam",
         "expires_in_seconds": 10 * 60,
+        "timings": {k: round(v, 4) for k, v in stages.timings.items()},
     }
 
 
@@ -73,10 +131,9 @@ async def cancel_processing(
     temp_id: str,
     student_id: str = Depends(require_intern),
     redis: Redis = Depends(get_redis),
-    redis_bin: Redis = Depends(get_redis_bin),
 ):
     try:
-        await cancel_temp_record(redis, redis_bin, temp_id=temp_id, student_id=student_id)
+        await cancel_temp_record(redis, temp_id=temp_id, student_id=student_id)
         return {"status": "cancelled", "temp_id": temp_id}
     except TempRecordOwnershipError as e:
         raise HTTPException(status_code=403, detail=str(e))
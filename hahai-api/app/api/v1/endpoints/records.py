@@ -1,30 +1,61 @@
 from __future__ import annotations
 
+import asyncio
 import base64
-
-from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile, status
-from fastapi.responses import Response
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from typing import Literal
+
+from fastapi import APIRouter, Depends, File, Form, HTTPException, Query, Request, UploadFile, status
+from fastapi.responses import Response, StreamingResponse
 from redis.asyncio.client import Redis
 
-from app.api.dependencies import get_redis, get_redis_bin, require_admin, require_intern
-from app.schemas.patient_record import PatientRecordOut, PatientRecordSaveIn
+from app.api.dependencies import (
+    get_intern_read_redis,
+    get_read_redis,
+    get_record_cache,
+    get_redis,
+    get_similarity_index,
+    require_admin,
+    require_intern,
+)
+from app.api.etags import check_etag
+from app.api.streaming import json_response, stream_json_array
+from app.db.keys import RECORDS_VERSION_KEY, intern_records_version_key
+from app.schemas.inference import PredictionLabel
+from app.schemas.patient_record import PatientRecordOut, PatientRecordSaveIn, SimilarRecordOut
+from app.services import jobs
+from app.services.ml import similarity
+from app.services.storage import archive as archive_store
 from app.services.storage import records as record_store
 from app.services.storage import images as image_store
+from app.services.storage import stats as stats_store
+from app.services.storage.record_cache import RecordCache
 from app.services.storage.records import promote_temp_record, TempRecordNotFoundError, TempRecordOwnershipError, TempRecordInvalidError
+from app.services.storage.usage import StorageQuotaExceededError
 
 router = APIRouter()
 
-def _record_to_out(record: dict) -> PatientRecordOut:
+def _record_out(record: dict) -> dict:
+    """PatientRecordOut's fields, in its order, as a plain dict (list fast path, see api/streaming.py)."""
     case_id = record["case_id"]
-    return PatientRecordOut(
-        case_id=case_id,
-        student_id=record["student_id"],
-        notes=record.get("notes", ""),
-        pred_label=record.get("pred_label", ""),
-        pred_accuracy=float(record.get("pred_accuracy", 0.0)),
-        xray_url=f"/api/v1/records/{case_id}/xray",
-        gradcam_url=f"/api/v1/records/{case_id}/gradcam",
-    )
+    return {
+        "case_id": case_id,
+        "student_id": record["student_id"],
+        "notes": record.get("notes", ""),
+        "pred_label": record.get("pred_label", ""),
+        "pred_accuracy": float(record.get("pred_accuracy", 0.0)),
+        "model_version": record.get("model_version", ""),
+        "xray_url": f"/api/v1/records/{case_id}/xray",
+        "gradcam_url": f"/api/v1/records/{case_id}/gradcam",
+    }
+
+
+def _record_to_out(record: dict) -> PatientRecordOut:
+    return PatientRecordOut(**_record_out(record))
 
 
 @router.post(
@@ -46,7 +77,6 @@ async def create_record_test(
     gradcam: UploadFile | None = File(None),
 
     redis: Redis = Depends(get_redis),
-    redis_bin: Redis = Depends(get_redis_bin),
 ):
     try:
         xray_bytes = await xray.read()
@@ -64,7 +94,6 @@ async def create_record_test(
 
         case_id = await record_store.create_record(
             redis,
-            redis_bin,
             student_id=student_id,
             notes=notes,
             pred_label=pred_label,
@@ -87,14 +116,13 @@ async def create_record(
     payload: PatientRecordSaveIn, 
     student_id: str = Depends(require_intern),
     redis: Redis = Depends(get_redis),
-    redis_bin: Redis = Depends(get_redis_bin),
 ):
     """
     SAVE: promote temp record to permanent case_id record.
     """
     try:
         case_id = await promote_temp_record(
-            redis, redis_bin,
+            redis,
             temp_id=payload.temp_id,
             student_id=student_id,
             notes=payload.notes,
@@ -108,6 +136,144 @@ async def create_record(
         raise HTTPException(status_code=403, detail=str(e))
     except TempRecordInvalidError as e:
         raise HTTPException(status_code=409, detail=str(e))
+    except record_store.InternNotFoundForRecordError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except StorageQuotaExceededError as e:
+        raise HTTPException(status_code=507, detail=str(e))
+
+
+def _ts(value: datetime | None) -> float | None:
+    return value.timestamp() if value is not None else None
+
+
+def _spool_to_disk(upload: UploadFile) -> str:
+    archive_store.prune_spools()
+    os.makedirs(archive_store.spool_dir(), exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        prefix=archive_store.SPOOL_PREFIX, suffix=".part", dir=archive_store.spool_dir(), delete=False,
+    ) as out:
+        upload.file.seek(0)
+        shutil.copyfileobj(upload.file, out, length=1024 * 1024)
+        return out.name
+
+
+async def _spool_checked(upload: UploadFile) -> str:
+    # all blocking file I/O (copy, gzip sniffing, header read) off the event loop
+    path = await asyncio.to_thread(_spool_to_disk, upload)
+    try:
+        await asyncio.to_thread(archive_store.read_archive_header, path)
+    except archive_store.ArchiveFormatError as e:
+        await asyncio.to_thread(os.remove, path)
+        raise HTTPException(status_code=400, detail=str(e))
+    return path
+
+
+@router.post(
+    "/import",
+    response_model=dict,
+    status_code=status.HTTP_202_ACCEPTED,
+    dependencies=[Depends(require_admin)],
+)
+async def import_records(
+    archive: UploadFile | None = File(None),
+    batch_size: int | None = Query(None, ge=1, le=10_000),
+    resume: str | None = Query(None, description="job_id of an interrupted or failed import to continue"),
+    redis: Redis = Depends(get_redis),
+):
+    """
+    Bulk restore from a record archive. Runs as a background job;
+    poll GET /admin/jobs/{job_id} for progress. The upload is kept under
+    the job id until the import completes, so ?resume=<job_id> continues
+    from the job's checkpoint without uploading again (or with the same
+    archive uploaded again, if the spooled copy is gone).
+    """
+    if resume is not None:
+        try:
+            job = await jobs.get_job(redis, resume)
+        except jobs.JobNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        if job["kind"] != "records_import":
+            raise HTTPException(status_code=409, detail=f"Job {resume} is not an import job")
+        if job["status"] == "completed":
+            raise HTTPException(status_code=409, detail=f"Job {resume} has already completed")
+        if job["status"] in ("pending", "running") and time.time() - job["updated_at"] < archive_store.IMPORT_STALE_SECONDS:
+            raise HTTPException(status_code=409, detail=f"Job {resume} is still running")
+        job_id = resume
+        path = archive_store.spool_path(job_id)
+        if archive is not None:
+            await asyncio.to_thread(os.replace, await _spool_checked(archive), path)
+        elif not await asyncio.to_thread(os.path.exists, path):
+            raise HTTPException(
+                status_code=409,
+                detail=f"The upload of job {resume} is no longer spooled here; upload the archive again with ?resume",
+            )
+        # claim it before returning, so a second resume gets the 409 above
+        await jobs.update_job(redis, job_id, status="pending")
+    else:
+        if archive is None:
+            raise HTTPException(status_code=400, detail="An archive upload is required unless resuming a job")
+        part = await _spool_checked(archive)
+        job_id = await jobs.create_job(redis, kind="records_import", params={"source": archive.filename})
+        path = archive_store.spool_path(job_id)
+        await asyncio.to_thread(os.replace, part, path)
+
+    jobs.run_in_background(archive_store.import_archive_file(
+        redis, path,
+        job_id=job_id,
+        batch_size=batch_size,
+        delete_after=True,
+    ))
+    return {"status": "accepted", "job_id": job_id}
+
+
+@router.get(
+    "/export",
+    dependencies=[Depends(require_admin)],
+)
+async def export_records(
+    redis: Redis = Depends(get_read_redis),
+):
+    return StreamingResponse(
+        archive_store.iter_archive_lines(redis),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="records.ndjson"'},
+    )
+
+
+@router.get(
+    "/stats",
+    response_model=dict,
+    dependencies=[Depends(require_admin)],
+)
+async def record_stats(redis: Redis = Depends(get_read_redis)):
+    """
+    Dashboard aggregates, read from counters maintained at write time.
+    """
+    return await stats_store.get_stats(redis)
+
+
+@router.get(
+    "/search",
+    response_model=list[PatientRecordOut],
+    dependencies=[Depends(require_admin)],
+)
+async def search_records(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    redis: Redis = Depends(get_read_redis),
+    primary: Redis = Depends(get_redis),
+    cache: RecordCache = Depends(get_record_cache),
+):
+    """
+    Ranked search over intern notes; the total match count is in X-Total-Count.
+    """
+    total, records = await record_store.search_records(
+        redis, query=q, offset=offset, limit=limit, cache=cache, primary=primary,
+    )
+    response.headers["X-Total-Count"] = str(total)
+    return json_response(records, convert=_record_out, headers=response.headers)
 
 
 @router.get(
@@ -115,9 +281,59 @@ async def create_record(
     response_model=list[PatientRecordOut],
     dependencies=[Depends(require_admin)],
 )
-async def list_all_records(redis: Redis = Depends(get_redis)):
-    records = await record_store.list_records(redis)
-    return [_record_to_out(r) for r in records]
+async def list_all_records(
+    request: Request,
+    response: Response,
+    pred_label: PredictionLabel | None = None,
+    student_id: str | None = None,
+    min_accuracy: float | None = Query(None, ge=0.0, le=100.0),
+    max_accuracy: float | None = Query(None, ge=0.0, le=100.0),
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+    saved_from: datetime | None = None,
+    saved_to: datetime | None = None,
+    sort_by: Literal["created_at", "saved_at", "pred_accuracy"] = "created_at",
+    order: Literal["asc", "desc"] = "desc",
+    offset: int = Query(0, ge=0),
+    limit: int | None = Query(None, ge=1, le=1000),
+    redis: Redis = Depends(get_read_redis),
+    primary: Redis = Depends(get_redis),
+    cache: RecordCache = Depends(get_record_cache),
+):
+    """
+    Without query parameters this returns every record (unchanged behaviour).
+    Any filter, sort or paging parameter switches to the indexed query path;
+    the total match count is returned in X-Total-Count. Either way the
+    response carries an ETag; polls with a current If-None-Match get 304.
+    The array is streamed as the records are read.
+    """
+    if not_modified := await check_etag(request, response, redis, RECORDS_VERSION_KEY):
+        return not_modified
+
+    params = (pred_label, student_id, min_accuracy, max_accuracy,
+              created_from, created_to, saved_from, saved_to, limit)
+    if all(p is None for p in params) and offset == 0 and sort_by == "created_at" and order == "desc":
+        pages = record_store.iter_all_records(redis, cache=cache, primary=primary)
+        return await stream_json_array(pages, convert=_record_out, headers=response.headers)
+
+    total, pages = await record_store.query_record_pages(
+        redis,
+        cache=cache,
+        primary=primary,
+        pred_label=pred_label.value if pred_label else None,
+        student_id=student_id,
+        ranges={
+            "pred_accuracy": (min_accuracy, max_accuracy),
+            "created_at": (_ts(created_from), _ts(created_to)),
+            "saved_at": (_ts(saved_from), _ts(saved_to)),
+        },
+        sort_by=sort_by,
+        descending=order == "desc",
+        offset=offset,
+        limit=limit,
+    )
+    response.headers["X-Total-Count"] = str(total)
+    return await stream_json_array(pages, convert=_record_out, headers=response.headers)
 
 
 @router.get(
@@ -125,10 +341,19 @@ async def list_all_records(redis: Redis = Depends(get_redis)):
     response_model=list[PatientRecordOut],
     dependencies=[Depends(require_admin)]
 )
-async def list_records_for_intern(student_id: str, redis: Redis = Depends(get_redis)):
+async def list_records_for_intern(
+    student_id: str,
+    request: Request,
+    response: Response,
+    redis: Redis = Depends(get_read_redis),
+    primary: Redis = Depends(get_redis),
+    cache: RecordCache = Depends(get_record_cache),
+):
+    if not_modified := await check_etag(request, response, redis, intern_records_version_key(student_id)):
+        return not_modified
     try:
-        records = await record_store.list_records_for_intern(redis, student_id=student_id)
-        return [_record_to_out(r) for r in records]
+        pages = record_store.iter_records_for_intern(redis, student_id=student_id, cache=cache, primary=primary)
+        return await stream_json_array(pages, convert=_record_out, headers=response.headers)
     except record_store.InternNotFoundForRecordError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
@@ -137,25 +362,68 @@ async def list_records_for_intern(student_id: str, redis: Redis = Depends(get_re
     response_model=list[PatientRecordOut]
 )
 async def list_my_intern_records(
+    request: Request,
+    response: Response,
     student_id: str = Depends(require_intern),
-    redis: Redis = Depends(get_redis),
+    redis: Redis = Depends(get_intern_read_redis),
+    primary: Redis = Depends(get_redis),
+    cache: RecordCache = Depends(get_record_cache),
 ):
-    records = await record_store.list_records_for_intern(redis, student_id=student_id)
-    return [_record_to_out(r) for r in records]
+    if not_modified := await check_etag(request, response, redis, intern_records_version_key(student_id)):
+        return not_modified
+    pages = record_store.iter_records_for_intern(redis, student_id=student_id, cache=cache, primary=primary)
+    return await stream_json_array(pages, convert=_record_out, headers=response.headers)
 
 
 @router.get(
     "/{case_id}",
     response_model=PatientRecordOut
 )
-async def get_record(case_id: str, redis: Redis = Depends(get_redis)):
+async def get_record(
+    case_id: str,
+    redis: Redis = Depends(get_read_redis),
+    primary: Redis = Depends(get_redis),
+    cache: RecordCache = Depends(get_record_cache),
+):
     try:
-        record = await record_store.get_record(redis, case_id=case_id)
+        record = await record_store.get_record(redis, case_id=case_id, cache=cache, primary=primary)
         return _record_to_out(record)
     except record_store.RecordNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 
+@router.get(
+    "/{case_id}/similar",
+    response_model=list[SimilarRecordOut],
+    dependencies=[Depends(require_admin)],
+)
+async def similar_records(
+    case_id: str,
+    k: int = Query(10, ge=1, le=100),
+    redis: Redis = Depends(get_read_redis),
+    primary: Redis = Depends(get_redis),
+    cache: RecordCache = Depends(get_record_cache),
+    index: similarity.SimilarityIndex = Depends(get_similarity_index),
+):
+    """
+    The k records whose x-rays look most like this one (cosine similarity of
+    the model's image embeddings), most similar first.
+    """
+    try:
+        matches = index.similar_to(case_id, k=k)
+    except similarity.SimilarityIndexNotReadyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except similarity.EmbeddingNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    records = await record_store.get_records(redis, [cid for cid, _ in matches], cache=cache, primary=primary)
+    scores = dict(matches)
+    return [
+        SimilarRecordOut(**_record_to_out(r).model_dump(), similarity=round(scores[r["case_id"]], 4))
+        for r in records
+    ]
+
+
 @router.delete(
     "/{case_id}",
     response_model=dict,
@@ -164,48 +432,73 @@ async def get_record(case_id: str, redis: Redis = Depends(get_redis)):
 async def delete_record(
     case_id: str,
     redis: Redis = Depends(get_redis),
-    redis_bin: Redis = Depends(get_redis_bin),
+    cache: RecordCache = Depends(get_record_cache),
 ):
     try:
-        await record_store.delete_record(redis, redis_bin, case_id=case_id)
+        await record_store.delete_record(redis, case_id=case_id, cache=cache)
         return {"status": "deleted", "case_id": case_id}
     except record_store.RecordNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
 
-@router.get("/{case_id}/xray")
-async def get_xray(
+def _pick_thumb_size(record: dict, size: int | None) -> int | None:
+    """
+    Smallest stored thumbnail that is at least `size` px; None means serve the original.
+    """
+    if size is None:
+        return None
+    candidates = [s for s in record.get("thumb_sizes", []) if s >= size]
+    return min(candidates) if candidates else None
+
+
+async def _serve_image(
+    redis: Redis,
+    primary: Redis,
+    cache: RecordCache,
+    *,
     case_id: str,
-    redis: Redis = Depends(get_redis),
-    redis_bin: Redis = Depends(get_redis_bin),
-):
+    kind: str,
+    size: int | None,
+) -> Response:
     try:
-        record = await record_store.get_record(redis, case_id=case_id)
+        record = await record_store.get_record(redis, case_id=case_id, cache=cache, primary=primary)
     except record_store.RecordNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
 
-    data = await image_store.get_xray(redis_bin, case_id=case_id)
+    thumb = _pick_thumb_size(record, size)
+    if thumb is not None:
+        data = await image_store.get_thumbnail(redis, case_id=case_id, kind=kind, size=thumb, primary=primary)
+        if data is not None:
+            return Response(content=data, media_type=record["thumb_content_type"] or "application/octet-stream")
+
+    if kind == "xray":
+        data = await image_store.get_xray(redis, case_id=case_id, primary=primary)
+    else:
+        data = await image_store.get_gradcam(redis, case_id=case_id, primary=primary)
     if data is None:
-        raise HTTPException(status_code=404, detail="Xray image not found")
+        raise HTTPException(status_code=404, detail=f"{kind.capitalize()} image not found")
 
-    content_type = record.get("xray_content_type", "application/octet-stream")
+    content_type = record.get(f"{kind}_content_type", "application/octet-stream")
     return Response(content=data, media_type=content_type)
 
 
-@router.get("/{case_id}/gradcam")
-async def get_gradcam(
+@router.get("/{case_id}/xray")
+async def get_xray(
     case_id: str,
-    redis: Redis = Depends(get_redis),
-    redis_bin: Redis = Depends(get_redis_bin),
+    size: int | None = Query(None, ge=1, description="Max preview edge in px; served from the closest stored thumbnail."),
+    redis: Redis = Depends(get_read_redis),
+    primary: Redis = Depends(get_redis),
+    cache: RecordCache = Depends(get_record_cache),
 ):
-    try:
-        record = await record_store.get_record(redis, case_id=case_id)
-    except record_store.RecordNotFoundError as e:
-        raise HTTPException(status_code=404, detail=str(e))
+    return await _serve_image(redis, primary, cache, case_id=case_id, kind="xray", size=size)
 
-    data = await image_store.get_gradcam(redis_bin, case_id=case_id)
-    if data is None:
-        raise HTTPException(status_code=404, detail="Gradcam image not found")
 
-    content_type = record.get("gradcam_content_type", "application/octet-stream")
-    return Response(content=data, media_type=content_type)
+@router.get("/{case_id}/gradcam")
+async def get_gradcam(
+    case_id: str,
+    size: int | None = Query(None, ge=1, description="Max preview edge in px; served from the closest stored thumbnail."),
+    redis: Redis = Depends(get_read_redis),
+    primary: Redis = Depends(get_redis),
+    cache: RecordCache = Depends(get_record_cache),
+):
+    return await _serve_image(redis, primary, cache, case_id=case_id, kind="gradcam", size=size)
@@ -0,0 +1,147 @@
+"""
+Offline batch inference for case libraries, outside uvicorn.
+
+  python -m app.cli.infer DIR --student-id ID [--batch-size N] [--workers N]
+                          [--notes-from-filename]
+                          [--model-path PATH --model-version NAME]
+  python -m app.cli.infer --resume JOB_ID [--batch-size N] [--workers N]
+
+Every image under DIR becomes a saved record of the given intern. Re-run with
+--resume JOB_ID after an interruption to skip the files already written; the
+directory, intern and model come from the job, and passing different ones is
+an error.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from app.config import settings
+from app.db.redis import create_redis
+from app.services import jobs
+
+# what a run writes depends on these, so a resume must use the job's values
+JOB_PARAMS = ("directory", "student_id", "model_path", "model_version", "notes_from_filename")
+
+
+class ResumeConflictError(Exception):
+    pass
+
+
+def _resume_params(args: argparse.Namespace, job: dict) -> dict:
+    """The job's stored params; raises ResumeConflictError if the command line disagrees."""
+    if job["kind"] != "batch_inference":
+        raise ResumeConflictError(f"Job {job['job_id']} is not a batch inference job")
+    stored = job["params"]
+    given = _given_params(args)
+    conflicts = [
+        f"{name}={given[name]!r} (job has {stored.get(name)!r})"
+        for name in JOB_PARAMS
+        if given[name] is not None and name in stored and given[name] != stored[name]
+    ]
+    if conflicts:
+        raise ResumeConflictError(f"--resume {job['job_id']} conflicts with " + ", ".join(conflicts))
+    # jobs started before a param was recorded fall back to the command line
+    return {name: stored[name] if name in stored else given[name] for name in JOB_PARAMS}
+
+
+def _given_params(args: argparse.Namespace) -> dict:
+    return {
+        "directory": os.path.abspath(args.directory) if args.directory else None,
+        "student_id": args.student_id,
+        "model_path": args.model_path,
+        "model_version": args.model_version,
+        "notes_from_filename": args.notes_from_filename,
+    }
+
+
+def _new_params(args: argparse.Namespace) -> dict:
+    params = _given_params(args)
+    params["model_path"] = params["model_path"] or settings.MODEL_PATH
+    params["model_version"] = params["model_version"] or settings.MODEL_VERSION
+    params["notes_from_filename"] = bool(params["notes_from_filename"])
+    return params
+
+
+async def _run(args: argparse.Namespace) -> int:
+    # Imported here, not at module level: the preprocessing pool uses spawn,
+    # which re-imports this module in every worker process.
+    from app.services import batch_inference
+    from app.services.ml.model import load_keras_model
+
+    redis = await create_redis(settings.REDIS_URL)
+    try:
+        if args.resume:
+            job_id = args.resume
+            try:
+                params = _resume_params(args, await jobs.get_job(redis, job_id))
+            except (jobs.JobNotFoundError, ResumeConflictError) as e:
+                print(str(e), file=sys.stderr)
+                return 2
+            if params["directory"] is None or params["student_id"] is None:
+                print(f"Job {job_id} has no stored directory/intern; pass DIR and --student-id", file=sys.stderr)
+                return 2
+        else:
+            params = _new_params(args)
+            job_id = await jobs.create_job(redis, kind="batch_inference", params=params)
+        print(f"job {job_id}", file=sys.stderr)
+
+        model = load_keras_model(params["model_path"] or settings.MODEL_PATH)
+
+        def report(p: dict) -> None:
+            rate = p["processed"] / p["elapsed"] if p["elapsed"] > 0 else 0.0
+            print(
+                f"processed={p['processed']}/{p['todo']} failed={p['failed']} ({rate:.1f} img/s)",
+                file=sys.stderr,
+            )
+
+        try:
+            summary = await batch_inference.run_batch_inference(
+                redis,
+                model=model,
+                model_version=params["model_version"] or settings.MODEL_VERSION,
+                root=params["directory"],
+                student_id=params["student_id"],
+                job_id=job_id,
+                batch_size=args.batch_size,
+                workers=args.workers,
+                notes_from_filename=bool(params["notes_from_filename"]),
+                on_progress=report,
+            )
+        except batch_inference.BatchInferenceError as e:
+            await jobs.update_job(redis, job_id, status="failed", error=str(e))
+            print(str(e), file=sys.stderr)
+            return 1
+        except BaseException as e:
+            await jobs.update_job(redis, job_id, status="interrupted", error=str(e) or type(e).__name__)
+            print(f"interrupted; resume with --resume {job_id}", file=sys.stderr)
+            raise
+
+        print(json.dumps({"job_id": job_id, **summary}, indent=2))
+        return 0 if not summary["failed"] else 2
+    finally:
+        await redis.aclose()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli.infer")
+    parser.add_argument("directory", nargs="?", help="directory of x-ray images (searched recursively)")
+    parser.add_argument("--student-id", help="intern the records are saved for")
+    parser.add_argument("--batch-size", type=int, default=settings.INFER_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="preprocessing processes")
+    # None = not given, so --resume can tell an explicit value from a default
+    parser.add_argument("--notes-from-filename", action="store_true", default=None, help="use the file name as the record notes")
+    parser.add_argument("--resume", metavar="JOB_ID", help="continue an interrupted run with the job's directory, intern and model")
+    parser.add_argument("--model-path", help=f"default {settings.MODEL_PATH}")
+    parser.add_argument("--model-version", help=f"default {settings.MODEL_VERSION}")
+    args = parser.parse_args(argv)
+    if not args.resume and (args.directory is None or args.student_id is None):
+        parser.error("DIR and --student-id are required unless resuming with --resume JOB_ID")
+    return asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
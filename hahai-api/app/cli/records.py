@@ -0,0 +1,316 @@
+"""
+Record maintenance commands that run outside uvicorn.
+
+  python -m app.cli.records import archive.ndjson[.gz] [--batch-size N] [--resume JOB_ID]
+  python -m app.cli.records export archive.ndjson
+  python -m app.cli.records rebuild-stats
+  python -m app.cli.records rebuild-indexes
+  python -m app.cli.records sweep [--grace-seconds N]
+  python -m app.cli.records migrate-keys [--source-url URL [--source-cluster]] [--keep-source] [--dry-run]
+  python -m app.cli.records encode-records --to compact|legacy [--dry-run]
+  python -m app.cli.records encoding-bench [--records N] [--redis-url URL] [--flush]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+
+from app.config import settings
+from app.db.keys import record_key
+from app.db.redis import create_redis
+from app.services import jobs
+from app.services.storage import archive as archive_store
+from app.services.storage import indexes as index_store
+from app.services.storage import interns as intern_store
+from app.services.storage import migrate as migrate_store
+from app.services.storage import records as record_store
+from app.services.storage import stats as stats_store
+from app.services.storage import sweeper
+from app.services.storage import usage as usage_store
+from app.services.storage.record_codec import decode_record
+
+
+async def _import(args: argparse.Namespace) -> int:
+    redis = await create_redis(settings.REDIS_URL)
+    try:
+        if args.resume:
+            job_id = args.resume
+            await jobs.get_job(redis, job_id)
+        else:
+            job_id = await jobs.create_job(redis, kind="records_import", params={"source": args.path})
+        print(f"job {job_id}", file=sys.stderr)
+
+        started = time.perf_counter()
+        totals: dict[str, int] = {}
+
+        def report(counts: dict[str, int]) -> None:
+            for k, v in counts.items():
+                totals[k] = totals.get(k, 0) + v
+            elapsed = time.perf_counter() - started
+            rate = totals.get("lines_read", 0) / elapsed if elapsed > 0 else 0.0
+            print(
+                f"read={totals.get('lines_read', 0)} imported={totals.get('imported', 0)} "
+                f"existing={totals.get('skipped_existing', 0)} "
+                f"unknown_intern={totals.get('skipped_unknown_intern', 0)} "
+                f"invalid={totals.get('invalid', 0)} ({rate:.0f} rec/s)",
+                file=sys.stderr,
+            )
+
+        job = await archive_store.import_archive_file(
+            redis, args.path,
+            job_id=job_id,
+            batch_size=args.batch_size,
+            on_progress=report,
+        )
+        print(f"{job['status']}: {job.get('imported', 0)} imported", file=sys.stderr)
+        return 0 if job["status"] == "completed" else 1
+    finally:
+        await redis.aclose()
+
+
+async def _export(args: argparse.Namespace) -> int:
+    redis = await create_redis(settings.REDIS_URL)
+    try:
+        count = -1  # header line
+        with open(args.path, "wb") as out:
+            async for line in archive_store.iter_archive_lines(redis, page_size=args.batch_size):
+                out.write(line)
+                count += 1
+        print(f"exported {count} records to {args.path}", file=sys.stderr)
+        return 0
+    finally:
+        await redis.aclose()
+
+
+async def _rebuild_stats(args: argparse.Namespace) -> int:
+    redis = await create_redis(settings.REDIS_URL)
+    try:
+        stats = await stats_store.rebuild_stats(redis, page_size=args.batch_size)
+        print(json.dumps(stats, indent=2))
+        return 0
+    finally:
+        await redis.aclose()
+
+
+async def _rebuild_indexes(args: argparse.Namespace) -> int:
+    redis = await create_redis(settings.REDIS_URL)
+    try:
+        n = await index_store.rebuild_indexes(redis, page_size=args.batch_size)
+        print(f"indexed {n} records", file=sys.stderr)
+        return 0
+    finally:
+        await redis.aclose()
+
+
+async def _sweep(args: argparse.Namespace) -> int:
+    redis = await create_redis(settings.REDIS_URL)
+    try:
+        totals = await sweeper.sweep(
+            redis,
+            batch_size=args.batch_size,
+            pause=args.pause,
+            grace_seconds=args.grace_seconds,
+        )
+        print(json.dumps(totals, indent=2))
+        return 0
+    except sweeper.SweepInProgressError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    finally:
+        await redis.aclose()
+
+
+async def _migrate_keys(args: argparse.Namespace) -> int:
+    target = await create_redis(settings.REDIS_URL)
+    source = await create_redis(args.source_url, cluster=args.source_cluster) if args.source_url else target
+    try:
+        moved = {"record_keys_moved": 0}
+
+        def report(counts: dict[str, int]) -> None:
+            moved["record_keys_moved"] += counts.get("record_keys_moved", 0)
+            print(f"record keys moved: {moved['record_keys_moved']}", file=sys.stderr)
+
+        summary = await migrate_store.migrate_keys(
+            source, target,
+            batch_size=args.batch_size,
+            keep_source=args.keep_source,
+            dry_run=args.dry_run,
+            on_progress=report,
+        )
+        print(json.dumps(summary, indent=2))
+        return 0
+    finally:
+        if source is not target:
+            await source.aclose()
+        await target.aclose()
+
+
+async def _encode_records(args: argparse.Namespace) -> int:
+    redis = await create_redis(settings.REDIS_URL)
+    try:
+        totals = {"records_scanned": 0, "records_converted": 0}
+
+        def report(counts: dict[str, int]) -> None:
+            for k in totals:
+                totals[k] += counts.get(k, 0)
+            print(f"scanned={totals['records_scanned']} converted={totals['records_converted']}", file=sys.stderr)
+
+        summary = await migrate_store.reencode_records(
+            redis,
+            compact=args.to == "compact",
+            batch_size=args.batch_size,
+            dry_run=args.dry_run,
+            on_progress=report,
+        )
+        print(json.dumps(summary, indent=2))
+        if summary["conflicts"]:
+            print("some records changed while converting; run again to finish them", file=sys.stderr)
+        return 0
+    finally:
+        await redis.aclose()
+
+
+async def _bench_records(redis, n: int, rng: random.Random) -> list[str]:
+    """n records shaped like real ones: half saved from a temp record, half created directly."""
+    labels = ("positive", "negative")
+    for i in range(n):
+        common = dict(
+            student_id="bench",
+            pred_label=rng.choice(labels),
+            pred_accuracy=rng.uniform(50, 100),
+            xray_bytes=b"x" * rng.randint(40_000, 90_000),
+            xray_content_type="image/jpeg",
+            gradcam_bytes=b"g" * rng.randint(60_000, 120_000),
+            gradcam_content_type="image/png",
+            model_version="v1",
+        )
+        notes = " ".join(rng.choice(("fracture", "distal", "radius", "no", "displacement", "ulna", "styloid")) for _ in range(rng.randint(0, 12)))
+        if i % 2:
+            await record_store.create_record(redis, notes=notes, **common)
+        else:
+            temp_id = await record_store.create_temp_record(
+                redis, **common,
+                xray_thumbs={128: b"t" * 3000, 256: b"t" * 9000},
+                gradcam_thumbs={128: b"t" * 3500, 256: b"t" * 11000},
+                thumb_content_type="image/webp",
+            )
+            await record_store.promote_temp_record(redis, temp_id=temp_id, student_id="bench", notes=notes)
+    return await index_store.intern_record_ids(redis, "bench")
+
+
+async def _encoding_bench(args: argparse.Namespace) -> int:
+    redis = await create_redis(args.redis_url, cluster=False)
+    if await redis.dbsize():
+        if not args.flush:
+            print(f"{args.redis_url} is not empty; use a scratch database or pass --flush", file=sys.stderr)
+            await redis.aclose()
+            return 2
+        await redis.flushdb()
+
+    try:
+        settings.RECORD_COMPACT_ENCODING = False
+        await intern_store.create_intern(redis, student_id="bench", name="Bench", surname="Mark")
+        case_ids = await _bench_records(redis, args.records, random.Random(args.seed))
+        keys = [record_key(cid) for cid in case_ids]
+
+        async def measure() -> dict:
+            sizes, method = await usage_store.measure_hash_bytes(redis, keys)
+            pipe = redis.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            stored = await pipe.execute()
+            started = time.perf_counter()
+            for cid, data in zip(case_ids, stored):
+                decode_record(data, cid)
+            decode_us = (time.perf_counter() - started) / len(keys) * 1e6
+            return {
+                "bytes_per_record": round(statistics.mean(sizes), 1),
+                "fields_per_record": round(statistics.mean(len(d) for d in stored), 1),
+                "decode_us_per_record": round(decode_us, 2),
+                "method": method,
+            }
+
+        legacy = await measure()
+        converted = await migrate_store.reencode_records(redis, compact=True, batch_size=args.batch_size)
+        compact = await measure()
+
+        before, after = legacy["bytes_per_record"], compact["bytes_per_record"]
+        print(json.dumps({
+            "records": len(keys),
+            "legacy": legacy,
+            "compact": compact,
+            "saved_bytes_per_record": round(before - after, 1),
+            "saved_pct": round(100 * (before - after) / before, 1) if before else 0.0,
+            "records_converted": converted["records_converted"],
+        }, indent=2))
+        return 0
+    finally:
+        await redis.flushdb()  # the database was empty (or flushed) when we started
+        await redis.aclose()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli.records")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_import = sub.add_parser("import", help="bulk import a record archive")
+    p_import.add_argument("path")
+    p_import.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+    p_import.add_argument("--resume", metavar="JOB_ID", help="continue an interrupted import job")
+    p_import.set_defaults(func=_import)
+
+    p_export = sub.add_parser("export", help="write all records to an archive")
+    p_export.add_argument("path")
+    p_export.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+    p_export.set_defaults(func=_export)
+
+    p_stats = sub.add_parser("rebuild-stats", help="recompute dashboard aggregates from scratch")
+    p_stats.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+    p_stats.set_defaults(func=_rebuild_stats)
+
+    p_idx = sub.add_parser("rebuild-indexes", help="backfill the secondary record indexes")
+    p_idx.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+    p_idx.set_defaults(func=_rebuild_indexes)
+
+    p_sweep = sub.add_parser("sweep", help="repair dangling index entries and reclaim orphaned blobs")
+    p_sweep.add_argument("--batch-size", type=int, default=settings.SWEEP_BATCH_SIZE)
+    p_sweep.add_argument("--pause", type=float, default=settings.SWEEP_PAUSE_SECONDS)
+    p_sweep.add_argument("--grace-seconds", type=int, default=settings.SWEEP_GRACE_SECONDS)
+    p_sweep.set_defaults(func=_sweep)
+
+    p_migrate = sub.add_parser(
+        "migrate-keys",
+        help="move data into the current (cluster-ready) key layout and rebuild indexes and stats",
+    )
+    p_migrate.add_argument("--source-url", help="old server to copy from (default: migrate REDIS_URL in place)")
+    p_migrate.add_argument("--source-cluster", action="store_true", help="the source is a Redis Cluster")
+    p_migrate.add_argument("--keep-source", action="store_true", help="copy without deleting the source keys")
+    p_migrate.add_argument("--dry-run", action="store_true", help="only count the keys that would move")
+    p_migrate.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+    p_migrate.set_defaults(func=_migrate_keys)
+
+    p_encode = sub.add_parser("encode-records", help="rewrite record hashes in the compact or the legacy encoding")
+    p_encode.add_argument("--to", choices=("compact", "legacy"), required=True)
+    p_encode.add_argument("--dry-run", action="store_true", help="only count the records that would change")
+    p_encode.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+    p_encode.set_defaults(func=_encode_records)
+
+    p_bench = sub.add_parser("encoding-bench", help="bytes per record hash, legacy vs compact, on a scratch database")
+    p_bench.add_argument("--records", type=int, default=2000)
+    p_bench.add_argument("--redis-url", default="redis://localhost:6379/15")
+    p_bench.add_argument("--flush", action="store_true", help="FLUSHDB the scratch database first")
+    p_bench.add_argument("--seed", type=int, default=0)
+    p_bench.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE)
+    p_bench.set_defaults(func=_encoding_bench)
+
+    args = parser.parse_args(argv)
+    return asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
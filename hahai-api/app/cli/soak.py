@@ -0,0 +1,251 @@
+"""
+Memory soak for the inference path: drives thousands of /process calls
+through the real app (in-process, with a small stand-in model) and fails
+if memory keeps growing.
+
+  python -m app.cli.soak [--requests N] [--redis-url URL] [--flush]
+                         [--image-size PX] [--concurrency N] [--save-every N]
+                         [--max-rss-mb-per-1k MB] [--max-heap-mb-per-1k MB]
+                         [--max-tf-objects-per-1k N] [--report PATH]
+
+Every --sample-every requests it records RSS, the Python heap (tracemalloc)
+and the number of live TensorFlow/Keras objects. Growth is the slope of a
+least-squares fit over the samples after --warmup requests, per 1000
+requests; exit status 1 if any slope is over its threshold, so it can gate
+a deploy. Uses its own Redis database (default db 15), which must be empty
+unless --flush is given.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2 as cv
+import numpy as np
+
+from app.config import settings
+
+MB = 1024 * 1024
+
+
+def _rss_bytes() -> int:
+    # current (not peak) resident set size
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak; Linux reports KiB
+
+
+def _tf_object_counts() -> dict[str, int]:
+    """Live objects whose type comes from tensorflow/keras, by type (top 10) and in total."""
+    counts: dict[str, int] = {}
+    for obj in gc.get_objects():
+        module = getattr(type(obj), "__module__", None)
+        if isinstance(module, str) and module.startswith(("tensorflow", "keras", "tf_keras")):
+            name = f"{module}.{type(obj).__qualname__}"
+            counts[name] = counts.get(name, 0) + 1
+    top = dict(sorted(counts.items(), key=lambda kv: -kv[1])[:10])
+    return {"total": sum(counts.values()), **top}
+
+
+def _slope_per_1k(xs: list[int], ys: list[float]) -> float:
+    if len(xs) < 2:
+        return 0.0
+    slope = np.polyfit(np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64), 1)[0]
+    return float(slope) * 1000
+
+
+def build_stand_in_model(path: str, *, image_size: int) -> None:
+    """
+    A few-layer sigmoid classifier with the real model's interface: RGB
+    input in [0, 255], a conv layer named ENCODER_LAST_CONV_LAYER for
+    Grad-CAM and embeddings, one output unit.
+    """
+    import tensorflow as tf
+
+    inputs = tf.keras.Input(shape=(image_size, image_size, 3)) # type:ignore
+    x = tf.keras.layers.Rescaling(1.0 / 255)(inputs) # type:ignore
+    x = tf.keras.layers.Conv2D(8, 3, strides=4, padding="same")(x) # type:ignore
+    x = tf.keras.layers.Conv2D(16, 3, strides=2, padding="same")(x) # type:ignore
+    x = tf.keras.layers.Activation("relu", name=settings.ENCODER_LAST_CONV_LAYER)(x) # type:ignore
+    x = tf.keras.layers.GlobalAveragePooling2D()(x) # type:ignore
+    outputs = tf.keras.layers.Dense(1, activation="sigmoid")(x) # type:ignore
+    tf.keras.Model(inputs, outputs).save(path) # type:ignore
+
+
+def _random_xray(rng: np.random.Generator) -> bytes:
+    # varying sizes and aspect ratios, like real uploads, so preprocessing
+    # allocates differently shaped buffers
+    h, w = int(rng.integers(400, 1400)), int(rng.integers(400, 1400))
+    img = rng.integers(0, 256, size=(h // 8, w // 8), dtype=np.uint8)
+    img = cv.resize(img, (w, h), interpolation=cv.INTER_LINEAR)
+    ok, buf = cv.imencode(".jpg", img, [int(cv.IMWRITE_JPEG_QUALITY), 90])
+    if not ok:
+        raise ValueError("Failed to encode soak image")
+    return buf.tobytes()
+
+
+async def _soak(args: argparse.Namespace) -> int:
+    import httpx
+    from redis.asyncio.client import Redis
+
+    workdir = tempfile.mkdtemp(prefix="hahai-soak-")
+    model_path = os.path.join(workdir, "model.keras")
+    build_stand_in_model(model_path, image_size=args.image_size)
+
+    # the app reads these at startup; nothing else in the soak needs them
+    settings.REDIS_URL = args.redis_url
+    settings.REDIS_CLUSTER = False
+    settings.REDIS_REPLICA_URLS = []
+    settings.IMAGE_SIZE = args.image_size
+    settings.MODEL_PATH = model_path
+    settings.MODEL_VERSION = "soak"
+    settings.MODEL_SYNC_INTERVAL_SECONDS = 0
+    settings.SWEEP_INTERVAL_SECONDS = 0
+    settings.PROCESS_MAX_CONCURRENCY = max(settings.PROCESS_MAX_CONCURRENCY, args.concurrency)
+    settings.PROCESS_MAX_QUEUE = max(settings.PROCESS_MAX_QUEUE, args.concurrency)
+
+    redis = Redis.from_url(args.redis_url, decode_responses=True)
+    if await redis.dbsize():
+        if not args.flush:
+            print(f"{args.redis_url} is not empty; use a scratch database or pass --flush", file=sys.stderr)
+            await redis.aclose()
+            return 2
+        await redis.flushdb()
+
+    from app.server import app
+    from app.services.storage import interns as intern_store
+
+    for lane in range(args.concurrency):
+        await intern_store.create_intern(redis, student_id=f"soak-{lane}", name="Soak", surname=str(lane))
+
+    rng = np.random.default_rng(args.seed)
+    images = [_random_xray(rng) for _ in range(args.distinct_images)]
+    samples: list[dict] = []
+    failures = 0
+    done = 0
+    started = time.perf_counter()
+
+    def sample() -> None:
+        gc.collect()
+        current, _peak = tracemalloc.get_traced_memory()
+        tf_objects = _tf_object_counts()
+        samples.append({
+            "requests": done,
+            "rss_mb": round(_rss_bytes() / MB, 2),
+            "heap_mb": round(current / MB, 2),
+            "tf_objects": tf_objects["total"],
+            "tf_top": {k: v for k, v in tf_objects.items() if k != "total"},
+            "elapsed_seconds": round(time.perf_counter() - started, 1),
+        })
+        s = samples[-1]
+        print(f"requests={done} rss={s['rss_mb']}MB heap={s['heap_mb']}MB tf_objects={s['tf_objects']}", file=sys.stderr)
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://soak", timeout=120) as client:
+            tokens = []
+            for lane in range(args.concurrency):
+                r = await client.post("/api/v1/auth/intern/login", json={"student_id": f"soak-{lane}"})
+                r.raise_for_status()
+                tokens.append(r.json()["token"])
+
+            async def one(lane: int, n: int) -> None:
+                nonlocal failures
+                headers = {"X-Intern-Token": tokens[lane]}
+                files = {"xray": ("xray.jpg", images[n % len(images)], "image/jpeg")}
+                r = await client.post("/api/v1/process", files=files, headers=headers)
+                if r.status_code != 200:
+                    failures += 1
+                    return
+                temp_id = r.json()["temp_id"]
+                await client.get(f"/api/v1/records/{temp_id}/gradcam", params={"size": 128})
+                if args.save_every and n % args.save_every == 0:
+                    r = await client.post("/api/v1/records", json={"temp_id": temp_id, "notes": "soak"}, headers=headers)
+                    if r.status_code == 201:
+                        await client.delete(f"/api/v1/records/{r.json()['case_id']}", headers={"X-RFZO": settings.ADMIN_RFZO})
+                else:
+                    await client.delete(f"/api/v1/process/{temp_id}", headers=headers)
+
+            tracemalloc.start()
+            sample()
+            while done < args.requests:
+                lanes = min(args.concurrency, args.requests - done)
+                await asyncio.gather(*(one(lane, done + lane) for lane in range(lanes)))
+                before = done
+                done += lanes
+                if done // args.sample_every != before // args.sample_every or done == args.requests:
+                    sample()
+            tracemalloc_top = [
+                str(stat) for stat in tracemalloc.take_snapshot().statistics("lineno")[:10]
+            ]
+            tracemalloc.stop()
+
+    await redis.flushdb()  # the database was empty (or flushed) when we started
+    await redis.aclose()
+
+    steady = [s for s in samples if s["requests"] >= args.warmup]
+    xs = [s["requests"] for s in steady]
+    growth = {
+        "rss_mb_per_1k": round(_slope_per_1k(xs, [s["rss_mb"] for s in steady]), 3),
+        "heap_mb_per_1k": round(_slope_per_1k(xs, [s["heap_mb"] for s in steady]), 3),
+        "tf_objects_per_1k": round(_slope_per_1k(xs, [s["tf_objects"] for s in steady]), 1),
+    }
+    limits = {
+        "rss_mb_per_1k": args.max_rss_mb_per_1k,
+        "heap_mb_per_1k": args.max_heap_mb_per_1k,
+        "tf_objects_per_1k": args.max_tf_objects_per_1k,
+    }
+    exceeded = [k for k, v in growth.items() if v > limits[k]]
+    report = {
+        "requests": done,
+        "failed_requests": failures,
+        "warmup": args.warmup,
+        "growth": growth,
+        "limits": limits,
+        "exceeded": exceeded,
+        "requests_per_second": round(done / (time.perf_counter() - started), 2),
+        "samples": samples,
+        "tracemalloc_top": tracemalloc_top,
+    }
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps({k: v for k, v in report.items() if k not in ("samples", "tracemalloc_top")}, indent=2))
+    if exceeded:
+        print("memory growth over the limit: " + ", ".join(exceeded), file=sys.stderr)
+        print("\n".join(tracemalloc_top), file=sys.stderr)
+    return 1 if exceeded or failures else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.cli.soak")
+    parser.add_argument("--requests", type=int, default=3000)
+    parser.add_argument("--warmup", type=int, default=300, help="requests left out of the growth fit (caches, allocator)")
+    parser.add_argument("--sample-every", type=int, default=100)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--flush", action="store_true", help="FLUSHDB the soak database first")
+    parser.add_argument("--image-size", type=int, default=settings.IMAGE_SIZE)
+    parser.add_argument("--concurrency", type=int, default=1, help="interns sending requests at once")
+    parser.add_argument("--save-every", type=int, default=10, help="save (then delete) every Nth result instead of cancelling it; 0 = never")
+    parser.add_argument("--distinct-images", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-rss-mb-per-1k", type=float, default=10.0)
+    parser.add_argument("--max-heap-mb-per-1k", type=float, default=2.0)
+    parser.add_argument("--max-tf-objects-per-1k", type=float, default=50.0)
+    parser.add_argument("--report", metavar="PATH", help="write all samples and the tracemalloc top as JSON")
+    args = parser.parse_args(argv)
+    return asyncio.run(_soak(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,6 +8,16 @@ class Settings(BaseSettings):
 
     # Redis
     REDIS_URL: str = "redis://localhost:6379/0"
+    REDIS_MAX_CONNECTIONS: int = 32  # per process, shared by requests and background jobs
+    REDIS_POOL_TIMEOUT_SECONDS: float = 5.0  # wait for a free pooled connection before erroring
+    REDIS_SOCKET_TIMEOUT_SECONDS: float = 10.0
+    REDIS_CONNECT_TIMEOUT_SECONDS: float = 5.0
+    REDIS_HEALTH_CHECK_INTERVAL_SECONDS: int = 30  # PING idle connections before reuse
+    REDIS_CLUSTER: bool = False  # REDIS_URL points at a Redis Cluster node
+    REDIS_KEY_BUCKETS: int = 16  # hash-tag buckets for records and their indexes; change only via migrate-keys
+    REDIS_REPLICA_URLS: list[str] = []  # read replicas for record/image reads and listings (standalone mode only)
+    REDIS_REPLICA_CHECK_INTERVAL_SECONDS: float = 2.0  # a replica must keep up within one interval to serve reads
+    REDIS_READ_YOUR_WRITES_SECONDS: int = 10  # after a save/delete, reads touching it go to the primary
 
     # Admin auth (simple shared secret)
     ADMIN_RFZO: str = "321200918843"
@@ -15,10 +25,62 @@ class Settings(BaseSettings):
     SESSION_TTL_SECONDS: int = 12 * 60 * 60  # 12 hours
 
     MODEL_PATH: str = "effnet_model\model.keras" #type:ignore
+    MODEL_VERSION: str = "v1"  # version name for MODEL_PATH in the model registry
+    MODEL_WARMUP: bool = True  # run dummy predict + gradcam before a version takes traffic
+    MODEL_SYNC_INTERVAL_SECONDS: int = 15  # how often workers pick up a version activated elsewhere
     IMAGE_SIZE: int = 512
     ENCODER_LAST_CONV_LAYER: str = "top_activation"
     GRADCAM_ALPHA: float = 0.4
 
+    # Admission control for /process (per worker, except the per-intern limit)
+    PROCESS_MAX_CONCURRENCY: int = 2  # inferences running at once
+    PROCESS_MAX_QUEUE: int = 8  # requests waiting for a slot before 503
+    PROCESS_QUEUE_TIMEOUT_SECONDS: float = 15.0  # max wait for a slot (latency budget)
+    PROCESS_MAX_INFLIGHT_PER_INTERN: int = 1  # across all workers, before 429
+    PROCESS_INFLIGHT_TTL_SECONDS: int = 120
+
+    # Test-time augmentation (all views run as one batch; see build_tta_batch)
+    TTA_ENABLED: bool = False
+    TTA_VIEWS: list[str] = ["identity", "hflip", "shift:0.04,0", "shift:-0.04,0", "scale:0.92", "scale:1.08"]
+
+    # Preview thumbnails generated at ingest (GET .../xray?size=128)
+    THUMBNAIL_SIZES: list[int] = [128, 256]
+    THUMBNAIL_FORMAT: str = "webp"  # "webp" or "jpg"
+    THUMBNAIL_QUALITY: int = 80
+
+    # Image storage quotas in bytes, checked when a record is saved (0 = unlimited)
+    STORAGE_QUOTA_PER_INTERN_BYTES: int = 0
+    STORAGE_QUOTA_TOTAL_BYTES: int = 0
+
+    # Per-worker LRU cache of promoted record metadata (0 disables)
+    RECORD_CACHE_SIZE: int = 4096
+    # Records per pipelined read when streaming list responses (GET /records and friends)
+    RECORD_LIST_PAGE_SIZE: int = 500
+    # Write record hashes with short field codes (see storage/record_codec.py).
+    # Turn on once every worker reads both formats; convert existing records
+    # with `python -m app.cli.records encode-records`
+    RECORD_COMPACT_ENCODING: bool = False
+
+    # Similar-case retrieval (GET /records/{case_id}/similar), in-memory per worker
+    SIMILARITY_ENABLED: bool = True
+    SIMILARITY_IVF_LISTS: int = 64  # k-means partitions once there are 50x as many records (0 = always exact)
+    SIMILARITY_IVF_PROBES: int = 8  # partitions scanned per query (more = closer to exact, slower)
+
+    # Background jobs / bulk operations
+    JOB_TTL_SECONDS: int = 7 * 24 * 60 * 60  # 7 days
+    IMPORT_BATCH_SIZE: int = 500
+    IMPORT_SPOOL_DIR: str = ""  # HTTP uploads are kept here until their import completes (empty = system temp dir)
+    PURGE_BATCH_SIZE: int = 200
+    ROSTER_MAX_ROWS: int = 5000  # POST /interns/bulk
+    INFER_BATCH_SIZE: int = 32  # offline batch inference (python -m app.cli.infer)
+    REINFER_BATCH_SIZE: int = 16  # stored records per model call when re-running them on a new version
+    REINFER_PAUSE_SECONDS: float = 0.1  # between re-inference batches, on top of waiting for live /process traffic
+
+    # Index consistency sweeper (0 disables the periodic run; admin trigger still works)
+    SWEEP_INTERVAL_SECONDS: int = 6 * 60 * 60
+    SWEEP_BATCH_SIZE: int = 100
+    SWEEP_PAUSE_SECONDS: float = 0.05  # between batches, keeps live latency unaffected
+    SWEEP_GRACE_SECONDS: int = 15 * 60  # never touch keys younger than this
 
     model_config = SettingsConfigDict(
         env_file=".env",
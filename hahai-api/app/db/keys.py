@@ -1,25 +1,168 @@
 import secrets
+import uuid
+import zlib
+
+from app.config import settings
+
+# Cluster-ready layout. Redis Cluster only runs multi-key commands (RENAME,
+# ZINTERSTORE, MULTI/EXEC) on keys in one hash slot, and only the part of a
+# key inside {...} is hashed. So:
+#
+#   - every record lives in one of KEY_BUCKETS buckets (crc32 of its
+#     case_id), and its hash, blobs AND its entries in the bucket's indexes,
+#     notes postings and aggregates all carry the bucket tag {b}:
+#       record:{b}:{case_id}[:xray|:gradcam|:{kind}:{size}|:embedding]
+#       records:{b}  records:{b}:by:{field}  records:{b}:label:{label}
+#       records:{b}:intern:{student_id}  notes:{b}:term:{term}  stats:{b}:{name}
+#     so a record's writes stay one MULTI, and a global query is one
+#     ZINTERSTORE per bucket merged client-side;
+#   - an intern's keys are tagged with the student_id: intern:{id}[:sessions|:inflight|:wrote].
+#
+# KEY_BUCKETS is fixed for the lifetime of the data; changing it (or moving
+# from the untagged layout) goes through `python -m app.cli.records migrate-keys`.
+
+KEY_BUCKETS = settings.REDIS_KEY_BUCKETS
 
 ALL_INTERNS_KEY = "interns"
-ALL_RECORDS_KEY = "records"
+
+STATS_TOTALS = "totals"
+STATS_INTERNS = "interns"
+STATS_CONFIDENCE = "confidence"
+STATS_DAILY = "daily"
+STORAGE_TOTALS = "storage"
+STORAGE_INTERNS = "storage:interns"
+
+MODELS_ACTIVE_KEY = "models:active"
+
+# pub/sub channels: case_ids of removed records (per-worker metadata caches,
+# similarity index) and of newly saved records with an embedding
+RECORD_INVALIDATION_CHANNEL = "records:invalidated"
+RECORD_EMBEDDED_CHANNEL = "records:embedded"
+
+def record_bucket(case_id: str) -> int:
+    return zlib.crc32(case_id.encode()) % KEY_BUCKETS
+
+def all_buckets() -> range:
+    return range(KEY_BUCKETS)
 
 def make_temp_id() -> str:
     return "temp-" + secrets.token_hex(16)
 
+def make_case_id(bucket: int | None = None) -> str:
+    """
+    A new uuid4 case_id; with `bucket`, one that hashes into that bucket
+    (KEY_BUCKETS tries on average), so a temp record can be RENAMEd to it.
+    """
+    while True:
+        case_id = str(uuid.uuid4())
+        if bucket is None or record_bucket(case_id) == bucket:
+            return case_id
+
 def intern_key(student_id: str) -> str:
-    return f"intern:{student_id}"
+    return f"intern:{{{student_id}}}"
 
-def intern_records_key(student_id: str) -> str:
-    return f"intern:{student_id}:records"
+def intern_records_key(student_id: str, bucket: int) -> str:
+    # the intern's case_ids that fall into `bucket`
+    return f"records:{{{bucket}}}:intern:{student_id}"
+
+INTERN_RECORDS_KEY_PATTERN = "records:{*}:intern:*"
 
 def record_key(case_id: str) -> str:
-    return f"record:{case_id}"
+    return f"record:{{{record_bucket(case_id)}}}:{case_id}"
 
 def record_xray_key(case_id: str) -> str:
-    return f"record:{case_id}:xray"
+    return f"{record_key(case_id)}:xray"
 
 def record_gradcam_key(case_id: str) -> str:
-    return f"record:{case_id}:gradcam"
+    return f"{record_key(case_id)}:gradcam"
+
+def record_thumb_key(case_id: str, kind: str, size: int) -> str:
+    # kind: "xray" | "gradcam"
+    return f"{record_key(case_id)}:{kind}:{size}"
+
+def record_embedding_key(case_id: str) -> str:
+    return f"{record_key(case_id)}:embedding"
+
+def record_image_keys(case_id: str, thumb_sizes: list[int] | tuple[int, ...] = ()) -> list[str]:
+    keys = [record_xray_key(case_id), record_gradcam_key(case_id)]
+    for size in thumb_sizes:
+        keys.append(record_thumb_key(case_id, "xray", size))
+        keys.append(record_thumb_key(case_id, "gradcam", size))
+    return keys
+
+def record_blob_keys(case_id: str, thumb_sizes: list[int] | tuple[int, ...] = ()) -> list[str]:
+    """Every non-hash key of a record: images plus the embedding."""
+    return record_image_keys(case_id, thumb_sizes) + [record_embedding_key(case_id)]
+
+RECORD_KEY_PATTERN = "record:{*}:*"
+
+def _parse_record_suffix(rest: str) -> tuple[str, str]:
+    parts = rest.split(":")
+    if len(parts) >= 3 and parts[-2] in ("xray", "gradcam") and parts[-1].isdigit():
+        return ":".join(parts[:-2]), f"{parts[-2]}:{parts[-1]}"
+    if len(parts) >= 2 and parts[-1] in ("xray", "gradcam", "embedding"):
+        return ":".join(parts[:-1]), parts[-1]
+    return ":".join(parts), "meta"
+
+def parse_record_key(key: str) -> tuple[str, str]:
+    """
+    Inverse of the record_* key builders: returns (case_id, kind) where kind
+    is "meta", "xray", "gradcam", "embedding" or a thumbnail like "xray:128".
+    """
+    return _parse_record_suffix(key.split("}:", 1)[1])
+
+def parse_legacy_record_key(key: str) -> tuple[str, str]:
+    """parse_record_key for the untagged record:{case_id}... layout."""
+    return _parse_record_suffix(key[len("record:"):])
+
+def records_key(bucket: int) -> str:
+    return f"records:{{{bucket}}}"
+
+def records_by_key(field: str, bucket: int) -> str:
+    return f"records:{{{bucket}}}:by:{field}"
+
+def records_label_key(pred_label: str, bucket: int) -> str:
+    return f"records:{{{bucket}}}:label:{pred_label}"
+
+def notes_term_key(term: str, bucket: int) -> str:
+    return f"notes:{{{bucket}}}:term:{term}"
+
+def stats_key(name: str, bucket: int) -> str:
+    return f"stats:{{{bucket}}}:{name}"
+
+def query_tmp_key(token: str, bucket: int) -> str:
+    return f"tmp:query:{{{bucket}}}:{token}"
 
 def intern_session_key(token: str) -> str:
-    return f"session:intern:{token}"
\ No newline at end of file
+    return f"session:intern:{token}"
+
+def intern_sessions_key(student_id: str) -> str:
+    return f"intern:{{{student_id}}}:sessions"
+
+def intern_inflight_key(student_id: str) -> str:
+    return f"intern:{{{student_id}}}:inflight"
+
+def intern_wrote_key(student_id: str) -> str:
+    # set for REDIS_READ_YOUR_WRITES_SECONDS after the intern saves a record
+    return f"intern:{{{student_id}}}:wrote"
+
+# version counters behind the list endpoints' ETags (see storage/versions.py);
+# single keys, bumped after the writes' MULTI commits
+RECORDS_VERSION_KEY = "version:records"
+INTERNS_VERSION_KEY = "version:interns"
+
+def intern_records_version_key(student_id: str) -> str:
+    return f"version:records:intern:{student_id}"
+
+def job_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+def job_items_key(job_id: str, bucket: int) -> str:
+    # items a resumable job has already finished, next to the records they produced
+    return f"job:{job_id}:items:{{{bucket}}}"
+
+def lock_key(name: str) -> str:
+    return f"lock:{name}"
+
+# image blobs the sweeper found without metadata -> first seen (unix seconds)
+SWEEP_ORPHANS_KEY = "sweeper:orphans"
@@ -1,13 +1,190 @@
+import asyncio
+import itertools
+import logging
+
 import redis.asyncio as redis_async
 from redis.asyncio.client import Redis
+from redis.asyncio.cluster import RedisCluster
+from redis.client import NEVER_DECODE
+from redis.exceptions import RedisError
 
-async def create_redis_text(redis_url: str) -> Redis:
-    r = redis_async.from_url(redis_url, decode_responses=True)
-    await r.ping() #type:ignore
-    return r
+from app.config import settings
+
+# One pooled client per process. It decodes replies to str (hash fields,
+# set members, ids); image blobs are read with NEVER_DECODE instead of going
+# through a second bytes-mode client, so metadata and blobs can be written
+# together in one MULTI on the same connection. Writing bytes works on any
+# client, only replies are decoded.
+#
+# With REDIS_CLUSTER the same code runs against a RedisCluster client: the
+# key layout (see keys.py) keeps every MULTI and multi-key command inside one
+# hash slot, and non-transactional pipelines are split per node by redis-py.
+# Pub/sub messages are published outside MULTI, since PUBLISH has no key to
+# route a cluster transaction by.
+#
+# REDIS_REPLICA_URLS adds read-only clients for the heavy reads (record and
+# image GETs, listings, search, export); see ReadReplicas. Everything else,
+# and every write, stays on the primary.
 
+logger = logging.getLogger(__name__)
 
-async def create_redis_binary(redis_url: str) -> Redis:
-    r = redis_async.from_url(redis_url, decode_responses=False)
+
+async def create_redis(redis_url: str, *, cluster: bool | None = None) -> Redis:
+    """
+    Blocking pool: when all REDIS_MAX_CONNECTIONS are checked out, callers
+    wait up to REDIS_POOL_TIMEOUT_SECONDS for one instead of failing at once.
+    In cluster mode REDIS_MAX_CONNECTIONS is per node and a caller that
+    finds a node's pool empty fails right away (redis-py has no blocking
+    pool for clusters). `cluster` defaults to REDIS_CLUSTER.
+    """
+    if settings.REDIS_CLUSTER if cluster is None else cluster:
+        return await create_redis_cluster(redis_url)
+
+    pool = redis_async.BlockingConnectionPool.from_url(
+        redis_url,
+        decode_responses=True,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT_SECONDS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT_SECONDS,
+        socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT_SECONDS,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL_SECONDS,
+    )
+    r = Redis.from_pool(pool)
     await r.ping() #type:ignore
     return r
+
+
+async def create_redis_cluster(redis_url: str) -> Redis:
+    """Cluster client; `redis_url` is any one node, the rest are discovered."""
+    r = RedisCluster.from_url(
+        redis_url,
+        decode_responses=True,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT_SECONDS,
+        socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT_SECONDS,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL_SECONDS,
+    )
+    await r.initialize()
+    return r #type:ignore
+
+
+def is_cluster(redis: Redis) -> bool:
+    return isinstance(redis, RedisCluster)
+
+
+async def create_replica_redis(redis_url: str) -> Redis:
+    """
+    Client for one read replica. Not pinged: an unreachable replica just
+    stays out of rotation until a health check finds it up.
+    """
+    pool = redis_async.BlockingConnectionPool.from_url(
+        redis_url,
+        decode_responses=True,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        timeout=settings.REDIS_POOL_TIMEOUT_SECONDS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT_SECONDS,
+        socket_connect_timeout=settings.REDIS_CONNECT_TIMEOUT_SECONDS,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL_SECONDS,
+    )
+    return Redis.from_pool(pool)
+
+
+class ReadReplicas:
+    """
+    Picks the client for a read: the next healthy replica (round robin), or
+    the primary when none is configured or healthy.
+
+    A replica is healthy when it answers, its link to the primary is up and
+    it has replicated at least the primary's offset from the previous check,
+    i.e. it lags less than one check interval. Replicas are eventually
+    consistent, so callers still send reads that must see a write made
+    moments ago to the primary (see records.get_record's `primary` and
+    require_intern).
+    """
+
+    def __init__(self, primary: Redis, replicas: dict[str, Redis] | None = None):
+        self.primary = primary
+        self.replicas = replicas or {}
+        self.healthy: list[str] = []
+        self.failovers = 0  # times the last healthy replica dropped out
+        self._next = itertools.count()
+        self._primary_offset: int | None = None
+
+    def reader(self) -> Redis:
+        healthy = self.healthy
+        if not healthy:
+            return self.primary
+        return self.replicas[healthy[next(self._next) % len(healthy)]]
+
+    async def _replica_ok(self, client: Redis, min_offset: int | None, timeout: float) -> bool:
+        try:
+            info = await asyncio.wait_for(client.info("replication"), timeout)
+        except (RedisError, OSError, asyncio.TimeoutError):
+            return False
+        if info.get("role") != "slave" or info.get("master_link_status") != "up":
+            return False
+        return min_offset is None or int(info.get("slave_repl_offset", -1)) >= min_offset
+
+    async def check(self, *, timeout: float = 1.0) -> list[str]:
+        """Re-evaluates every replica; returns the healthy URLs."""
+        if not self.replicas:
+            return []
+        try:
+            offset = int((await self.primary.info("replication")).get("master_repl_offset", 0))
+        except (RedisError, OSError):
+            logger.warning("Replica check: primary unreachable, keeping the current rotation")
+            return self.healthy
+
+        results = await asyncio.gather(*(
+            self._replica_ok(client, self._primary_offset, timeout) for client in self.replicas.values()
+        ))
+        healthy = [url for url, ok in zip(self.replicas, results) if ok]
+        for url in set(self.healthy) - set(healthy):
+            logger.warning("Read replica %s out of rotation", url)
+        for url in set(healthy) - set(self.healthy):
+            logger.info("Read replica %s in rotation", url)
+        if self.healthy and not healthy:
+            self.failovers += 1
+            logger.warning("No healthy read replica, reading from the primary")
+
+        self.healthy = healthy
+        self._primary_offset = offset
+        return healthy
+
+    def snapshot(self) -> dict:
+        return {
+            "replicas": list(self.replicas),
+            "healthy": list(self.healthy),
+            "reading_from": "replicas" if self.healthy else "primary",
+            "failovers": self.failovers,
+        }
+
+    async def aclose(self) -> None:
+        for client in self.replicas.values():
+            await client.aclose()
+
+
+async def create_read_replicas(primary: Redis, urls: list[str]) -> ReadReplicas:
+    replicas = ReadReplicas(primary, {url: await create_replica_redis(url) for url in urls})
+    await replicas.check()
+    return replicas
+
+
+async def run_replica_health_checks(replicas: ReadReplicas, *, interval_seconds: float) -> None:
+    """Lifespan background loop: moves replicas in and out of rotation."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await replicas.check(timeout=min(1.0, interval_seconds))
+        except Exception:
+            logger.exception("Replica health check failed")
+
+
+async def get_bytes(redis: Redis, key: str) -> bytes | None:
+    """GET without decoding, for binary values on the decoding client."""
+    return await redis.execute_command("GET", key, **{NEVER_DECODE: True})
+
+
+def queue_get_bytes(pipe, key: str) -> None:
+    """Pipeline GET without decoding (non-transactional pipelines only)."""
+    pipe.execute_command("GET", key, **{NEVER_DECODE: True})
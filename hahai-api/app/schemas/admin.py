@@ -0,0 +1,16 @@
+from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+
+class PurgeRequest(BaseModel):
+    student_ids: list[str] = Field(default_factory=list)
+    student_id_prefix: str | None = Field(default=None, min_length=1, description="Select a whole cohort by student_id prefix.")
+    created_from: datetime | None = None
+    created_to: datetime | None = None
+
+
+class ModelDeployRequest(BaseModel):
+    version: str = Field(min_length=1, max_length=64, pattern=r"^[A-Za-z0-9._-]+$")
+    path: str = Field(min_length=1, description="Model file (.keras) readable by every API worker.")
+    activate: bool = Field(default=True, description="Switch traffic to this version once it is warm.")
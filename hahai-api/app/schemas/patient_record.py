@@ -13,11 +13,16 @@ class PatientRecordOut(BaseModel):
 
     pred_label: str
     pred_accuracy: float = Field(ge=0.0, le=100.0)
+    model_version: str = Field(default="", description="Model version that produced the prediction.")
 
     # URLs that the frontend can use in <img src="...">
     xray_url: str
     gradcam_url: str
 
+class SimilarRecordOut(PatientRecordOut):
+    similarity: float = Field(description="Cosine similarity of the image embeddings, -1..1.")
+
+
 class PatientRecordSaveIn(BaseModel):
     temp_id: str
     notes: str = ""
@@ -5,27 +5,88 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from app.api.v1.router import router as v1_router
 from app.config import settings
-from app.db.redis import create_redis_text, create_redis_binary
-from app.services.ml.model import load_keras_model
+from app.db.redis import ReadReplicas, create_read_replicas, create_redis, run_replica_health_checks
+from app.services.admission import InferenceGate
+from app.services.stages import StageMetrics
+from app.services.jobs import cancel_background_jobs, run_in_background
+from app.services.storage.record_cache import RecordCache, run_invalidation_listener
+from app.services.storage.sweeper import run_periodic_sweeps
+from app.services.ml.preprocessing import parse_tta_views
+from app.services.ml.registry import ModelRegistry, get_desired_model, load_options, run_model_sync
+from app.services.ml.similarity import SimilarityIndex, run_similarity_sync
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    app.state.redis = await create_redis_text(settings.REDIS_URL) # metadata
-    app.state.redis_bin = await create_redis_binary(settings.REDIS_URL) # images
+    parse_tta_views(settings.TTA_VIEWS)  # a bad spec fails here, not on every TTA /process call
+    app.state.redis = await create_redis(settings.REDIS_URL) # one pool for metadata and images
 
-    app.state.model = load_keras_model(settings.MODEL_PATH)
+    # heavy reads go to healthy replicas; without any, everything reads the primary
+    if settings.REDIS_REPLICA_URLS and not settings.REDIS_CLUSTER:
+        app.state.replicas = await create_read_replicas(app.state.redis, settings.REDIS_REPLICA_URLS)
+        run_in_background(run_replica_health_checks(
+            app.state.replicas, interval_seconds=settings.REDIS_REPLICA_CHECK_INTERVAL_SECONDS,
+        ))
+    else:
+        app.state.replicas = ReadReplicas(app.state.redis)
+
+    # Serve the version last activated via /admin/models, falling back to MODEL_PATH
+    app.state.models = ModelRegistry()
+    desired = await get_desired_model(app.state.redis)
+    version = desired.get("version") or settings.MODEL_VERSION
+    path = desired.get("path") or settings.MODEL_PATH
+    try:
+        await app.state.models.load(version, path, **load_options())
+    except Exception:
+        if (version, path) == (settings.MODEL_VERSION, settings.MODEL_PATH):
+            raise
+        version, path = settings.MODEL_VERSION, settings.MODEL_PATH
+        await app.state.models.load(version, path, **load_options())
+    app.state.models.activate(version)
+
+    app.state.inference_gate = InferenceGate(
+        concurrency=settings.PROCESS_MAX_CONCURRENCY,
+        max_queue=settings.PROCESS_MAX_QUEUE,
+        queue_timeout=settings.PROCESS_QUEUE_TIMEOUT_SECONDS,
+    )
+    app.state.stage_metrics = StageMetrics()
+
+    app.state.record_cache = RecordCache(
+        settings.RECORD_CACHE_SIZE,
+        hold_seconds=settings.REDIS_READ_YOUR_WRITES_SECONDS if app.state.replicas.replicas else 0,
+    )
+    if settings.RECORD_CACHE_SIZE > 0 or app.state.replicas.replicas:
+        run_in_background(run_invalidation_listener(app.state.record_cache, app.state.redis))
+
+    # built in the background; /similar answers 503 until it is ready
+    app.state.similarity_index = SimilarityIndex(
+        ivf_lists=settings.SIMILARITY_IVF_LISTS,
+        probes=settings.SIMILARITY_IVF_PROBES,
+    )
+    if settings.SIMILARITY_ENABLED:
+        run_in_background(run_similarity_sync(app.state.similarity_index, app.state.redis))
+
+    if settings.MODEL_SYNC_INTERVAL_SECONDS > 0:
+        run_in_background(run_model_sync(
+            app.state.models, app.state.redis, interval_seconds=settings.MODEL_SYNC_INTERVAL_SECONDS,
+        ))
+
+    if settings.SWEEP_INTERVAL_SECONDS > 0:
+        run_in_background(run_periodic_sweeps(app.state.redis, interval_seconds=settings.SWEEP_INTERVAL_SECONDS))
 
     yield
 
     # Shutdown
+    await cancel_background_jobs()
+
+    replicas = getattr(app.state, "replicas", None)
+    if replicas is not None:
+        await replicas.aclose()
+
     redis = getattr(app.state, "redis", None)
     if redis is not None:
         await redis.aclose()
-    redis_bin = getattr(app.state, "redis_bin", None)
-    if redis_bin is not None:
-        await redis_bin.aclose()
 
 
 app = FastAPI(title=settings.PROJECT_NAME, lifespan=lifespan)
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable
+
+from redis.asyncio.client import Redis
+
+from app.db.keys import intern_inflight_key
+from app.services.stages import ClientDisconnectedError
+
+# Admission control for inference. Two layers:
+#   - per intern: in-flight count in intern:{id}:inflight, shared by all
+#     workers, so one intern can't hold several slots with retries/tabs (429)
+#   - per worker: InferenceGate, a bounded queue in front of at most
+#     `concurrency` running inferences. A full queue, or a queue wait longer
+#     than the latency budget, is rejected right away (503) instead of
+#     letting every request slow down until it times out.
+# Both rejections carry a Retry-After estimate. Queued requests whose client
+# went away are dropped before they ever take a slot.
+
+DISCONNECT_POLL_SECONDS = 0.25
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, message: str, *, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class InternBusyError(AdmissionRejectedError):
+    pass
+
+
+class InferenceSaturatedError(AdmissionRejectedError):
+    pass
+
+
+class InferenceGate:
+    def __init__(self, *, concurrency: int, max_queue: int, queue_timeout: float):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._sem = asyncio.Semaphore(self.concurrency)
+        self._running = 0
+        self._waiting = 0
+        self._service_seconds: float | None = None  # EWMA of slot hold time
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def busy(self) -> bool:
+        """Live requests running or queued on this worker."""
+        return self._running > 0 or self._waiting > 0
+
+    def retry_after(self) -> int:
+        per_request = self._service_seconds or 1.0
+        return max(1, math.ceil(per_request * (self._waiting + 1) / self.concurrency))
+
+    def snapshot(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "running": self._running,
+            "waiting": self._waiting,
+            "avg_service_seconds": round(self._service_seconds or 0.0, 3),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+    def _reject(self, message: str) -> InferenceSaturatedError:
+        self.rejected += 1
+        return InferenceSaturatedError(message, retry_after=self.retry_after())
+
+    async def _wait_for_slot(self, is_disconnected: Callable[[], Awaitable[bool]] | None) -> None:
+        # One acquire() task for the whole wait keeps our place in the FIFO
+        # while we poll for client disconnects.
+        acquire = asyncio.ensure_future(self._sem.acquire())
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._reject("Timed out waiting for an inference slot")
+                done, _ = await asyncio.wait({acquire}, timeout=min(remaining, DISCONNECT_POLL_SECONDS))
+                if done:
+                    return
+                if is_disconnected is not None and await is_disconnected():
+                    raise ClientDisconnectedError("Client disconnected while queued", stage="queue")
+        except BaseException:
+            if not acquire.cancel() and not acquire.cancelled() and acquire.exception() is None:
+                self._sem.release()  # acquired just as we gave up
+            raise
+
+    @asynccontextmanager
+    async def slot(self, is_disconnected: Callable[[], Awaitable[bool]] | None = None) -> AsyncIterator[None]:
+        if self._sem.locked() and self._waiting >= self.max_queue:
+            raise self._reject("Inference queue is full")
+
+        self._waiting += 1
+        try:
+            await self._wait_for_slot(is_disconnected)
+        finally:
+            self._waiting -= 1
+
+        self.admitted += 1
+        self._running += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._running -= 1
+            self._sem.release()
+            held = time.perf_counter() - started
+            self._service_seconds = held if self._service_seconds is None else 0.8 * self._service_seconds + 0.2 * held
+
+
+async def acquire_intern_slot(redis: Redis, *, student_id: str, limit: int, ttl_seconds: int) -> None:
+    """
+    Raises InternBusyError if the intern already has `limit` inferences in flight.
+    The TTL only matters if a worker dies holding a slot.
+    """
+    key = intern_inflight_key(student_id)
+    pipe = redis.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, ttl_seconds)
+    n, _ = await pipe.execute()
+    if n > limit:
+        await redis.decr(key)
+        raise InternBusyError(f"{limit} inference request(s) already in progress", retry_after=1)
+
+
+async def release_intern_slot(redis: Redis, *, student_id: str) -> None:
+    key = intern_inflight_key(student_id)
+    if await redis.decr(key) < 0:
+        await redis.delete(key)  # slot outlived its TTL; don't let the count go negative
+
+
+@asynccontextmanager
+async def admit(
+    redis: Redis,
+    gate: InferenceGate,
+    *,
+    student_id: str,
+    per_intern_limit: int,
+    ttl_seconds: int,
+    is_disconnected: Callable[[], Awaitable[bool]] | None = None,
+) -> AsyncIterator[None]:
+    await acquire_intern_slot(redis, student_id=student_id, limit=per_intern_limit, ttl_seconds=ttl_seconds)
+    try:
+        async with gate.slot(is_disconnected):
+            yield
+    finally:
+        await release_intern_slot(redis, student_id=student_id)
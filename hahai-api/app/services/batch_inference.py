@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+import asyncio
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Callable
+
+import cv2 as cv
+import numpy as np
+import tensorflow as tf
+from redis.asyncio.client import Redis
+from redis.exceptions import WatchError
+
+from app.config import settings
+from app.db.keys import all_buckets, intern_key, job_items_key, make_case_id, record_bucket, record_key
+from app.db.redis import is_cluster
+from app.services import jobs
+from app.services.ml.gradcam import cached_grad_model, gradcam_batch
+from app.services.ml.model import label_from_p
+from app.services.ml.similarity import encode_embedding, publish_embeddings_added
+from app.services.ml.preprocessing import encode_overlay_outputs, preprocess_file
+from app.services.storage.images import queue_record_blobs
+from app.services.storage.record_codec import encode_record
+from app.services.storage.records import RecordNotFoundError, add_record_indexes, delete_record
+from app.services.storage.usage import blob_sizes
+from app.services.storage.versions import bump_record_versions
+
+# Offline batch inference for case libraries. Per batch of N images:
+#
+#   process pool   decode + square-resize + encode xray/thumbnails (next batch
+#                  is already being preprocessed while the model runs)
+#   model          one forward + backward pass gives predictions, Grad-CAM
+#                  and the similarity embeddings
+#   process pool   PNG-encode the overlays + gradcam thumbnails
+#   redis          one MULTI per key bucket for images, metadata, indexes and
+#                  the job's done-set, written while the next batch runs
+#
+# Files are tracked by path relative to the input directory in
+# job:{id}:items:{b}, next to the record they became, so a resumed job
+# skips exactly what was written.
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+STAGES = ("preprocess_wait", "model", "encode", "write_wait")
+MAX_REPORTED_ERRORS = 20
+WRITE_WATCH_RETRIES = 3
+
+
+class BatchInferenceError(Exception):
+    pass
+
+
+def find_images(root: str) -> list[str]:
+    """Image paths under `root`, relative to it, in a stable order."""
+    found = []
+    for dirpath, _dirnames, filenames in os.walk(root):
+        for name in filenames:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                found.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return sorted(found)
+
+
+def _thumb_opts() -> dict:
+    return dict(
+        sizes=settings.THUMBNAIL_SIZES,
+        output_format=settings.THUMBNAIL_FORMAT,
+        quality=settings.THUMBNAIL_QUALITY,
+    )
+
+
+async def _write_batch(
+    redis: Redis,
+    items: list[dict],
+    *,
+    job_id: str,
+    student_id: str,
+) -> int:
+    # One MULTI per key bucket: a record's images, metadata, indexes and its
+    # done-set entry land together, so an interrupted batch leaves nothing
+    # half-written. As in promote_temp_record, the intern hash is WATCHed so
+    # a purge that overlaps the run stops it instead of being undone by it;
+    # in cluster mode (no cross-slot WATCH) it is checked again after EXEC.
+    watch_intern = not is_cluster(redis)
+    by_bucket: dict[int, list[dict]] = defaultdict(list)
+    for it in items:
+        by_bucket[record_bucket(it["meta"]["case_id"])].append(it)
+
+    written: dict[int, list[dict]] = {}
+    for bucket, group in by_bucket.items():
+        for attempt in range(WRITE_WATCH_RETRIES):
+            async with redis.pipeline() as pipe:
+                if watch_intern:
+                    await pipe.watch(intern_key(student_id))
+                if not await (pipe if watch_intern else redis).exists(intern_key(student_id)):
+                    break
+                pipe.multi()
+                for it in group:
+                    meta = it["meta"]
+                    pipe.hset(record_key(meta["case_id"]), mapping=encode_record(meta))
+                    queue_record_blobs(
+                        pipe,
+                        case_id=meta["case_id"],
+                        xray=it["xray"],
+                        gradcam=it["gradcam"],
+                        xray_thumbs={s: it["xray_thumbs"][s] for s in it["thumb_sizes"]},
+                        gradcam_thumbs={s: it["gradcam_thumbs"][s] for s in it["thumb_sizes"]},
+                        embedding=it["embedding"],
+                    )
+                    add_record_indexes(pipe, meta)
+                pipe.sadd(job_items_key(job_id, bucket), *[it["path"] for it in group])
+                pipe.expire(job_items_key(job_id, bucket), settings.JOB_TTL_SECONDS)
+                try:
+                    await pipe.execute()
+                    written[bucket] = group
+                    break
+                except WatchError:
+                    continue  # the intern hash changed: checked again on the next attempt
+        else:
+            raise BatchInferenceError(f"Intern {student_id} kept changing during the run")
+        if bucket not in written:
+            break
+
+    if len(written) < len(by_bucket) or (not watch_intern and not await redis.exists(intern_key(student_id))):
+        # Purged part-way. With WATCH, buckets written before the purge are
+        # in its listing and already gone; in cluster mode they may have
+        # landed after it, so they are taken back here.
+        if not watch_intern and written:
+            pipe = redis.pipeline(transaction=False)
+            for bucket, group in written.items():
+                pipe.srem(job_items_key(job_id, bucket), *[it["path"] for it in group])
+            await pipe.execute()
+            for group in written.values():
+                for it in group:
+                    try:
+                        await delete_record(redis, case_id=it["meta"]["case_id"])
+                    except RecordNotFoundError:
+                        pass
+        raise BatchInferenceError(f"Intern {student_id} was deleted during the run")
+
+    await bump_record_versions(redis, [student_id])
+    await publish_embeddings_added(redis, *[it["meta"]["case_id"] for it in items])
+    return len(items)
+
+
+async def _done_items(redis: Redis, job_id: str) -> set[str]:
+    pipe = redis.pipeline(transaction=False)
+    for b in all_buckets():
+        pipe.smembers(job_items_key(job_id, b))
+    return set().union(*await pipe.execute())
+
+
+async def run_batch_inference(
+    redis: Redis,
+    *,
+    model: tf.keras.Model, # type:ignore
+    model_version: str,
+    root: str,
+    student_id: str,
+    job_id: str,
+    batch_size: int | None = None,
+    workers: int | None = None,
+    notes_from_filename: bool = False,
+    on_progress: Callable[[dict], None] | None = None,
+) -> dict:
+    """
+    Runs the whole directory (minus files already done in job:{job_id}:items:*)
+    and returns a summary with throughput and per-stage seconds.
+    """
+    batch_size = batch_size or settings.INFER_BATCH_SIZE
+    workers = workers or os.cpu_count() or 1
+
+    if not await redis.exists(intern_key(student_id)):
+        raise BatchInferenceError(f"Intern {student_id} not found")
+
+    files = find_images(root)
+    done = await _done_items(redis, job_id)
+    todo = [f for f in files if f not in done]
+    await jobs.update_job(redis, job_id, status="running", files_total=len(files), files_skipped_done=len(files) - len(todo))
+
+    grad_model = cached_grad_model(model, settings.ENCODER_LAST_CONV_LAYER)
+    thumb_opts = _thumb_opts()
+    loop = asyncio.get_running_loop()
+    stage_seconds = {s: 0.0 for s in STAGES}
+    totals = {"processed": 0, "failed": 0}
+    errors: list[dict] = []
+    started = time.perf_counter()
+
+    # spawn: pool processes must not inherit the parent's TensorFlow runtime;
+    # one OpenCV thread each since the pool itself provides the parallelism
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=cv.setNumThreads, initargs=(1,)) as pool:
+        pre = partial(preprocess_file, image_size=settings.IMAGE_SIZE, thumb_opts=thumb_opts)
+        enc = partial(encode_overlay_outputs, thumb_opts=thumb_opts)
+
+        def submit(chunk: list[str]) -> asyncio.Future:
+            futs = [loop.run_in_executor(pool, pre, os.path.join(root, rel)) for rel in chunk]
+            return asyncio.gather(*futs, return_exceptions=True)
+
+        chunks = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+        next_pre = submit(chunks[0]) if chunks else None
+        pending_write: asyncio.Task | None = None
+
+        async def finish_write() -> None:
+            # counts a batch only once its MULTIs have committed
+            nonlocal pending_write
+            if pending_write is None:
+                return
+            t0 = time.perf_counter()
+            written = await pending_write
+            pending_write = None
+            stage_seconds["write_wait"] += time.perf_counter() - t0
+            totals["processed"] += written
+            await jobs.update_job(redis, job_id, counters={"files_processed": written})
+
+        for n, chunk in enumerate(chunks):
+            t0 = time.perf_counter()
+            results = await next_pre
+            stage_seconds["preprocess_wait"] += time.perf_counter() - t0
+            if n + 1 < len(chunks):
+                next_pre = submit(chunks[n + 1])  # overlaps with the model below
+
+            ok = [(rel, r) for rel, r in zip(chunk, results) if not isinstance(r, BaseException)]
+            failed = len(chunk) - len(ok)
+            for rel, r in zip(chunk, results):
+                if isinstance(r, BaseException) and len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({"path": rel, "error": str(r)})
+
+            items: list[dict] = []
+            if ok:
+                t0 = time.perf_counter()
+                probs, overlays, embeddings = await asyncio.to_thread(
+                    gradcam_batch, grad_model,
+                    batch_x=np.stack([r["x"] for _, r in ok]),
+                    imgs_bgr=[r["img_bgr"] for _, r in ok],
+                    alpha=settings.GRADCAM_ALPHA,
+                )
+                stage_seconds["model"] += time.perf_counter() - t0
+
+                t0 = time.perf_counter()
+                encoded = await asyncio.gather(*[loop.run_in_executor(pool, enc, ov) for ov in overlays])
+                stage_seconds["encode"] += time.perf_counter() - t0
+
+                now = int(time.time())
+                for (rel, r), p, emb, (gradcam_png, gradcam_thumbs) in zip(ok, probs, embeddings, encoded):
+                    pred_label, pred_accuracy = label_from_p(float(p))
+                    thumb_sizes = sorted(set(r["xray_thumbs"]) & set(gradcam_thumbs))
+                    case_id = make_case_id()
+                    meta = {
+                        "case_id": case_id,
+                        "student_id": student_id,
+                        "notes": os.path.splitext(os.path.basename(rel))[0] if notes_from_filename else "",
+                        "pred_label": pred_label,
+                        "pred_accuracy": pred_accuracy,
+                        "created_at": now,
+                        "saved_at": now,
+                        "is_temp": "0",
+                        "xray_content_type": r["xray_content_type"],
+                        "gradcam_content_type": "image/png",
+                        "thumb_sizes": ",".join(str(s) for s in thumb_sizes),
+                        "thumb_content_type": r["thumb_content_type"],
+                        "model_version": model_version,
+                        **blob_sizes(
+                            xray=r["xray"],
+                            gradcam=gradcam_png,
+                            thumbs=[r["xray_thumbs"][s] for s in thumb_sizes] + [gradcam_thumbs[s] for s in thumb_sizes],
+                        ),
+                    }
+                    items.append({
+                        "path": rel,
+                        "meta": meta,
+                        "xray": r["xray"],
+                        "gradcam": gradcam_png,
+                        "thumb_sizes": thumb_sizes,
+                        "xray_thumbs": r["xray_thumbs"],
+                        "gradcam_thumbs": gradcam_thumbs,
+                        "embedding": encode_embedding(emb),
+                    })
+
+            await finish_write()
+            if items:
+                pending_write = asyncio.create_task(_write_batch(redis, items, job_id=job_id, student_id=student_id))
+
+            totals["failed"] += failed
+            await jobs.update_job(redis, job_id, counters={"files_failed": failed})
+            if on_progress is not None:
+                on_progress({**totals, "todo": len(todo), "elapsed": time.perf_counter() - started})
+
+        await finish_write()
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        "files_total": len(files),
+        "files_skipped_done": len(files) - len(todo),
+        "processed": totals["processed"],
+        "failed": totals["failed"],
+        "elapsed_seconds": round(elapsed, 2),
+        "images_per_second": round(totals["processed"] / elapsed, 2) if elapsed > 0 else 0.0,
+        "stage_seconds": {k: round(v, 2) for k, v in stage_seconds.items()},
+        "batch_size": batch_size,
+        "workers": workers,
+        "errors": errors,  # failed files are retried when the job is resumed
+    }
+    await jobs.update_job(redis, job_id, status="completed", images_per_second=str(summary["images_per_second"]))
+    return summary
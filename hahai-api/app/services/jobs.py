@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, Coroutine
+
+from redis.asyncio.client import Redis
+
+from app.config import settings
+from app.db.keys import job_key
+
+
+class JobNotFoundError(Exception):
+    pass
+
+
+# Strong references to running tasks; asyncio only keeps weak ones.
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def create_job(redis: Redis, *, kind: str, params: dict | None = None) -> str:
+    """
+    Registers a job under job:{job_id}. Progress lives in the same hash so
+    any worker (or the CLI) can report on it.
+    """
+    job_id = str(uuid.uuid4())
+    now = int(time.time())
+
+    pipe = redis.pipeline()
+    pipe.hset(job_key(job_id), mapping={
+        "job_id": job_id,
+        "kind": kind,
+        "status": "pending",
+        "params": json.dumps(params or {}),
+        "created_at": now,
+        "updated_at": now,
+    })
+    pipe.expire(job_key(job_id), settings.JOB_TTL_SECONDS)
+    await pipe.execute()
+    return job_id
+
+
+async def update_job(
+    redis: Redis,
+    job_id: str,
+    *,
+    status: str | None = None,
+    counters: dict[str, int] | None = None,
+    **fields: Any,
+) -> None:
+    key = job_key(job_id)
+    mapping: dict[str, Any] = {k: v for k, v in fields.items() if v is not None}
+    if status is not None:
+        mapping["status"] = status
+    mapping["updated_at"] = int(time.time())
+
+    pipe = redis.pipeline()
+    for name, amount in (counters or {}).items():
+        if amount:
+            pipe.hincrby(key, name, amount)
+    pipe.hset(key, mapping=mapping)
+    pipe.expire(key, settings.JOB_TTL_SECONDS)
+    await pipe.execute()
+
+
+async def get_job(redis: Redis, job_id: str) -> dict:
+    data = await redis.hgetall(job_key(job_id)) #type:ignore
+    if not data:
+        raise JobNotFoundError(f"Job {job_id} not found")
+
+    out: dict[str, Any] = {}
+    for k, v in data.items():
+        if k == "params":
+            out[k] = json.loads(v or "{}")
+        elif v.lstrip("-").isdigit():
+            out[k] = int(v)
+        else:
+            out[k] = v
+    return out
+
+
+def run_in_background(coro: Coroutine[Any, Any, Any]) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+async def cancel_background_jobs() -> None:
+    for task in list(_background_tasks):
+        task.cancel()
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
@@ -0,0 +1,52 @@
+from __future__ import annotations
+
+import secrets
+from typing import Callable
+
+from redis.asyncio.client import Redis
+from redis.exceptions import WatchError
+
+from app.db.keys import lock_key
+
+# Single-key locks for the cross-worker background jobs (sweeper,
+# re-inference): SET NX EX with a random token, refreshed by the holder
+# after every batch and deleted by the holder when it is done. Refresh and
+# release compare the token under WATCH, so a worker whose lock expired and
+# was taken over can neither extend nor delete the new holder's lock.
+
+
+class LockLostError(Exception):
+    pass
+
+
+async def acquire_lock(redis: Redis, name: str, *, ttl_seconds: int) -> str | None:
+    """The new lock's token, or None if someone else holds lock:{name}."""
+    token = secrets.token_hex(8)
+    if await redis.set(lock_key(name), token, nx=True, ex=ttl_seconds):
+        return token
+    return None
+
+
+async def _if_held(redis: Redis, name: str, token: str, apply: Callable) -> bool:
+    key = lock_key(name)
+    async with redis.pipeline() as pipe:
+        try:
+            await pipe.watch(key)
+            if await pipe.get(key) != token:
+                return False
+            pipe.multi()
+            apply(pipe, key)
+            await pipe.execute()
+            return True
+        except WatchError:
+            return False  # changed between GET and EXEC: expired and taken over
+
+
+async def refresh_lock(redis: Redis, name: str, token: str, *, ttl_seconds: int) -> None:
+    """Extends lock:{name} if `token` still holds it, else raises LockLostError."""
+    if not await _if_held(redis, name, token, lambda pipe, key: pipe.expire(key, ttl_seconds)):
+        raise LockLostError(f"lock:{name} expired and was taken over")
+
+
+async def release_lock(redis: Redis, name: str, token: str) -> bool:
+    return await _if_held(redis, name, token, lambda pipe, key: pipe.delete(key))
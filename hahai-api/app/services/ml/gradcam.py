@@ -1,9 +1,21 @@
 from __future__ import annotations
 
+import threading
+import weakref
+
 import cv2 as cv
 import numpy as np
 import tensorflow as tf
 
+from app.services.ml.preprocessing import encode_png
+
+# Grad models built per served model and target layer. Building one is a
+# functional-model construction (layer graph walk, new names registered),
+# far more than the Grad-CAM itself for small inputs, and per request it
+# was pure churn. Weak keys: an unloaded model version drops its entry.
+_grad_models: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_grad_models_lock = threading.Lock()
+
 
 def generate_gradcam(
     model: tf.keras.Model, # type:ignore
@@ -17,13 +29,57 @@ def generate_gradcam(
     Computes Grad-CAM for the model's single sigmoid output (unit 0),
     creates a COLORMAP_JET overlay on the provided image, returns PNG bytes.
     """
-    target_layer = model.get_layer(target_layer_name)
+    superimposed = gradcam_overlay(
+        model,
+        batch_x=batch_x,
+        img_bgr_512=img_bgr_512,
+        target_layer_name=target_layer_name,
+        alpha=alpha,
+    )
+    return encode_overlay_png(superimposed)
 
-    # Model that gives both conv maps and predictions
-    grad_model = tf.keras.Model( # type:ignore
-        inputs=model.inputs,
-        outputs=[target_layer.output, model.output],
+
+def encode_overlay_png(overlay: np.ndarray) -> bytes:
+    return encode_png(overlay)
+
+
+def gradcam_overlay(
+    model: tf.keras.Model, # type:ignore
+    *,
+    batch_x: np.ndarray,
+    img_bgr_512: np.ndarray,
+    target_layer_name: str,
+    alpha: float = 0.4,
+) -> np.ndarray:
+    """
+    Same as generate_gradcam but returns the (H,W,3) uint8 BGR overlay
+    unencoded, e.g. to derive thumbnails from it.
+    """
+    overlay, _embedding = gradcam_overlay_and_embedding(
+        model,
+        batch_x=batch_x,
+        img_bgr_512=img_bgr_512,
+        target_layer_name=target_layer_name,
+        alpha=alpha,
     )
+    return overlay
+
+
+def gradcam_overlay_and_embedding(
+    model: tf.keras.Model, # type:ignore
+    *,
+    batch_x: np.ndarray,
+    img_bgr_512: np.ndarray,
+    target_layer_name: str,
+    alpha: float = 0.4,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    gradcam_overlay plus the image embedding from the same forward pass:
+    the target layer's maps global-average-pooled, i.e. the features the
+    classifier head sees. Returns (overlay, embedding (c,) float32).
+    """
+    # Model that gives both conv maps and predictions
+    grad_model = cached_grad_model(model, target_layer_name)
 
     x = tf.convert_to_tensor(batch_x)
 
@@ -41,10 +97,13 @@ def generate_gradcam(
         raise ValueError("Gradients are None. Check target layer and model graph.")
 
     pooled_grads = tf.reduce_mean(grads, axis=(1, 2))  # (1,c)
+    embedding = tf.reduce_mean(conv_out, axis=(1, 2))[0].numpy().astype(np.float32)
+
+    return _overlay_from_maps(conv_out[0], pooled_grads[0], img_bgr_512, alpha), embedding
 
-    conv_out = conv_out[0]          # (h,w,c)
-    pooled = pooled_grads[0]        # (c,)
 
+def _overlay_from_maps(conv_out, pooled, img_bgr_512: np.ndarray, alpha: float) -> np.ndarray:
+    # conv_out: (h,w,c) conv maps, pooled: (c,) pooled gradients.
     # Weight conv maps by pooled grads
     heatmap = tf.reduce_sum(conv_out * pooled[tf.newaxis, tf.newaxis, :], axis=-1)  # (h,w)
 
@@ -70,8 +129,56 @@ def generate_gradcam(
 
     superimposed = (heatmap_color.astype(np.float32) * float(alpha) +
                     img_bgr_512.astype(np.float32)).clip(0, 255).astype(np.uint8)
+    return superimposed
+
+
+def build_grad_model(model: tf.keras.Model, target_layer_name: str) -> tf.keras.Model: # type:ignore
+    target_layer = model.get_layer(target_layer_name)
+    return tf.keras.Model( # type:ignore
+        inputs=model.inputs,
+        outputs=[target_layer.output, model.output],
+    )
+
+
+def cached_grad_model(model: tf.keras.Model, target_layer_name: str) -> tf.keras.Model: # type:ignore
+    """build_grad_model, built once per (model, layer) and reused."""
+    with _grad_models_lock:
+        per_layer = _grad_models.setdefault(model, {})
+        grad_model = per_layer.get(target_layer_name)
+        if grad_model is None:
+            grad_model = per_layer[target_layer_name] = build_grad_model(model, target_layer_name)
+    return grad_model
+
+
+def gradcam_batch(
+    grad_model: tf.keras.Model, # type:ignore
+    *,
+    batch_x: np.ndarray,              # (N,H,W,3) float32 RGB
+    imgs_bgr: list[np.ndarray],       # N x (H,W,3) uint8 BGR for the overlays
+    alpha: float = 0.4,
+) -> tuple[np.ndarray, list[np.ndarray], np.ndarray]:
+    """
+    Predictions, Grad-CAM overlays and embeddings for a whole batch from one
+    forward and one backward pass (see build_grad_model). In inference mode
+    every sample's score only depends on its own input, so the gradient of
+    the summed scores gives each sample its own gradients.
+    Returns: (p_positive (N,), overlays, embeddings (N,c) float32)
+    """
+    x = tf.convert_to_tensor(batch_x)
+
+    with tf.GradientTape() as tape:
+        conv_out, preds = grad_model(x, training=False)
+        score = preds[:, 0] if len(preds.shape) == 2 else preds
+        total = tf.reduce_sum(score)
+
+    grads = tape.gradient(total, conv_out)  # (N,h,w,c)
+    if grads is None:
+        raise ValueError("Gradients are None. Check target layer and model graph.")
 
-    ok, buf = cv.imencode(".png", superimposed)
-    if not ok:
-        raise ValueError("Failed to encode gradcam overlay as PNG")
-    return buf.tobytes()
\ No newline at end of file
+    pooled_grads = tf.reduce_mean(grads, axis=(1, 2))  # (N,c)
+    overlays = [
+        _overlay_from_maps(conv_out[i], pooled_grads[i], imgs_bgr[i], alpha)
+        for i in range(len(imgs_bgr))
+    ]
+    embeddings = tf.reduce_mean(conv_out, axis=(1, 2)).numpy().astype(np.float32)
+    return np.asarray(score, dtype=np.float64).reshape(-1), overlays, embeddings
@@ -1,6 +1,8 @@
 import tensorflow as tf
 import numpy as np
 
+from app.services.ml.preprocessing import build_tta_batch
+
 @tf.keras.utils.register_keras_serializable(package="preproc") # type:ignore
 def effb4_preprocess(x):
     return tf.keras.applications.efficientnet.preprocess_input(x) #type:ignore 
@@ -12,20 +14,56 @@ def load_keras_model(model_path: str) -> tf.keras.Model: # type:ignore
     return model
 
 
+def predict_scores(model: tf.keras.Model, batch_x: np.ndarray) -> np.ndarray: # type:ignore
+    """
+    Plain forward pass, (N,1) or (N,) sigmoid outputs. Used instead of
+    model.predict, which sets up a fresh predict function (and traces it)
+    on every call: slower for one-image batches, and the traced graphs
+    pile up over thousands of requests (see app/cli/soak.py).
+    """
+    return np.asarray(model(batch_x, training=False), dtype=np.float64)
+
+
 def predict_binary(model: tf.keras.Model, batch_x: np.ndarray) -> tuple[str, float, float]: # type:ignore
     """
     Returns: (pred_label, pred_accuracy_0_100, p_positive)
     Assumes sigmoid output in [0,1], shape (N,1) or (N,)
     """
-    y = model.predict(batch_x, verbose=1)
+    y = predict_scores(model, batch_x)
 
     # normalize output to scalar p
     p = float(y[0][0] if hasattr(y[0], "__len__") else y[0])
 
+    return label_from_p(p) + (p,)
+
+
+def predict_binary_tta(
+    model: tf.keras.Model, # type:ignore
+    batch_x: np.ndarray,
+    *,
+    views: list[str] | tuple[str, ...],
+) -> tuple[str, float, float, float]:
+    """
+    Test-time augmentation: all views of the (1,H,W,3) input are predicted in
+    a single batched model call and their probabilities averaged.
+    Returns: (pred_label, pred_accuracy_0_100, p_positive_mean, spread_0_100)
+    where spread is the std of p_positive across views, in percentage points.
+    """
+    tta_x = build_tta_batch(batch_x, views)
+    y = predict_scores(model, tta_x)
+    probs = y.reshape(len(views), -1)[:, 0]
+
+    p = float(probs.mean())
+    spread = float(probs.std() * 100.0)
+    pred_label, pred_accuracy = label_from_p(p)
+    return pred_label, pred_accuracy, p, spread
+
+
+def label_from_p(p: float) -> tuple[str, float]:
     pred_class = 1 if p >= 0.5 else 0
     pred_label = "positive" if pred_class == 1 else "negative"
 
     certainty = p if pred_class == 1 else (1.0 - p)
     pred_accuracy = float(certainty * 100.0)
 
-    return pred_label, pred_accuracy, p
\ No newline at end of file
+    return pred_label, pred_accuracy
\ No newline at end of file
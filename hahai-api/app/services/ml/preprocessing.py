@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import functools
+
 import cv2 as cv
 import numpy as np
 
@@ -95,3 +97,194 @@ def format_img_for_model_input(
     if not ok:
         raise ValueError("Failed to encode standardized xray as PNG")
     return img_bgr_512, batch_x, buf.tobytes(), "image/png"
+
+
+def make_thumbnails(
+    img_bgr: np.ndarray,
+    *,
+    sizes: list[int] | tuple[int, ...] = (128, 256),
+    output_format: str = "webp",   # "webp" or "jpg"
+    quality: int = 80,
+) -> tuple[dict[int, bytes], str]:
+    """
+    Downscaled previews of an (already square) image.
+    Returns ({size: encoded_bytes}, content_type).
+    """
+    if output_format.lower() == "webp":
+        ext, params, content_type = ".webp", [int(cv.IMWRITE_WEBP_QUALITY), int(quality)], "image/webp"
+    else:
+        ext, params, content_type = ".jpg", [int(cv.IMWRITE_JPEG_QUALITY), int(quality)], "image/jpeg"
+
+    thumbs: dict[int, bytes] = {}
+    src = img_bgr
+    for size in sorted(set(sizes), reverse=True):
+        if size >= max(src.shape[:2]):
+            continue
+        # INTER_AREA from the previous (larger) level keeps downscaling cheap and alias-free
+        src = cv.resize(src, (size, size), interpolation=cv.INTER_AREA)
+        ok, buf = cv.imencode(ext, src, params)
+        if not ok:
+            raise ValueError(f"Failed to encode {size}px thumbnail")
+        thumbs[size] = buf.tobytes()
+    return thumbs, content_type
+
+
+def encode_png(img_bgr: np.ndarray) -> bytes:
+    ok, buf = cv.imencode(".png", img_bgr)
+    if not ok:
+        raise ValueError("Failed to encode image as PNG")
+    return buf.tobytes()
+
+
+# Process-pool workers for offline batch inference (app.cli.infer). They only
+# need cv2/numpy, so pool processes never import TensorFlow.
+
+def preprocess_file(path: str, *, image_size: int, thumb_opts: dict) -> dict:
+    """
+    Reads one image file and returns the model input row plus the encoded
+    xray and its thumbnails.
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    img_bgr_512, batch_x, xray_bytes, xray_ct = format_img_for_model_input(
+        raw,
+        image_size=image_size,
+        output_format="jpg",
+        jpg_quality=95,
+    )
+    xray_thumbs, thumb_ct = make_thumbnails(img_bgr_512, **thumb_opts)
+    return {
+        "img_bgr": img_bgr_512,
+        "x": batch_x[0],
+        "xray": xray_bytes,
+        "xray_content_type": xray_ct,
+        "xray_thumbs": xray_thumbs,
+        "thumb_content_type": thumb_ct,
+    }
+
+
+def decode_stored_xray(data: bytes, *, image_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    (img_bgr, model input row) for an x-ray as stored at ingest (already
+    square-resized), e.g. to run it through a newer model.
+    """
+    img_bgr = decode_image_bytes_to_bgr(data)
+    if img_bgr.shape[:2] != (image_size, image_size):
+        img_bgr = square_resize_image(img_bgr, out_size=image_size)
+    return img_bgr, cv.cvtColor(img_bgr, cv.COLOR_BGR2RGB).astype(np.float32)
+
+
+def encode_overlay_outputs(overlay: np.ndarray, *, thumb_opts: dict) -> tuple[bytes, dict[int, bytes]]:
+    """(gradcam PNG bytes, gradcam thumbnails) for one overlay."""
+    thumbs, _ = make_thumbnails(overlay, **thumb_opts)
+    return encode_png(overlay), thumbs
+
+
+# Test-time augmentation views. Every supported view (flip, shift, center
+# zoom) is axis-aligned, i.e. a pair of 1-D maps from output row/column to
+# source row/column. From them we build, once per view list and input size,
+# a remap table for all views stacked vertically. A batch is then one
+# cv.remap over the whole (views*H, W) table rather than a per-view loop of
+# slices and resizes. Flips and shifts land on whole pixels and use nearest
+# lookup, which is an exact copy. Zooms are sampled bilinearly, as
+# cv.resize would. The zoom views sit last in the table so both lookups
+# write into one output. Out-of-image pixels map outside the input and read
+# the zero border.
+
+REMAP_MAX_ROWS = 32766  # cv.remap asserts rows < SHRT_MAX
+
+
+def parse_tta_views(views: list[str] | tuple[str, ...]) -> tuple[tuple[str, tuple[float, ...]], ...]:
+    """
+    Parses TTA view specs into (name, args) pairs, raising ValueError on the
+    first invalid one. Checked at startup so a bad TTA_VIEWS never reaches /process.
+
+    View specs:
+      "identity", "hflip", "vflip",
+      "shift:<dx>,<dy>"  translation as a fraction of the image size (e.g. "shift:0.05,0")
+      "scale:<factor>"   center zoom (e.g. "scale:0.9", "scale:1.1")
+    """
+    parsed = []
+    for view in views:
+        name, _, arg = view.partition(":")
+        try:
+            if name in ("identity", "hflip", "vflip") and not arg:
+                parsed.append((name, ()))
+            elif name == "shift":
+                fx, fy = (float(v) for v in arg.split(","))
+                if not (abs(fx) < 1 and abs(fy) < 1):
+                    raise ValueError
+                parsed.append((name, (fx, fy)))
+            elif name == "scale":
+                factor = float(arg)
+                if not 0 < factor < 100:
+                    raise ValueError
+                parsed.append((name, (factor,)))
+            else:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"Invalid TTA view {view!r}") from None
+    return tuple(parsed)
+
+
+def _view_axis(name: str, args: tuple[float, ...], *, axis: int, n: int) -> tuple[np.ndarray, np.ndarray]:
+    # (source coordinate, valid) for each output index along one axis (0 = rows, 1 = columns)
+    out = np.arange(n, dtype=np.float64)
+    if (name, axis) in (("hflip", 1), ("vflip", 0)):
+        return n - 1 - out, np.ones(n, dtype=bool)
+    if name == "shift":
+        src = out - int(round(args[1 - axis] * n))
+        return src, (src >= 0) & (src < n)
+    if name == "scale":
+        # as cv.resize to m pixels, then a center crop (zoom in) or zero pad (zoom out)
+        m = max(1, int(round(n * args[0])))
+        r = out + (m - n) // 2 if m >= n else out - (n - m) // 2
+        return np.clip((r + 0.5) * n / m - 0.5, 0, n - 1), (r >= 0) & (r < m)
+    return out, np.ones(n, dtype=bool)
+
+
+@functools.lru_cache(maxsize=8)
+def _tta_plan(views: tuple[str, ...], h: int, w: int) -> dict:
+    specs = parse_tta_views(views)
+    ys = [_view_axis(name, args, axis=0, n=h) for name, args in specs]
+    xs = [_view_axis(name, args, axis=1, n=w) for name, args in specs]
+
+    frac = np.array([(sy % 1).any() or (sx % 1).any() for (sy, _), (sx, _) in zip(ys, xs)])
+    order = np.argsort(frac, kind="stable")
+    map_y = np.empty((len(specs), h, w), dtype=np.float32)
+    map_x = np.empty((len(specs), h, w), dtype=np.float32)
+    for i, v in enumerate(order):
+        (sy, vy), (sx, vx) = ys[v], xs[v]
+        inside = vy[:, None] & vx[None, :]
+        map_y[i] = np.where(inside, sy[:, None], -2)
+        map_x[i] = np.where(inside, sx[None, :], -2)
+    return {
+        "map_y": map_y.reshape(-1, w),
+        "map_x": map_x.reshape(-1, w),
+        "exact_rows": int((~frac).sum()) * h,
+        "order": None if (order == np.arange(len(specs))).all() else np.argsort(order),
+    }
+
+
+def build_tta_batch(batch_x: np.ndarray, views: list[str] | tuple[str, ...]) -> np.ndarray:
+    """
+    Expands a (1,H,W,3) model input into (len(views),H,W,3) augmented views
+    for test-time augmentation, so all of them go through one model call.
+    See parse_tta_views for the view specs.
+    """
+    base = np.ascontiguousarray(batch_x[0])
+    h, w, c = base.shape
+    plan = _tta_plan(tuple(views), h, w)
+    map_x, map_y, n = plan["map_x"], plan["map_y"], plan["exact_rows"]
+
+    out = np.empty((len(views), h, w, c), dtype=batch_x.dtype)
+    rows = out.reshape(-1, w, c)
+    for start, end, interpolation in ((0, n, cv.INTER_NEAREST), (n, len(rows), cv.INTER_LINEAR)):
+        # cv.remap takes fewer than SHRT_MAX rows per call, however many views there are
+        for lo in range(start, end, REMAP_MAX_ROWS):
+            hi = min(lo + REMAP_MAX_ROWS, end)
+            cv.remap(
+                base, map_x[lo:hi], map_y[lo:hi], interpolation,
+                dst=rows[lo:hi], borderMode=cv.BORDER_CONSTANT, borderValue=0,
+            )
+    return out if plan["order"] is None else np.take(out, plan["order"], axis=0)
@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import asyncio
+import gc
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import numpy as np
+import tensorflow as tf
+from redis.asyncio.client import Redis
+
+from app.config import settings
+from app.db.keys import MODELS_ACTIVE_KEY
+from app.services.ml.gradcam import gradcam_overlay
+from app.services.ml.model import load_keras_model, predict_scores
+
+# In-process registry of loaded model versions. Requests lease the active
+# version for their whole duration (get_model), so switching versions is a
+# single assignment and never pulls a model out from under a running
+# predict/gradcam. A replaced version is dropped once its last lease ends.
+#
+# The version every worker should serve lives in Redis (models:active);
+# workers that didn't handle the admin call pick it up via sync_active_model.
+
+logger = logging.getLogger(__name__)
+
+
+class ModelNotFoundError(Exception):
+    pass
+
+
+class ModelVersionExistsError(Exception):
+    pass
+
+
+class ModelNotReadyError(Exception):
+    pass
+
+
+class ModelInUseError(Exception):
+    pass
+
+
+class ModelLease:
+    __slots__ = ("version", "model")
+
+    def __init__(self, version: str, model: tf.keras.Model): # type:ignore
+        self.version = version
+        self.model = model
+
+
+class _Slot:
+    def __init__(self, version: str, path: str):
+        self.version = version
+        self.path = path
+        self.status = "loading"  # loading -> ready -> draining -> unloaded (dropped) | failed
+        self.model: tf.keras.Model | None = None # type:ignore
+        self.in_flight = 0
+        self.loaded_at: int | None = None
+        self.warmup_seconds: float | None = None
+        self.error = ""
+
+
+def _load_and_warm(path: str, *, image_size: int, batch_sizes: list[int], gradcam_layer: str | None):
+    model = load_keras_model(path)
+    for bs in sorted(set(batch_sizes)):
+        predict_scores(model, np.zeros((bs, image_size, image_size, 3), dtype=np.float32))
+    if gradcam_layer:
+        gradcam_overlay(
+            model,
+            batch_x=np.zeros((1, image_size, image_size, 3), dtype=np.float32),
+            img_bgr_512=np.zeros((image_size, image_size, 3), dtype=np.uint8),
+            target_layer_name=gradcam_layer,
+        )
+    return model
+
+
+def load_options() -> dict:
+    """ModelRegistry.load options from settings (warms the batch sizes requests will use)."""
+    if not settings.MODEL_WARMUP:
+        return {"image_size": settings.IMAGE_SIZE}
+    return {
+        "image_size": settings.IMAGE_SIZE,
+        "warmup_batch_sizes": [1, len(settings.TTA_VIEWS)],
+        "gradcam_layer": settings.ENCODER_LAST_CONV_LAYER,
+    }
+
+
+class ModelRegistry:
+    def __init__(self) -> None:
+        self._slots: dict[str, _Slot] = {}
+        self._active: str | None = None
+        self._load_lock = asyncio.Lock()
+
+    @property
+    def active_version(self) -> str | None:
+        return self._active
+
+    def status(self, version: str) -> tuple[str, str] | None:
+        """(status, path) of a known version, None if never loaded."""
+        slot = self._slots.get(version)
+        return None if slot is None else (slot.status, slot.path)
+
+    def describe(self) -> dict:
+        return {
+            "active_version": self._active,
+            "versions": [
+                {
+                    "version": s.version,
+                    "path": s.path,
+                    "status": s.status,
+                    "in_flight": s.in_flight,
+                    "loaded_at": s.loaded_at,
+                    "warmup_seconds": s.warmup_seconds,
+                    "error": s.error,
+                }
+                for s in self._slots.values()
+            ],
+        }
+
+    async def load(
+        self,
+        version: str,
+        path: str,
+        *,
+        image_size: int,
+        warmup_batch_sizes: list[int] | None = None,
+        gradcam_layer: str | None = None,
+    ) -> None:
+        """
+        Loads and warms `version` in a worker thread, so requests keep being
+        served by the active version meanwhile. Loads are serialized to keep
+        peak memory at (active + one new) model.
+        """
+        existing = self._slots.get(version)
+        if existing is not None and existing.status in ("loading", "ready"):
+            raise ModelVersionExistsError(f"Model version {version} is already {existing.status}")
+
+        slot = _Slot(version, path)
+        self._slots[version] = slot
+        started = time.perf_counter()
+        try:
+            async with self._load_lock:
+                slot.model = await asyncio.to_thread(
+                    _load_and_warm, path,
+                    image_size=image_size,
+                    batch_sizes=warmup_batch_sizes or [],
+                    gradcam_layer=gradcam_layer,
+                )
+        except Exception as e:
+            slot.status = "failed"
+            slot.error = str(e)
+            raise
+
+        slot.status = "ready"
+        slot.loaded_at = int(time.time())
+        slot.warmup_seconds = round(time.perf_counter() - started, 3)
+
+    def activate(self, version: str) -> str | None:
+        """
+        Switches new leases to `version`; returns the previously active version,
+        which is unloaded as soon as its in-flight requests finish.
+        """
+        slot = self._slots.get(version)
+        if slot is None:
+            raise ModelNotFoundError(f"Model version {version} is not loaded")
+        if slot.status not in ("ready", "draining"):
+            raise ModelNotReadyError(f"Model version {version} is {slot.status}")
+
+        previous, self._active = self._active, version
+        slot.status = "ready"
+        if previous is not None and previous != version:
+            old = self._slots[previous]
+            old.status = "draining"
+            self._release_if_idle(old)
+        return previous
+
+    def unload(self, version: str) -> None:
+        slot = self._slots.get(version)
+        if slot is None:
+            raise ModelNotFoundError(f"Model version {version} is not loaded")
+        if version == self._active:
+            raise ModelInUseError(f"Model version {version} is active")
+        if slot.status == "loading":
+            raise ModelNotReadyError(f"Model version {version} is still loading")
+        slot.status = "draining"
+        self._release_if_idle(slot)
+
+    def _release_if_idle(self, slot: _Slot) -> None:
+        if slot.status == "draining" and slot.in_flight == 0:
+            slot.model = None
+            slot.status = "unloaded"
+            if self._slots.get(slot.version) is slot:
+                del self._slots[slot.version]
+            gc.collect()
+            logger.info("Unloaded model version %s", slot.version)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[ModelLease]:
+        if self._active is None:
+            raise ModelNotReadyError("No model version is active")
+        slot = self._slots[self._active]
+        slot.in_flight += 1
+        try:
+            yield ModelLease(slot.version, slot.model)
+        finally:
+            slot.in_flight -= 1
+            self._release_if_idle(slot)
+
+
+async def get_desired_model(redis: Redis) -> dict[str, str]:
+    return await redis.hgetall(MODELS_ACTIVE_KEY) #type:ignore
+
+
+async def set_desired_model(redis: Redis, *, version: str, path: str) -> None:
+    await redis.hset(MODELS_ACTIVE_KEY, mapping={ # type:ignore
+        "version": version,
+        "path": path,
+        "activated_at": int(time.time()),
+    })
+
+
+async def sync_active_model(registry: ModelRegistry, redis: Redis, **load_opts) -> bool:
+    """
+    Loads + activates the version recorded in models:active if this worker
+    isn't serving it yet. Returns True if it switched.
+    """
+    desired = await get_desired_model(redis)
+    version, path = desired.get("version"), desired.get("path")
+    if not version or not path or version == registry.active_version:
+        return False
+
+    known = registry.status(version)
+    if known == ("failed", path):
+        return False  # already failed here; a new deploy call resets it
+    if known is None or known[0] == "failed":
+        await registry.load(version, path, **(load_opts or load_options()))
+    elif known[0] == "loading":
+        return False  # the admin job on this worker is still warming it
+
+    registry.activate(version)
+    logger.info("Switched to model version %s", version)
+    return True
+
+
+async def run_model_sync(registry: ModelRegistry, redis: Redis, *, interval_seconds: int, **load_opts) -> None:
+    """
+    Lifespan background loop: follows models:active so every worker switches
+    to a newly deployed version without a restart.
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await sync_active_model(registry, redis, **load_opts)
+        except Exception:
+            logger.exception("Model sync failed")
@@ -0,0 +1,291 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+
+import numpy as np
+from redis.asyncio.client import Redis
+
+from app.db.keys import RECORD_EMBEDDED_CHANNEL, RECORD_INVALIDATION_CHANNEL, record_embedding_key
+from app.db.redis import get_bytes, queue_get_bytes
+from app.services.storage.indexes import scan_record_ids
+
+# Similar-case retrieval. Each record's embedding (the encoder's last conv
+# maps, global-average-pooled: what the classifier head sees) is stored as
+# float16 bytes in record:{b}:{case_id}:embedding. Every worker keeps an
+# in-memory index of the unit-normalised vectors (float32, so a query is
+# one BLAS mat-vec) and keeps it current from two channels:
+#   records:embedded     case_id of a newly saved record with an embedding
+#   records:invalidated  case_id of a removed record (see record_cache)
+#
+# With ivf_lists > 0 and enough vectors, the rows are partitioned by a
+# k-means pass at (re)build time and a query only scans the `probes`
+# partitions whose centroids are closest (approximate, much less work).
+
+logger = logging.getLogger(__name__)
+
+LOAD_PAGE_SIZE = 500
+LISTEN_POLL_SECONDS = 5.0
+RECONNECT_DELAY_SECONDS = 1.0
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 20_000
+IVF_MIN_ROWS_PER_LIST = 50
+
+
+class SimilarityIndexNotReadyError(Exception):
+    pass
+
+
+class EmbeddingNotFoundError(Exception):
+    pass
+
+
+def encode_embedding(vec: np.ndarray) -> bytes:
+    return np.asarray(vec, dtype=np.float16).reshape(-1).tobytes()
+
+
+def decode_embedding(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32)
+
+
+def _normalize(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=-1, keepdims=True)
+    return m / np.maximum(norms, 1e-12)
+
+
+def _kmeans(x: np.ndarray, k: int, *, iterations: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on unit rows; returns unit centroids (k, d)."""
+    rng = np.random.default_rng(seed)
+    if len(x) > KMEANS_SAMPLE:
+        x = x[rng.choice(len(x), KMEANS_SAMPLE, replace=False)]
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        for c in range(k):
+            members = x[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+    return centroids
+
+
+class _Partition:
+    """Contiguous rows of one IVF list (or of the whole index without IVF)."""
+
+    def __init__(self, vectors: np.ndarray, ids: list[str]):
+        self.vectors = vectors                      # capacity rows, first n used
+        self.alive = np.ones(len(ids), dtype=bool)
+        self.ids: list[str | None] = list(ids)
+        self.n = len(ids)
+
+    def append(self, vec: np.ndarray, case_id: str) -> int:
+        if self.n == len(self.vectors):
+            grow = max(256, len(self.vectors))
+            self.vectors = np.vstack([self.vectors, np.zeros((grow, self.vectors.shape[1]), np.float32)])
+            self.alive = np.concatenate([self.alive, np.zeros(grow, dtype=bool)])
+        row = self.n
+        self.vectors[row] = vec
+        self.alive[row] = True
+        self.ids.append(case_id)
+        self.n += 1
+        return row
+
+    def compact(self) -> list[str]:
+        keep = np.flatnonzero(self.alive[:self.n])
+        self.vectors = self.vectors[keep]
+        self.alive = np.ones(len(keep), dtype=bool)
+        self.ids = [self.ids[i] for i in keep]
+        self.n = len(keep)
+        return self.ids  # type:ignore
+
+    def scores(self, q: np.ndarray) -> np.ndarray:
+        # one mat-vec over the contiguous block; deleted rows can never win
+        s = self.vectors[:self.n] @ q
+        s[~self.alive[:self.n]] = -np.inf
+        return s
+
+
+class SimilarityIndex:
+    def __init__(self, *, ivf_lists: int = 0, probes: int = 8):
+        self.ivf_lists = max(0, ivf_lists)
+        self.probes = max(1, probes)
+        self.ready = False
+        self._dim: int | None = None
+        self._centroids: np.ndarray | None = None
+        self._parts: list[_Partition] = []
+        self._pos: dict[str, tuple[int, int]] = {}  # case_id -> (partition, row)
+
+    def __len__(self) -> int:
+        return len(self._pos)
+
+    def __contains__(self, case_id: str) -> bool:
+        return case_id in self._pos
+
+    def snapshot(self) -> dict:
+        return {
+            "ready": self.ready,
+            "records": len(self._pos),
+            "dim": self._dim,
+            "partitions": 0 if self._centroids is None else len(self._centroids),
+            "probes": self.probes,
+            "memory_bytes": int(sum(p.vectors.nbytes for p in self._parts)),
+        }
+
+    def build(self, ids: list[str], vectors: np.ndarray | None) -> None:
+        """
+        Replaces the whole index. Runs in a worker thread while `ready` is
+        False, so no search sees it half-built.
+        """
+        if not ids or vectors is None:
+            self._dim, self._centroids, self._parts, self._pos = None, None, [], {}
+            return
+
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        centroids = None
+        if self.ivf_lists and len(ids) >= self.ivf_lists * IVF_MIN_ROWS_PER_LIST:
+            centroids = _kmeans(vectors, self.ivf_lists, iterations=KMEANS_ITERATIONS)
+
+        if centroids is None:
+            parts = [_Partition(vectors, ids)]
+        else:
+            assign = np.argmax(vectors @ centroids.T, axis=1)
+            parts = []
+            for c in range(len(centroids)):
+                rows = np.flatnonzero(assign == c)
+                parts.append(_Partition(vectors[rows], [ids[i] for i in rows]))
+
+        pos = {}
+        for pi, part in enumerate(parts):
+            for row, cid in enumerate(part.ids):
+                pos[cid] = (pi, row)
+        self._dim, self._centroids, self._parts, self._pos = vectors.shape[1], centroids, parts, pos
+
+    def add(self, case_id: str, vec: np.ndarray) -> None:
+        vec = _normalize(np.asarray(vec, dtype=np.float32).reshape(1, -1))[0]
+        if self._dim is None:
+            self._dim = vec.shape[0]
+            self._parts = [_Partition(np.zeros((0, self._dim), dtype=np.float32), [])]
+        if vec.shape[0] != self._dim:
+            logger.warning("Skipping embedding of %s: dim %d != %d", case_id, vec.shape[0], self._dim)
+            return
+        self.remove(case_id)
+        pi = 0 if self._centroids is None else int(np.argmax(self._centroids @ vec))
+        self._pos[case_id] = (pi, self._parts[pi].append(vec, case_id))
+
+    def remove(self, case_id: str) -> None:
+        loc = self._pos.pop(case_id, None)
+        if loc is None:
+            return
+        part = self._parts[loc[0]]
+        part.alive[loc[1]] = False
+        part.ids[loc[1]] = None
+        if part.n > 256 and part.alive[:part.n].sum() < part.n // 2:
+            for row, cid in enumerate(part.compact()):
+                self._pos[cid] = (loc[0], row)
+
+    def vector(self, case_id: str) -> np.ndarray | None:
+        loc = self._pos.get(case_id)
+        return None if loc is None else self._parts[loc[0]].vectors[loc[1]]
+
+    def search(self, vec: np.ndarray, *, k: int, exclude: str | None = None) -> list[tuple[str, float]]:
+        """Top-k (case_id, cosine similarity), best first."""
+        if not self.ready:
+            raise SimilarityIndexNotReadyError("Similarity index is still loading")
+        if not self._pos:
+            return []
+        q = _normalize(np.asarray(vec, dtype=np.float32).reshape(1, -1))[0]
+        if self._centroids is None:
+            probe = range(len(self._parts))
+        else:
+            probe = np.argsort(-(self._centroids @ q))[:self.probes]
+
+        candidates: list[tuple[str, float]] = []
+        for pi in probe:
+            part = self._parts[pi]
+            if not part.n:
+                continue
+            scores = part.scores(q)
+            kk = min(k + 1, part.n)  # +1: `exclude` may be among them
+            top = np.argpartition(-scores, kk - 1)[:kk]
+            candidates.extend(
+                (part.ids[t], float(scores[t])) for t in top  # type:ignore
+                if np.isfinite(scores[t]) and part.ids[t] != exclude
+            )
+        candidates.sort(key=lambda c: -c[1])
+        return candidates[:k]
+
+    def similar_to(self, case_id: str, *, k: int) -> list[tuple[str, float]]:
+        if not self.ready:
+            raise SimilarityIndexNotReadyError("Similarity index is still loading")
+        vec = self.vector(case_id)
+        if vec is None:
+            raise EmbeddingNotFoundError(f"Record {case_id} has no embedding")
+        return self.search(vec, k=k, exclude=case_id)
+
+
+async def load_embeddings(redis: Redis, *, page_size: int = LOAD_PAGE_SIZE) -> tuple[list[str], np.ndarray | None]:
+    """All stored embeddings of permanent records, one pipelined page at a time."""
+    ids: list[str] = []
+    vecs: list[np.ndarray] = []
+
+    async def load(page: list[str]) -> None:
+        pipe = redis.pipeline(transaction=False)
+        for cid in page:
+            queue_get_bytes(pipe, record_embedding_key(cid))
+        for cid, data in zip(page, await pipe.execute()):
+            if data:
+                ids.append(cid)
+                vecs.append(decode_embedding(data))
+
+    async for page in scan_record_ids(redis, page_size=page_size):
+        await load(page)
+
+    if not vecs:
+        return ids, None
+    dim = vecs[0].shape[0]
+    keep = [i for i, v in enumerate(vecs) if v.shape[0] == dim]
+    return [ids[i] for i in keep], np.stack([vecs[i] for i in keep])
+
+
+async def publish_embeddings_added(redis: Redis, *case_ids: str) -> None:
+    """Announces newly saved embeddings, after the MULTI that wrote them."""
+    pipe = redis.pipeline(transaction=False)
+    for cid in case_ids:
+        pipe.publish(RECORD_EMBEDDED_CHANNEL, cid)
+    await pipe.execute()
+
+
+async def run_similarity_sync(index: SimilarityIndex, redis: Redis) -> None:
+    """
+    Lifespan background loop: subscribes first, then (re)builds the index
+    from Redis, then applies adds/removes. Messages that arrive during the
+    build are buffered on the subscription and applied right after it.
+    """
+    while True:
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(RECORD_EMBEDDED_CHANNEL, RECORD_INVALIDATION_CHANNEL)
+            ids, vectors = await load_embeddings(redis)
+            await asyncio.to_thread(index.build, ids, vectors)
+            index.ready = True
+            logger.info("Similarity index ready with %d records", len(index))
+
+            while True:
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=LISTEN_POLL_SECONDS)
+                if msg is None or msg["type"] != "message":
+                    continue
+                case_id = msg["data"]
+                if msg["channel"] == RECORD_INVALIDATION_CHANNEL:
+                    index.remove(case_id)
+                else:
+                    data = await get_bytes(redis, record_embedding_key(case_id))
+                    if data:
+                        index.add(case_id, decode_embedding(data))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Similarity index sync failed; rebuilding")
+        finally:
+            index.ready = False
+            await pubsub.aclose()
+        await asyncio.sleep(RECONNECT_DELAY_SECONDS)
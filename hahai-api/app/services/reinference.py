@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import defaultdict
+from typing import Callable
+
+import numpy as np
+from redis.asyncio.client import Redis
+from redis.exceptions import WatchError
+
+from app.config import settings
+from app.db.keys import all_buckets, record_bucket, record_embedding_key, record_gradcam_key, record_key, record_thumb_key, record_xray_key, records_key
+from app.db.redis import queue_get_bytes
+from app.services import jobs
+from app.services.admission import InferenceGate
+from app.services.locks import acquire_lock, refresh_lock, release_lock
+from app.services.ml.gradcam import cached_grad_model, gradcam_batch
+from app.services.ml.model import label_from_p
+from app.services.ml.preprocessing import decode_stored_xray, encode_overlay_outputs
+from app.services.ml.registry import ModelRegistry
+from app.services.ml.similarity import encode_embedding, publish_embeddings_added
+from app.services.storage.images import thumb_sizes_of
+from app.services.storage.indexes import index_record, scan_record_ids, unindex_record
+from app.services.storage.record_cache import publish_record_invalidation
+from app.services.storage.record_codec import decode_record, encode_record, is_compact
+from app.services.storage.stats import track_record_added, track_record_removed
+from app.services.storage.usage import track_storage_added, track_storage_removed
+from app.services.storage.versions import bump_record_versions
+
+# Re-runs stored records through the active model version (e.g. after a
+# retrain), as an admin-triggered background job. Per batch:
+#
+#   redis    a page of permanent records; the ones already on the active
+#            version are skipped, so re-running the job (?resume=job_id)
+#            after a restart continues where it stopped
+#   decode   the stored 512px x-rays, off the event loop
+#   model    one forward + backward pass: predictions, Grad-CAM, embeddings
+#   encode   gradcam PNG + thumbnails
+#   redis    one WATCHed MULTI per key bucket: new prediction (the previous
+#            one kept in prev_pred_label / prev_pred_accuracy /
+#            prev_model_version), gradcam, thumbnails, embedding, indexes
+#            and aggregates; written while the next batch runs
+#
+# Live traffic first: before every batch the job waits until this worker's
+# inference gate is idle, and it sleeps REINFER_PAUSE_SECONDS after it.
+# A record deleted or changed while its batch ran is left alone (counted
+# as a conflict) and picked up by the next run.
+
+REINFER_LOCK_TTL_SECONDS = 10 * 60  # refreshed every batch
+LIVE_TRAFFIC_POLL_SECONDS = 0.05
+STAGES = ("redis_read", "live_wait", "decode", "model", "encode", "write_wait")
+MAX_REPORTED_ERRORS = 20
+
+
+class ReinferenceInProgressError(Exception):
+    pass
+
+
+def _thumb_opts() -> dict:
+    return dict(
+        sizes=settings.THUMBNAIL_SIZES,
+        output_format=settings.THUMBNAIL_FORMAT,
+        quality=settings.THUMBNAIL_QUALITY,
+    )
+
+
+async def _load_records(redis: Redis, case_ids: list[str], version: str) -> tuple[list[dict], int]:
+    """
+    Metadata, stored x-ray and x-ray thumbnail sizes of the records in
+    `case_ids` that aren't on `version` yet. Returns (records, skipped).
+    """
+    pipe = redis.pipeline(transaction=False)
+    for cid in case_ids:
+        pipe.hgetall(record_key(cid))
+    metas = [decode_record(meta, cid) for cid, meta in zip(case_ids, await pipe.execute())]
+
+    todo = [
+        meta for meta in metas
+        if meta and meta.get("is_temp") != "1" and meta.get("model_version") != version
+    ]
+    skipped = sum(1 for m in metas if m) - len(todo)
+    if not todo:
+        return [], skipped
+
+    pipe = redis.pipeline(transaction=False)
+    for meta in todo:
+        queue_get_bytes(pipe, record_xray_key(meta["case_id"]))
+        for size in thumb_sizes_of(meta):
+            pipe.strlen(record_thumb_key(meta["case_id"], "xray", size))
+    res = await pipe.execute()
+
+    records, i = [], 0
+    for meta in todo:
+        sizes = thumb_sizes_of(meta)
+        xray, lens = res[i], res[i + 1:i + 1 + len(sizes)]
+        i += 1 + len(sizes)
+        records.append({"meta": meta, "xray": xray, "xray_thumb_bytes": dict(zip(sizes, lens))})
+    return records, skipped
+
+
+def _decode(records: list[dict], image_size: int) -> list[tuple[dict, np.ndarray, np.ndarray] | Exception]:
+    out: list = []
+    for r in records:
+        try:
+            if not r["xray"]:
+                raise ValueError("Stored x-ray missing")
+            out.append((r, *decode_stored_xray(r["xray"], image_size=image_size)))
+        except Exception as e:
+            out.append(e)
+    return out
+
+
+def _encode(overlays: list[np.ndarray], thumb_opts: dict) -> list[tuple[bytes, dict[int, bytes]]]:
+    return [encode_overlay_outputs(ov, thumb_opts=thumb_opts) for ov in overlays]
+
+
+def _update_for(record: dict, p: float, embedding: np.ndarray, gradcam_png: bytes, gradcam_thumbs: dict[int, bytes], *, version: str, now: int) -> dict:
+    meta = record["meta"]
+    pred_label, pred_accuracy = label_from_p(p)
+    old_sizes = thumb_sizes_of(meta)
+    # a size survives if both thumbnails exist; the rest fall back to the full image
+    kept = [s for s in old_sizes if s in gradcam_thumbs and record["xray_thumb_bytes"].get(s)]
+    fields = {
+        "pred_label": pred_label,
+        "pred_accuracy": pred_accuracy,
+        "model_version": version,
+        "prev_pred_label": meta.get("pred_label", ""),
+        "prev_pred_accuracy": meta.get("pred_accuracy", ""),
+        "prev_model_version": meta.get("model_version", ""),
+        "reinferred_at": now,
+        "gradcam_content_type": "image/png",
+        "gradcam_bytes": len(gradcam_png),
+        "thumb_sizes": ",".join(str(s) for s in kept),
+        "thumb_bytes": sum(record["xray_thumb_bytes"][s] + len(gradcam_thumbs[s]) for s in kept),
+    }
+    return {
+        "case_id": meta["case_id"],
+        "seen_version": meta.get("model_version", ""),
+        "fields": fields,
+        "gradcam": gradcam_png,
+        "gradcam_thumbs": {s: gradcam_thumbs[s] for s in kept},
+        "dropped_sizes": [s for s in old_sizes if s not in kept],
+        "embedding": encode_embedding(embedding),
+    }
+
+
+async def _write_updates(redis: Redis, updates: list[dict]) -> tuple[list[str], int]:
+    """
+    One WATCHed MULTI per key bucket. Records deleted or changed since
+    they were read are skipped. Returns (case_ids written, conflicts).
+    """
+    by_bucket: dict[int, list[dict]] = defaultdict(list)
+    for u in updates:
+        by_bucket[record_bucket(u["case_id"])].append(u)
+
+    written: list[str] = []
+    owners: set[str] = set()
+    conflicts = 0
+    for group in by_bucket.values():
+        keys = [record_key(u["case_id"]) for u in group]
+        async with redis.pipeline() as pipe:
+            await pipe.watch(*keys)
+            read = redis.pipeline(transaction=False)
+            for key in keys:
+                read.hgetall(key)
+            current = await read.execute()
+
+            pipe.multi()
+            batch = []
+            batch_owners = set()
+            for u, stored in zip(group, current):
+                cid = u["case_id"]
+                data = decode_record(stored, cid)
+                if not data or data.get("is_temp") == "1" or data.get("model_version", "") != u["seen_version"]:
+                    conflicts += 1
+                    continue
+                old = data
+                new = {**old, **u["fields"]}
+                unindex_record(pipe, old)
+                track_record_removed(pipe, old)
+                track_storage_removed(pipe, old)
+                pipe.hset(record_key(cid), mapping=encode_record(u["fields"], compact=is_compact(stored)))
+                pipe.set(record_gradcam_key(cid), u["gradcam"])
+                for size, thumb in u["gradcam_thumbs"].items():
+                    pipe.set(record_thumb_key(cid, "gradcam", size), thumb)
+                for size in u["dropped_sizes"]:
+                    pipe.unlink(record_thumb_key(cid, "xray", size), record_thumb_key(cid, "gradcam", size))
+                pipe.set(record_embedding_key(cid), u["embedding"])
+                index_record(pipe, new)
+                track_record_added(pipe, new)
+                track_storage_added(pipe, new)
+                batch.append(cid)
+                batch_owners.add(data.get("student_id", ""))
+            if not batch:
+                continue
+            try:
+                await pipe.execute()
+            except WatchError:
+                conflicts += len(batch)
+                continue
+            written.extend(batch)
+            owners |= batch_owners
+
+    if written:
+        # the hashes changed: new listing versions, drop cached copies (and
+        # the old vectors), then announce the new embeddings
+        await bump_record_versions(redis, owners, membership=False)
+        await publish_record_invalidation(redis, *written)
+        await publish_embeddings_added(redis, *written)
+    return written, conflicts
+
+
+async def _wait_for_idle(gate: InferenceGate | None) -> None:
+    while gate is not None and gate.busy:
+        await asyncio.sleep(LIVE_TRAFFIC_POLL_SECONDS)
+
+
+async def run_reinference(
+    redis: Redis,
+    models: ModelRegistry,
+    *,
+    job_id: str,
+    gate: InferenceGate | None = None,
+    batch_size: int | None = None,
+    pause: float | None = None,
+    on_progress: Callable[[dict], None] | None = None,
+) -> dict:
+    """
+    Re-runs every permanent record not yet on the active model version and
+    returns a summary with throughput and per-stage seconds. Progress goes
+    to job:{job_id}, which is marked running once the lock is held. One run
+    at a time across all workers (lock:reinference); a run whose lock expired
+    and was taken over stops with LockLostError.
+    """
+    batch_size = batch_size or settings.REINFER_BATCH_SIZE
+    pause = settings.REINFER_PAUSE_SECONDS if pause is None else pause
+
+    token = await acquire_lock(redis, "reinference", ttl_seconds=REINFER_LOCK_TTL_SECONDS)
+    if token is None:
+        raise ReinferenceInProgressError("A re-inference job is already running")
+
+    thumb_opts = _thumb_opts()
+    stage_seconds = {s: 0.0 for s in STAGES}
+    totals = {"processed": 0, "skipped_current": 0, "failed": 0, "conflicts": 0}
+    versions: set[str] = set()
+    errors: list[dict] = []
+    started = time.perf_counter()
+    pending_write: asyncio.Task | None = None
+
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for b in all_buckets():
+            pipe.scard(records_key(b))
+        records_total = sum(await pipe.execute())
+        await jobs.update_job(redis, job_id, status="running", records_total=records_total)
+
+        async def finish_write() -> None:
+            nonlocal pending_write
+            if pending_write is None:
+                return
+            t0 = time.perf_counter()
+            written, conflicts = await pending_write
+            pending_write = None
+            stage_seconds["write_wait"] += time.perf_counter() - t0
+            totals["processed"] += len(written)
+            totals["conflicts"] += conflicts
+            await jobs.update_job(redis, job_id, counters={"records_processed": len(written), "records_conflicts": conflicts})
+
+        async for case_ids in scan_record_ids(redis, page_size=batch_size):
+            t0 = time.perf_counter()
+            if models.active_version is None:
+                raise RuntimeError("No model version is active")
+            records, skipped = await _load_records(redis, case_ids, models.active_version)
+            stage_seconds["redis_read"] += time.perf_counter() - t0
+            totals["skipped_current"] += skipped
+
+            failed = 0
+            if records:
+                t0 = time.perf_counter()
+                decoded = await asyncio.to_thread(_decode, records, settings.IMAGE_SIZE)
+                stage_seconds["decode"] += time.perf_counter() - t0
+                ok = [d for d in decoded if not isinstance(d, Exception)]
+                for r, d in zip(records, decoded):
+                    if isinstance(d, Exception):
+                        failed += 1
+                        if len(errors) < MAX_REPORTED_ERRORS:
+                            errors.append({"case_id": r["meta"]["case_id"], "error": str(d)})
+
+                if ok:
+                    t0 = time.perf_counter()
+                    await _wait_for_idle(gate)
+                    stage_seconds["live_wait"] += time.perf_counter() - t0
+
+                    t0 = time.perf_counter()
+                    async with models.acquire() as lease:
+                        probs, overlays, embeddings = await asyncio.to_thread(
+                            gradcam_batch, cached_grad_model(lease.model, settings.ENCODER_LAST_CONV_LAYER),
+                            batch_x=np.stack([x for _, _, x in ok]),
+                            imgs_bgr=[img for _, img, _ in ok],
+                            alpha=settings.GRADCAM_ALPHA,
+                        )
+                        version = lease.version
+                    stage_seconds["model"] += time.perf_counter() - t0
+                    versions.add(version)
+
+                    t0 = time.perf_counter()
+                    encoded = await asyncio.to_thread(_encode, overlays, thumb_opts)
+                    stage_seconds["encode"] += time.perf_counter() - t0
+
+                    now = int(time.time())
+                    updates = [
+                        _update_for(r, float(p), emb, png, thumbs, version=version, now=now)
+                        for (r, _, _), p, emb, (png, thumbs) in zip(ok, probs, embeddings, encoded)
+                    ]
+                    await finish_write()
+                    pending_write = asyncio.create_task(_write_updates(redis, updates))
+
+            totals["failed"] += failed
+            await jobs.update_job(redis, job_id, counters={"records_skipped_current": skipped, "records_failed": failed})
+            await refresh_lock(redis, "reinference", token, ttl_seconds=REINFER_LOCK_TTL_SECONDS)
+            if on_progress is not None:
+                on_progress({**totals, "records_total": records_total, "elapsed": time.perf_counter() - started})
+            if records and pause > 0:
+                await asyncio.sleep(pause)
+
+        await finish_write()
+    finally:
+        if pending_write is not None:
+            pending_write.cancel()
+        await release_lock(redis, "reinference", token)
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        "records_total": records_total,
+        "processed": totals["processed"],
+        "skipped_current": totals["skipped_current"],
+        "failed": totals["failed"],
+        "conflicts": totals["conflicts"],
+        "model_versions": sorted(versions),
+        "elapsed_seconds": round(elapsed, 2),
+        "records_per_second": round(totals["processed"] / elapsed, 2) if elapsed > 0 else 0.0,
+        "stage_seconds": {k: round(v, 2) for k, v in stage_seconds.items()},
+        "batch_size": batch_size,
+        "errors": errors,  # failed records are retried by the next run
+    }
+    return summary
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable
+
+# Per-stage timings for the /process pipeline (per worker), and the
+# cancellation bookkeeping: when a client disconnects, the stages that were
+# skipped are counted as saved compute using their average duration.
+
+PROCESS_STAGES = ("preprocess", "predict", "gradcam", "thumbnails", "store")
+
+
+class ClientDisconnectedError(Exception):
+    def __init__(self, message: str, *, stage: str):
+        super().__init__(message)
+        self.stage = stage
+
+
+class StageMetrics:
+    def __init__(self, stages: tuple[str, ...] = PROCESS_STAGES):
+        self.stages = stages
+        self._count = {s: 0 for s in stages}
+        self._seconds = {s: 0.0 for s in stages}
+        self.completed = 0
+        self.cancelled: dict[str, int] = {}  # stage (or "queue") -> cancelled before it ran
+        self.saved_seconds = 0.0
+
+    def avg_seconds(self, stage: str) -> float:
+        return self._seconds[stage] / self._count[stage] if self._count[stage] else 0.0
+
+    def record(self, stage: str, seconds: float) -> None:
+        self._count[stage] += 1
+        self._seconds[stage] += seconds
+
+    def record_cancel(self, stage: str) -> float:
+        """
+        `stage` is the first stage that didn't run ("queue" if none did).
+        Returns the compute estimated as saved.
+        """
+        skipped = self.stages if stage == "queue" else self.stages[self.stages.index(stage):]
+        saved = sum(self.avg_seconds(s) for s in skipped)
+        self.cancelled[stage] = self.cancelled.get(stage, 0) + 1
+        self.saved_seconds += saved
+        return saved
+
+    def snapshot(self) -> dict:
+        return {
+            "completed": self.completed,
+            "stages": {
+                s: {"count": self._count[s], "avg_seconds": round(self.avg_seconds(s), 4)}
+                for s in self.stages
+            },
+            "cancelled": dict(self.cancelled),
+            "cancelled_total": sum(self.cancelled.values()),
+            "compute_saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+class StageRunner:
+    """
+    Runs one request's pipeline stage by stage. Before each stage it checks
+    whether the client is still there and stops with ClientDisconnectedError
+    if not, so abandoned requests give up their inference slot early.
+    """
+
+    def __init__(self, metrics: StageMetrics, is_disconnected: Callable[[], Awaitable[bool]]):
+        self.metrics = metrics
+        self.is_disconnected = is_disconnected
+        self.timings: dict[str, float] = {}
+
+    async def check(self, stage: str) -> None:
+        if await self.is_disconnected():
+            self.metrics.record_cancel(stage)
+            raise ClientDisconnectedError(f"Client disconnected before {stage}", stage=stage)
+
+    async def run(self, stage: str, fn: Callable[..., Any], *args, offload: bool = True, **kwargs) -> Any:
+        """
+        Runs `fn` (in a worker thread when offload=True, else awaited as a coroutine)
+        and records its duration under `stage`.
+        """
+        await self.check(stage)
+        started = time.perf_counter()
+        result = await asyncio.to_thread(fn, *args, **kwargs) if offload else await fn(*args, **kwargs)
+        self.timings[stage] = time.perf_counter() - started
+        self.metrics.record(stage, self.timings[stage])
+        return result
+
+    def finish(self) -> None:
+        self.metrics.completed += 1
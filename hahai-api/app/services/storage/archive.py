@@ -0,0 +1,331 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import gzip
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+from typing import IO, AsyncIterator, Callable
+
+from redis.asyncio.client import Redis
+
+from app.config import settings
+from app.db.keys import ALL_INTERNS_KEY, record_bucket, record_gradcam_key, record_key, record_xray_key
+from app.db.redis import queue_get_bytes
+from app.services import jobs
+from app.services.storage.images import queue_record_blobs
+from app.services.storage.indexes import scan_record_ids
+from app.services.storage.record_codec import decode_record, encode_record
+from app.services.storage.records import add_record_indexes
+from app.services.storage.versions import bump_record_versions
+from app.services.storage.usage import blob_sizes
+
+# Record archives are NDJSON (optionally gzipped):
+#
+#   line 1:  {"format": "hahai-records", "version": 1}
+#   line 2+: one record per line, metadata fields plus base64 "xray"/"gradcam"
+#
+# Import is idempotent per case_id, so an interrupted import can simply be
+# re-run (or resumed from the job checkpoint) without duplicating records.
+#
+# HTTP uploads are spooled to IMPORT_SPOOL_DIR under the job id and kept
+# until the import completes, so an interrupted or failed job can be resumed
+# (POST /records/import?resume=<job_id>) from its checkpoint_line without
+# uploading again. Spools of jobs that never completed are pruned once the
+# job hash itself has expired.
+
+ARCHIVE_FORMAT = "hahai-records"
+ARCHIVE_VERSION = 1
+
+RECORD_FIELDS = (
+    "case_id",
+    "student_id",
+    "notes",
+    "pred_label",
+    "pred_accuracy",
+    "created_at",
+    "saved_at",
+    "xray_content_type",
+    "gradcam_content_type",
+    "model_version",
+)
+
+
+SPOOL_PREFIX = "hahai-import-"
+
+# a "running" import whose job hash has not been updated for this long is
+# taken to have died with its worker and may be resumed
+IMPORT_STALE_SECONDS = 10 * 60
+
+
+class ArchiveFormatError(Exception):
+    pass
+
+
+def spool_dir() -> str:
+    return settings.IMPORT_SPOOL_DIR or tempfile.gettempdir()
+
+
+def spool_path(job_id: str) -> str:
+    return os.path.join(spool_dir(), f"{SPOOL_PREFIX}{job_id}.ndjson")
+
+
+def prune_spools(*, max_age_seconds: int | None = None) -> int:
+    """Removes spooled uploads older than the job TTL; returns how many."""
+    cutoff = time.time() - (max_age_seconds or settings.JOB_TTL_SECONDS)
+    removed = 0
+    try:
+        entries = list(os.scandir(spool_dir()))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.name.startswith(SPOOL_PREFIX):
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def archive_header() -> bytes:
+    return json.dumps({"format": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION}).encode() + b"\n"
+
+
+def check_archive_header(line: bytes) -> None:
+    try:
+        header = json.loads(line)
+    except ValueError:
+        raise ArchiveFormatError("Archive header is not valid JSON")
+    if not isinstance(header, dict) or header.get("format") != ARCHIVE_FORMAT:
+        raise ArchiveFormatError("Not a HaHAI record archive")
+    if header.get("version") != ARCHIVE_VERSION:
+        raise ArchiveFormatError(f"Unsupported archive version {header.get('version')}")
+
+
+def encode_archive_record(meta: dict, *, xray: bytes, gradcam: bytes) -> bytes:
+    entry = {k: meta[k] for k in RECORD_FIELDS if k in meta}
+    entry["xray"] = base64.b64encode(xray).decode("ascii")
+    entry["gradcam"] = base64.b64encode(gradcam).decode("ascii")
+    return json.dumps(entry, separators=(",", ":")).encode() + b"\n"
+
+
+def decode_archive_record(line: bytes) -> dict:
+    """
+    Returns {"meta": {...}, "xray": bytes, "gradcam": bytes}.
+    Raises ArchiveFormatError for anything that can't be stored as-is.
+    """
+    try:
+        entry = json.loads(line)
+        meta = {
+            "case_id": str(entry["case_id"]),
+            "student_id": str(entry["student_id"]),
+            "notes": str(entry.get("notes", "")),
+            "pred_label": str(entry["pred_label"]),
+            "pred_accuracy": float(entry["pred_accuracy"]),
+            "created_at": int(float(entry.get("created_at", 0))),
+            "xray_content_type": str(entry.get("xray_content_type", "image/jpeg")),
+            "gradcam_content_type": str(entry.get("gradcam_content_type", "image/png")),
+            "model_version": str(entry.get("model_version", "")),
+            "is_temp": "0",
+        }
+        if entry.get("saved_at") is not None:
+            meta["saved_at"] = int(float(entry["saved_at"]))
+        xray = base64.b64decode(entry["xray"], validate=True)
+        gradcam = base64.b64decode(entry.get("gradcam", ""), validate=True)
+        meta.update(blob_sizes(xray=xray, gradcam=gradcam))
+    except (ValueError, KeyError, TypeError) as e:
+        raise ArchiveFormatError(f"Invalid archive record: {e}")
+
+    if not meta["case_id"] or meta["case_id"].startswith("temp-"):
+        raise ArchiveFormatError(f"Invalid case_id {meta['case_id']!r}")
+    if not meta["student_id"]:
+        raise ArchiveFormatError(f"Record {meta['case_id']} has no student_id")
+    if not xray:
+        raise ArchiveFormatError(f"Record {meta['case_id']} has no xray image")
+
+    return {"meta": meta, "xray": xray, "gradcam": gradcam}
+
+
+def open_archive(path: str) -> IO[bytes]:
+    with open(path, "rb") as fh:
+        magic = fh.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rb")  # type:ignore
+    return open(path, "rb")
+
+
+def read_archive_header(path: str) -> None:
+    """Raises ArchiveFormatError unless `path` starts with a valid header. Blocking."""
+    with open_archive(path) as fh:
+        lines = _read_lines(fh, 1)
+    if not lines:
+        raise ArchiveFormatError("Archive is empty")
+    check_archive_header(lines[0])
+
+
+def _read_lines(fh: IO[bytes], n: int) -> list[bytes]:
+    lines: list[bytes] = []
+    for line in fh:
+        if line.strip():
+            lines.append(line)
+            if len(lines) >= n:
+                break
+    return lines
+
+
+async def import_archive_batch(
+    redis: Redis,
+    entries: list[dict],
+    *,
+    known_interns: set[str],
+) -> dict[str, int]:
+    """
+    Writes a batch of decoded archive entries: one EXISTS pass, then one
+    MULTI per key bucket with the blobs, metadata and indexes, so an
+    interrupted batch never exposes metadata without images.
+    """
+    counts = {"imported": 0, "skipped_existing": 0, "skipped_unknown_intern": 0}
+
+    candidates = []
+    for e in entries:
+        if e["meta"]["student_id"] not in known_interns:
+            counts["skipped_unknown_intern"] += 1
+        else:
+            candidates.append(e)
+    if not candidates:
+        return counts
+
+    pipe = redis.pipeline(transaction=False)
+    for e in candidates:
+        pipe.exists(record_key(e["meta"]["case_id"]))
+    exists = await pipe.execute()
+
+    to_write = [e for e, found in zip(candidates, exists) if not found]
+    counts["skipped_existing"] = len(candidates) - len(to_write)
+    if not to_write:
+        return counts
+
+    by_bucket: dict[int, list[dict]] = defaultdict(list)
+    for e in to_write:
+        by_bucket[record_bucket(e["meta"]["case_id"])].append(e)
+    for group in by_bucket.values():
+        pipe = redis.pipeline()
+        for e in group:
+            meta = e["meta"]
+            pipe.hset(record_key(meta["case_id"]), mapping=encode_record(meta))
+            queue_record_blobs(pipe, case_id=meta["case_id"], xray=e["xray"], gradcam=e["gradcam"])
+            add_record_indexes(pipe, meta)
+        await pipe.execute()
+    await bump_record_versions(redis, [e["meta"]["student_id"] for e in to_write])
+
+    counts["imported"] = len(to_write)
+    return counts
+
+
+async def import_archive_file(
+    redis: Redis,
+    path: str,
+    *,
+    job_id: str,
+    batch_size: int | None = None,
+    delete_after: bool = False,
+    on_progress: Callable[[dict[str, int]], None] | None = None,
+) -> dict:
+    """
+    Streams an archive file into Redis in pipelined batches, reporting
+    progress into job:{job_id}. If the job already has a checkpoint
+    (e.g. the previous run was interrupted), lines up to it are skipped.
+    With delete_after, the file is removed once the import has completed;
+    an interrupted or failed run keeps it for a resume.
+    """
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    job = await jobs.get_job(redis, job_id)
+    checkpoint = int(job.get("checkpoint_line", 0))
+
+    await jobs.update_job(redis, job_id, status="running")
+    try:
+        # Interns are validated once up front instead of per record
+        known_interns = set(await redis.smembers(ALL_INTERNS_KEY)) #type:ignore
+
+        with open_archive(path) as fh:
+            header = await asyncio.to_thread(_read_lines, fh, 1)
+            if not header:
+                raise ArchiveFormatError("Archive is empty")
+            check_archive_header(header[0])
+
+            line_no = 0
+            while True:
+                lines = await asyncio.to_thread(_read_lines, fh, batch_size)
+                if not lines:
+                    break
+
+                start = line_no
+                line_no += len(lines)
+                if line_no <= checkpoint:
+                    continue
+                lines = lines[max(0, checkpoint - start):]
+
+                entries, invalid = [], 0
+                for line in lines:
+                    try:
+                        entries.append(decode_archive_record(line))
+                    except ArchiveFormatError:
+                        invalid += 1
+
+                counts = await import_archive_batch(redis, entries, known_interns=known_interns)
+                counts["invalid"] = invalid
+                counts["lines_read"] = len(lines)
+                await jobs.update_job(redis, job_id, counters=counts, checkpoint_line=line_no)
+                if on_progress is not None:
+                    on_progress(counts)
+
+        await jobs.update_job(redis, job_id, status="completed")
+    except asyncio.CancelledError:
+        await jobs.update_job(redis, job_id, status="interrupted")
+        raise
+    except Exception as e:
+        await jobs.update_job(redis, job_id, status="failed", error=str(e))
+        raise
+
+    if delete_after:
+        try: os.remove(path)
+        except OSError: pass
+
+    return await jobs.get_job(redis, job_id)
+
+
+async def iter_archive_lines(
+    redis: Redis,
+    *,
+    page_size: int | None = None,
+) -> AsyncIterator[bytes]:
+    """
+    Yields an archive of all permanent records, one pipelined page at a time.
+    """
+    page_size = page_size or settings.IMPORT_BATCH_SIZE
+    yield archive_header()
+
+    async for page in scan_record_ids(redis, page_size=page_size):
+        async for line in _export_page(redis, page):
+            yield line
+
+
+async def _export_page(redis: Redis, case_ids: list[str]) -> AsyncIterator[bytes]:
+    # one round-trip per page: hashes decoded, blobs read as raw bytes
+    pipe = redis.pipeline(transaction=False)
+    for cid in case_ids:
+        pipe.hgetall(record_key(cid))
+        queue_get_bytes(pipe, record_xray_key(cid))
+        queue_get_bytes(pipe, record_gradcam_key(cid))
+    res = await pipe.execute()
+
+    for cid, meta, xray, gradcam in zip(case_ids, res[::3], res[1::3], res[2::3]):
+        if not meta or not xray:
+            continue
+        yield encode_archive_record(decode_record(meta, cid), xray=xray, gradcam=gradcam or b"")
@@ -2,24 +2,65 @@ from __future__ import annotations
 
 from redis.asyncio.client import Redis
 
-from app.db.keys import record_gradcam_key, record_xray_key
+from app.db.keys import record_blob_keys, record_embedding_key, record_gradcam_key, record_thumb_key, record_xray_key
+from app.db.redis import get_bytes
 
 
-async def save_xray(redis_bin: Redis, *, case_id: str, data: bytes) -> None:
-    await redis_bin.set(record_xray_key(case_id), data)
+def thumb_sizes_of(meta: dict) -> list[int]:
+    """
+    Thumbnail sizes stored for a record (meta field "thumb_sizes", e.g. "128,256").
+    """
+    raw = meta.get("thumb_sizes") or ""
+    if isinstance(raw, list):
+        return raw
+    return sorted(int(s) for s in raw.split(",") if s.strip().isdigit())
 
 
-async def save_gradcam(redis_bin: Redis, *, case_id: str, data: bytes) -> None:
-    await redis_bin.set(record_gradcam_key(case_id), data)
+def queue_record_blobs(
+    pipe,
+    *,
+    case_id: str,
+    xray: bytes,
+    gradcam: bytes,
+    xray_thumbs: dict[int, bytes] | None = None,
+    gradcam_thumbs: dict[int, bytes] | None = None,
+    embedding: bytes | None = None,
+    ttl_seconds: int | None = None,
+) -> None:
+    """
+    Queues the image writes of one record on `pipe`, so callers can put them
+    in the same MULTI as the record hash and its indexes.
+    """
+    pipe.set(record_xray_key(case_id), xray, ex=ttl_seconds)
+    pipe.set(record_gradcam_key(case_id), gradcam, ex=ttl_seconds)
+    for size, data in (xray_thumbs or {}).items():
+        pipe.set(record_thumb_key(case_id, "xray", size), data, ex=ttl_seconds)
+    for size, data in (gradcam_thumbs or {}).items():
+        pipe.set(record_thumb_key(case_id, "gradcam", size), data, ex=ttl_seconds)
+    if embedding:
+        pipe.set(record_embedding_key(case_id), embedding, ex=ttl_seconds)
 
 
-async def get_xray(redis_bin: Redis, *, case_id: str) -> bytes | None:
-    return await redis_bin.get(record_xray_key(case_id))
+async def _get_blob(redis: Redis, key: str, primary: Redis | None) -> bytes | None:
+    # `redis` may be a read replica; a blob it doesn't have yet comes from the primary
+    data = await get_bytes(redis, key)
+    if data is None and primary is not None and primary is not redis:
+        data = await get_bytes(primary, key)
+    return data
 
 
-async def get_gradcam(redis_bin: Redis, *, case_id: str) -> bytes | None:
-    return await redis_bin.get(record_gradcam_key(case_id))
+async def get_xray(redis: Redis, *, case_id: str, primary: Redis | None = None) -> bytes | None:
+    return await _get_blob(redis, record_xray_key(case_id), primary)
 
 
-async def delete_images(redis_bin: Redis, *, case_id: str) -> None:
-    await redis_bin.delete(record_xray_key(case_id), record_gradcam_key(case_id))
+async def get_gradcam(redis: Redis, *, case_id: str, primary: Redis | None = None) -> bytes | None:
+    return await _get_blob(redis, record_gradcam_key(case_id), primary)
+
+
+async def get_thumbnail(redis: Redis, *, case_id: str, kind: str, size: int, primary: Redis | None = None) -> bytes | None:
+    return await _get_blob(redis, record_thumb_key(case_id, kind, size), primary)
+
+
+async def delete_images(redis: Redis, *, case_id: str, thumb_sizes: list[int] | None = None) -> None:
+    # UNLINK: Redis frees large image values in a background thread
+    await redis.unlink(*record_blob_keys(case_id, thumb_sizes or []))
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import secrets
+from typing import AsyncIterator
+
+from redis.asyncio.client import Redis
+
+from app.db.keys import (
+    all_buckets,
+    intern_records_key,
+    query_tmp_key,
+    record_bucket,
+    record_key,
+    records_by_key,
+    records_key,
+    records_label_key,
+)
+from app.services.storage.record_codec import decode_record
+from app.services.storage.search import index_notes, merge_pages
+
+# Secondary indexes over permanent records, one set of keys per bucket
+# (see keys.py), next to the records they index:
+#   records:{b}:label:{pred_label}   set of case_ids
+#   records:{b}:by:pred_accuracy     zset, score = pred_accuracy
+#   records:{b}:by:created_at        zset, score = created_at
+#   records:{b}:by:saved_at          zset, score = saved_at (created_at for direct creates)
+#
+# Queries intersect these server-side in every bucket (one pipeline), and
+# the per-bucket pages are merged here, so their cost follows the size of
+# the filtered ranges and the requested page, not the number of stored
+# records.
+
+SORT_FIELDS = ("created_at", "saved_at", "pred_accuracy")
+
+
+class InvalidQueryError(Exception):
+    pass
+
+
+def _scores(record: dict) -> dict[str, float]:
+    created_at = float(record.get("created_at") or 0)
+    return {
+        "pred_accuracy": float(record.get("pred_accuracy") or 0.0),
+        "created_at": created_at,
+        "saved_at": float(record.get("saved_at") or created_at),
+    }
+
+
+def index_record(pipe, record: dict) -> None:
+    case_id = record["case_id"]
+    bucket = record_bucket(case_id)
+    if record.get("pred_label"):
+        pipe.sadd(records_label_key(record["pred_label"], bucket), case_id)
+    for field, score in _scores(record).items():
+        pipe.zadd(records_by_key(field, bucket), {case_id: score})
+
+
+def unindex_record(pipe, record: dict) -> None:
+    case_id = record["case_id"]
+    bucket = record_bucket(case_id)
+    if record.get("pred_label"):
+        pipe.srem(records_label_key(record["pred_label"], bucket), case_id)
+    for field in SORT_FIELDS:
+        pipe.zrem(records_by_key(field, bucket), case_id)
+
+
+def _bound(value: float | None, default: str) -> float | str:
+    return default if value is None else value
+
+
+async def query_record_ids(
+    redis: Redis,
+    *,
+    pred_label: str | None = None,
+    student_id: str | None = None,
+    ranges: dict[str, tuple[float | None, float | None]] | None = None,
+    sort_by: str = "created_at",
+    descending: bool = True,
+    offset: int = 0,
+    limit: int | None = None,
+) -> tuple[int, list[str]]:
+    """
+    Returns (total_matches, case_ids for the requested page).
+    `ranges` maps a sort field (see SORT_FIELDS) to an inclusive (min, max) score range.
+    """
+    if sort_by not in SORT_FIELDS:
+        raise InvalidQueryError(f"Unknown sort field {sort_by}")
+    ranges = {f: r for f, r in (ranges or {}).items() if r != (None, None)}
+    for field in ranges:
+        if field not in SORT_FIELDS:
+            raise InvalidQueryError(f"Unknown range field {field}")
+
+    # each bucket contributes at most offset+limit rows to the merged page
+    num = -1 if limit is None else max(offset + limit, 1)
+    stop = -1 if limit is None else num - 1
+    buckets = list(all_buckets())
+    pipe = redis.pipeline(transaction=False)
+
+    # Fast paths: no intersection needed, page straight off the sort indexes
+    if not pred_label and not student_id and not ranges:
+        for b in buckets:
+            pipe.zcard(records_by_key(sort_by, b))
+            pipe.zrange(records_by_key(sort_by, b), 0, stop, desc=descending, withscores=True)
+        res = await pipe.execute()
+        return sum(res[::2]), merge_pages(res[1::2], descending=descending, offset=offset, limit=limit)
+
+    if not pred_label and not student_id and list(ranges) == [sort_by]:
+        lo, hi = ranges[sort_by]
+        lo, hi = _bound(lo, "-inf"), _bound(hi, "+inf")
+        for b in buckets:
+            sort_key = records_by_key(sort_by, b)
+            pipe.zcount(sort_key, lo, hi)
+            if descending:
+                pipe.zrange(sort_key, hi, lo, byscore=True, desc=True, offset=0, num=num, withscores=True)
+            else:
+                pipe.zrange(sort_key, lo, hi, byscore=True, offset=0, num=num, withscores=True)
+        res = await pipe.execute()
+        return sum(res[::2]), merge_pages(res[1::2], descending=descending, offset=offset, limit=limit)
+
+    # General path, per bucket: materialize each range, then intersect
+    # everything with the sort index. Only the sort index has a non-zero
+    # weight, so the result is scored (and therefore ordered) by the sort field.
+    token = secrets.token_hex(8)
+    per_bucket = 0
+    for b in buckets:
+        tmp = query_tmp_key(token, b)
+        tmp_keys = [tmp]
+        weights: dict[str, float] = {records_by_key(sort_by, b): 1}
+        for field, (lo, hi) in ranges.items():
+            rkey = f"{tmp}:{field}"
+            tmp_keys.append(rkey)
+            pipe.zrangestore(rkey, records_by_key(field, b), _bound(lo, "-inf"), _bound(hi, "+inf"), byscore=True)
+            weights[rkey] = 0
+        if pred_label:
+            weights[records_label_key(pred_label, b)] = 0
+        if student_id:
+            weights[intern_records_key(student_id, b)] = 0
+
+        pipe.zinterstore(tmp, weights, aggregate="SUM")
+        pipe.zrange(tmp, 0, stop, desc=descending, withscores=True)
+        pipe.unlink(*tmp_keys)
+        per_bucket = len(ranges) + 3
+    res = await pipe.execute()
+
+    totals = res[per_bucket - 3::per_bucket]
+    pages = res[per_bucket - 2::per_bucket]
+    return sum(totals), merge_pages(pages, descending=descending, offset=offset, limit=limit)
+
+
+async def intern_record_ids(redis: Redis, student_id: str) -> list[str]:
+    """An intern's permanent case_ids (their per-bucket sets), sorted."""
+    pipe = redis.pipeline(transaction=False)
+    for b in all_buckets():
+        pipe.smembers(intern_records_key(student_id, b))
+    return sorted(set().union(*await pipe.execute()))
+
+
+async def scan_record_ids(redis: Redis, *, page_size: int = 500) -> AsyncIterator[list[str]]:
+    """All permanent case_ids, bucket by bucket, in pages of about `page_size`."""
+    page: list[str] = []
+    for b in all_buckets():
+        async for cid in redis.sscan_iter(records_key(b), count=page_size):
+            page.append(cid)
+            if len(page) >= page_size:
+                yield page
+                page = []
+    if page:
+        yield page
+
+
+async def rebuild_indexes(redis: Redis, *, page_size: int = 500) -> int:
+    """
+    (Re)adds every permanent record to the secondary and notes indexes. Safe to run
+    against a live instance; used to backfill records stored before the
+    indexes existed.
+    """
+    indexed = 0
+    async for case_ids in scan_record_ids(redis, page_size=page_size):
+        pipe = redis.pipeline(transaction=False)
+        for cid in case_ids:
+            pipe.hgetall(record_key(cid))
+        metas = await pipe.execute()
+
+        pipe = redis.pipeline(transaction=False)
+        for cid, data in zip(case_ids, metas):
+            record = decode_record(data, cid)
+            if record and record.get("is_temp") != "1":
+                index_record(pipe, record)
+                index_notes(pipe, record)
+                indexed += 1
+        await pipe.execute()
+    return indexed
@@ -1,8 +1,14 @@
 from __future__ import annotations
 
+import csv
+import io
+import json
+
 from redis.asyncio.client import Redis
 
-from app.db.keys import ALL_INTERNS_KEY, intern_key, intern_records_key
+from app.db.keys import ALL_INTERNS_KEY, INTERNS_VERSION_KEY, all_buckets, intern_key, intern_records_key, intern_records_version_key
+from app.services.storage.indexes import intern_record_ids
+from app.services.storage.versions import bump_versions
 
 
 class InternAlreadyExistsError(Exception):
@@ -17,67 +23,178 @@ class InternHasRecordsError(Exception):
     pass
 
 
-async def create_intern(redis: Redis, *, student_id: str, name: str, surname: str) -> None:
-    ikey = intern_key(student_id)
-    rkey = intern_records_key(student_id)
+class RosterFormatError(Exception):
+    pass
 
-    if await redis.exists(ikey):
-        raise InternAlreadyExistsError(f"Intern {student_id} already exists")
 
-    pipe = redis.pipeline()
-    pipe.hset(ikey, mapping={
+ROSTER_FIELDS = ("student_id", "name", "surname")
+
+
+def _queue_create_intern(pipe, *, student_id: str, name: str, surname: str) -> None:
+    # Hash first, then the listing: the two are in different hash slots, so
+    # they go in plain pipelines, and a reader never lists a missing intern.
+    # records:{b}:intern:{id} needs no pre-creation; it appears with the first record
+    pipe.hset(intern_key(student_id), mapping={
         "student_id": student_id,
         "name": name,
         "surname": surname,
     })
     pipe.sadd(ALL_INTERNS_KEY, student_id)
-    # ensure the set exists (optional; sets don't need pre-creation, but harmless)
-    pipe.sadd(rkey, "__init__")
-    pipe.srem(rkey, "__init__")
-    await pipe.execute()
 
 
-async def get_intern(redis: Redis, *, student_id: str) -> dict:
-    data = await redis.hgetall(intern_key(student_id)) #type:ignore
-    if not data:
-        raise InternNotFoundError(f"Intern {student_id} not found")
+async def create_intern(redis: Redis, *, student_id: str, name: str, surname: str) -> None:
+    if await redis.exists(intern_key(student_id)):
+        raise InternAlreadyExistsError(f"Intern {student_id} already exists")
+
+    pipe = redis.pipeline(transaction=False)
+    _queue_create_intern(pipe, student_id=student_id, name=name, surname=surname)
+    await pipe.execute()
+    await bump_versions(redis, INTERNS_VERSION_KEY)
 
-    record_ids = await redis.smembers(intern_records_key(student_id)) #type:ignore
 
+def parse_roster(data: bytes, *, filename: str = "", content_type: str = "") -> list[dict]:
+    """
+    Rows of a roster upload: a JSON list of {student_id, name, surname}
+    objects, or CSV with a student_id,name,surname header (comma or semicolon).
+    """
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise RosterFormatError("Roster must be UTF-8 encoded")
+
+    if filename.lower().endswith(".json") or "json" in content_type or text.lstrip().startswith("["):
+        try:
+            rows = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise RosterFormatError(f"Invalid JSON roster: {e}")
+        if not isinstance(rows, list):
+            raise RosterFormatError("JSON roster must be a list of objects")
+        return [r if isinstance(r, dict) else {} for r in rows]
+
+    try:
+        dialect = csv.Sniffer().sniff(text.splitlines()[0] if text else "", delimiters=",;")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+    header = [h.strip().lower() for h in reader.fieldnames or []]
+    missing = [f for f in ROSTER_FIELDS if f not in header]
+    if missing:
+        raise RosterFormatError(f"CSV roster is missing column(s): {', '.join(missing)}")
+    reader.fieldnames = header
+    return list(reader)
+
+
+async def create_interns_bulk(
+    redis: Redis,
+    rows: list[dict],
+    *,
+    batch_size: int = 500,
+    dry_run: bool = False,
+) -> list[dict]:
+    """
+    Validates a roster and creates its new interns: one pipelined EXISTS pass
+    for the whole roster, then one pipeline per batch of writes.
+    Returns one result per row (1-based `row`) with status created | exists |
+    duplicate | invalid (would_create instead of created on a dry run).
+    """
+    results: list[dict] = []
+    valid: list[tuple[dict, dict]] = []  # (result, cleaned row)
+    seen: set[str] = set()
+    for n, raw in enumerate(rows, start=1):
+        row = {f: str(raw.get(f) or "").strip() for f in ROSTER_FIELDS}
+        res = {"row": n, "student_id": row["student_id"]}
+        results.append(res)
+        empty = [f for f in ROSTER_FIELDS if not row[f]]
+        if empty:
+            res.update(status="invalid", error=f"Missing {', '.join(empty)}")
+        elif row["student_id"] in seen:
+            res.update(status="duplicate", error="student_id appears earlier in the roster")
+        else:
+            seen.add(row["student_id"])
+            valid.append((res, row))
+
+    if valid:
+        pipe = redis.pipeline(transaction=False)
+        for _, row in valid:
+            pipe.exists(intern_key(row["student_id"]))
+        exists = await pipe.execute()
+
+        to_create = []
+        for (res, row), found in zip(valid, exists):
+            if found:
+                res.update(status="exists", error=f"Intern {row['student_id']} already exists")
+            else:
+                res["status"] = "would_create" if dry_run else "created"
+                to_create.append(row)
+
+        if not dry_run:
+            for i in range(0, len(to_create), batch_size):
+                pipe = redis.pipeline(transaction=False)
+                for row in to_create[i:i + batch_size]:
+                    _queue_create_intern(pipe, **row)
+                await pipe.execute()
+                await bump_versions(redis, INTERNS_VERSION_KEY)
+
+    return results
+
+
+def _intern_out(student_id: str, data: dict, record_sets: list[set[str]]) -> dict:
     return {
         "student_id": data.get("student_id", student_id),
         "name": data.get("name", ""),
         "surname": data.get("surname", ""),
-        "patient_records": sorted(list(record_ids)),
+        "patient_records": sorted(set().union(*record_sets)),
     }
 
 
+async def get_intern(redis: Redis, *, student_id: str) -> dict:
+    data = await redis.hgetall(intern_key(student_id)) #type:ignore
+    if not data:
+        raise InternNotFoundError(f"Intern {student_id} not found")
+
+    return _intern_out(student_id, data, [set(await intern_record_ids(redis, student_id))])
+
+
 async def list_interns(redis: Redis) -> list[dict]:
+    """
+    Every intern with their case_ids: one pipeline for all the intern hashes
+    and their per-bucket record sets, whatever the roster size.
+    """
     ids = await redis.smembers(ALL_INTERNS_KEY) #type:ignore
     student_ids = sorted(list(ids))
+    if not student_ids:
+        return []
 
-    interns: list[dict] = []
+    buckets = all_buckets()
+    pipe = redis.pipeline(transaction=False)
     for sid in student_ids:
-        try:
-            interns.append(await get_intern(redis, student_id=sid))
-        except InternNotFoundError:
-            continue
+        pipe.hgetall(intern_key(sid))
+        for b in buckets:
+            pipe.smembers(intern_records_key(sid, b))
+    res = await pipe.execute()
+
+    interns: list[dict] = []
+    step = 1 + len(buckets)
+    for i, sid in enumerate(student_ids):
+        data, *record_sets = res[i * step:(i + 1) * step]
+        if data:  # listed but deleted meanwhile
+            interns.append(_intern_out(sid, data, record_sets))
     return interns
 
 
 async def delete_intern(redis: Redis, *, student_id: str) -> None:
     ikey = intern_key(student_id)
-    rkey = intern_records_key(student_id)
 
     if not await redis.exists(ikey):
         raise InternNotFoundError(f"Intern {student_id} not found")
 
-    record_ids = await redis.smembers(rkey) #type:ignore
-    if record_ids:
-        raise InternHasRecordsError(f"Intern {student_id} has patient records; delete records first")
+    if await intern_record_ids(redis, student_id):
+        raise InternHasRecordsError(f"Intern {student_id} has patient records; delete records first or purge via /admin/purge")
 
-    pipe = redis.pipeline()
-    pipe.delete(ikey)
-    pipe.delete(rkey)
+    pipe = redis.pipeline(transaction=False)
     pipe.srem(ALL_INTERNS_KEY, student_id)
-    await pipe.execute()
\ No newline at end of file
+    pipe.delete(ikey)
+    for b in all_buckets():
+        pipe.delete(intern_records_key(student_id, b))
+    await pipe.execute()
+    await bump_versions(redis, INTERNS_VERSION_KEY, intern_records_version_key(student_id))
\ No newline at end of file
@@ -0,0 +1,347 @@
+from __future__ import annotations
+
+from collections import defaultdict
+from typing import Callable
+
+from redis.asyncio.client import Redis
+from redis.exceptions import WatchError
+
+from app.db.keys import (
+    ALL_INTERNS_KEY,
+    MODELS_ACTIVE_KEY,
+    RECORD_KEY_PATTERN,
+    intern_key,
+    intern_records_key,
+    intern_sessions_key,
+    parse_legacy_record_key,
+    parse_record_key,
+    record_bucket,
+    record_embedding_key,
+    record_gradcam_key,
+    record_key,
+    record_thumb_key,
+    record_xray_key,
+    records_key,
+)
+from app.services.storage.indexes import rebuild_indexes
+from app.services.storage.record_codec import decode_record, encode_record, pick_fields, record_fields
+from app.services.storage.stats import rebuild_stats
+
+# Moves data into the current key layout (see keys.py), from either the old
+# untagged layout (record:{case_id}, intern:{id}:records, global `records`,
+# `records:by:*`, `notes:term:*`, `stats:*` ...) or a bucketed layout with
+# a different REDIS_KEY_BUCKETS. Meant to run with the API stopped.
+#
+#   1. record and intern keys are copied with DUMP/RESTORE under their new
+#      names (TTLs kept) and UNLINKed from the source; the source may be
+#      another server, e.g. the old standalone instance when moving to a
+#      cluster
+#   2. index, notes and aggregate keys are never copied: the target's are
+#      dropped and recomputed from the record hashes (bucket sets, then
+#      rebuild_indexes and rebuild_stats)
+#
+# Every step is idempotent, so an interrupted migration is simply re-run.
+# In-flight counters (intern:{id}:inflight) aren't moved; they expire.
+
+# Derived keys, recomputed from the record hashes after a migration
+INDEX_KEY_PATTERNS = ("records", "records:*", "notes:*", "stats:*", "tmp:query:*", "intern:*:records")
+
+
+def _record_key_for(case_id: str, kind: str) -> str:
+    if kind == "meta":
+        return record_key(case_id)
+    if kind == "xray":
+        return record_xray_key(case_id)
+    if kind == "gradcam":
+        return record_gradcam_key(case_id)
+    if kind == "embedding":
+        return record_embedding_key(case_id)
+    thumb_kind, size = kind.split(":")
+    return record_thumb_key(case_id, thumb_kind, int(size))
+
+
+def migrated_record_key(key: str) -> str:
+    """The current name of a record key from any supported layout."""
+    if key.startswith("record:{"):
+        return _record_key_for(*parse_record_key(key))
+    return _record_key_for(*parse_legacy_record_key(key))
+
+
+def _legacy_intern_key(student_id: str) -> str:
+    return f"intern:{student_id}"
+
+
+async def _copy_keys(source: Redis, target: Redis, pairs: list[tuple[str, str]], *, keep_source: bool) -> int:
+    """DUMP/RESTORE each (src, dst) pair, then drop the sources. Returns keys copied."""
+    if not pairs:
+        return 0
+    pipe = source.pipeline(transaction=False)
+    for src, _ in pairs:
+        pipe.dump(src)
+        pipe.pttl(src)
+    res = await pipe.execute()
+
+    copied = []
+    pipe = target.pipeline(transaction=False)
+    for (src, dst), data, pttl in zip(pairs, res[::2], res[1::2]):
+        if data is None or pttl == -2:
+            continue  # gone since the SCAN (expired temp record)
+        pipe.restore(dst, max(pttl, 0), data, replace=True)
+        copied.append(src)
+    if copied:
+        await pipe.execute()
+
+    if copied and not keep_source:
+        pipe = source.pipeline(transaction=False)
+        for src in copied:
+            pipe.unlink(src)
+        await pipe.execute()
+    return len(copied)
+
+
+async def _move_records(
+    source: Redis,
+    target: Redis,
+    *,
+    batch_size: int,
+    keep_source: bool,
+    dry_run: bool,
+    report: Callable[[dict[str, int]], None],
+) -> int:
+    same_server = source is target
+    moved = 0
+    batch: list[tuple[str, str]] = []
+
+    async def flush() -> None:
+        nonlocal moved
+        n = len(batch) if dry_run else await _copy_keys(source, target, batch, keep_source=keep_source)
+        moved += n
+        report({"record_keys_moved": n})
+        batch.clear()
+
+    async for key in source.scan_iter(match="record:*", count=batch_size):
+        dst = migrated_record_key(key)
+        if same_server and dst == key:
+            continue  # already in the current layout
+        batch.append((key, dst))
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+    return moved
+
+
+async def _move_interns(source: Redis, target: Redis, *, keep_source: bool, dry_run: bool) -> int:
+    same_server = source is target
+    student_ids = sorted(await source.smembers(ALL_INTERNS_KEY)) #type:ignore
+
+    pipe = source.pipeline(transaction=False)
+    for sid in student_ids:
+        pipe.exists(_legacy_intern_key(sid))
+        pipe.exists(f"{_legacy_intern_key(sid)}:sessions")
+    found = await pipe.execute()
+
+    pairs = []
+    for sid, has_hash, has_sessions in zip(student_ids, found[::2], found[1::2]):
+        if has_hash:
+            pairs.append((_legacy_intern_key(sid), intern_key(sid)))
+        if has_sessions:
+            pairs.append((f"{_legacy_intern_key(sid)}:sessions", intern_sessions_key(sid)))
+        if not same_server:
+            pairs.append((intern_key(sid), intern_key(sid)))
+            pairs.append((intern_sessions_key(sid), intern_sessions_key(sid)))
+
+    if not same_server:
+        # keys whose names didn't change still have to reach the new server
+        pairs.append((ALL_INTERNS_KEY, ALL_INTERNS_KEY))
+        pairs.append((MODELS_ACTIVE_KEY, MODELS_ACTIVE_KEY))
+        async for key in source.scan_iter(match="session:intern:*", count=500):
+            pairs.append((key, key))
+
+    if dry_run:
+        return len(pairs)
+    moved = 0
+    for i in range(0, len(pairs), 500):
+        moved += await _copy_keys(source, target, pairs[i:i + 500], keep_source=keep_source)
+    return moved
+
+
+async def drop_index_keys(redis: Redis, *, batch_size: int = 500) -> int:
+    """UNLINKs every derived key (any layout); the callers rebuild them."""
+    dropped = 0
+    for pattern in INDEX_KEY_PATTERNS:
+        batch: list[str] = []
+        async for key in redis.scan_iter(match=pattern, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                dropped += await redis.unlink(*batch)
+                batch = []
+        if batch:
+            dropped += await redis.unlink(*batch)
+    return dropped
+
+
+async def fill_record_sets(redis: Redis, *, batch_size: int = 500) -> int:
+    """
+    Adds every permanent record hash to records:{b} and its intern's
+    records:{b}:intern:{id}, the sets rebuild_indexes/rebuild_stats walk.
+    """
+    filled = 0
+
+    async def consume(case_ids: list[str]) -> None:
+        nonlocal filled
+        pipe = redis.pipeline(transaction=False)
+        for cid in case_ids:
+            pipe.hmget(record_key(cid), record_fields(("is_temp", "student_id")))
+        res = await pipe.execute()
+
+        pipe = redis.pipeline(transaction=False)
+        for cid, fields in zip(case_ids, res):
+            is_temp, student_id = pick_fields(fields, ("is_temp", "student_id"))
+            if is_temp != "1" and student_id:
+                bucket = record_bucket(cid)
+                pipe.sadd(records_key(bucket), cid)
+                pipe.sadd(intern_records_key(student_id, bucket), cid)
+                filled += 1
+        await pipe.execute()
+
+    batch: list[str] = []
+    async for key in redis.scan_iter(match=RECORD_KEY_PATTERN, count=batch_size):
+        case_id, kind = parse_record_key(key)
+        if kind != "meta":
+            continue
+        batch.append(case_id)
+        if len(batch) >= batch_size:
+            await consume(batch)
+            batch = []
+    if batch:
+        await consume(batch)
+    return filled
+
+
+async def migrate_keys(
+    source: Redis,
+    target: Redis,
+    *,
+    batch_size: int = 500,
+    keep_source: bool = False,
+    dry_run: bool = False,
+    on_progress: Callable[[dict[str, int]], None] | None = None,
+) -> dict:
+    """
+    Migrates `source` into the current layout on `target` (pass the same
+    client twice to migrate in place). With dry_run, only counts the keys
+    that would move.
+    """
+    report = on_progress or (lambda counts: None)
+
+    summary: dict = {
+        "intern_keys_moved": await _move_interns(source, target, keep_source=keep_source, dry_run=dry_run),
+        "record_keys_moved": await _move_records(
+            source, target,
+            batch_size=batch_size, keep_source=keep_source, dry_run=dry_run, report=report,
+        ),
+    }
+    if dry_run:
+        return summary
+
+    summary["index_keys_dropped"] = await drop_index_keys(target, batch_size=batch_size)
+    summary["records"] = await fill_record_sets(target, batch_size=batch_size)
+    summary["records_indexed"] = await rebuild_indexes(target, page_size=batch_size)
+    summary["stats"] = await rebuild_stats(target, page_size=batch_size)
+    return summary
+
+
+# Record hash encodings (see record_codec.py). Rewriting a hash is HSET of
+# the new fields plus HDEL of the old ones, never DEL + HSET, so temp
+# records keep their TTL. Each bucket's batch is one WATCHed MULTI; hashes
+# changed meanwhile (a save, a re-inference) are left for the next run,
+# which skips everything already converted. Safe with the API running.
+
+
+def _reencoded(case_id: str, data: dict, *, compact: bool) -> dict:
+    return {k: str(v) for k, v in encode_record(decode_record(data, case_id), compact=compact).items()}
+
+
+async def _reencode_batch(redis: Redis, case_ids: list[str], *, compact: bool) -> dict[str, int]:
+    counts = {"records_scanned": len(case_ids), "records_converted": 0, "conflicts": 0}
+    by_bucket: dict[int, list[str]] = defaultdict(list)
+    for cid in case_ids:
+        by_bucket[record_bucket(cid)].append(cid)
+
+    for group in by_bucket.values():
+        keys = [record_key(cid) for cid in group]
+        async with redis.pipeline() as pipe:
+            await pipe.watch(*keys)
+            read = redis.pipeline(transaction=False)
+            for key in keys:
+                read.hgetall(key)
+            stored = await read.execute()
+
+            pipe.multi()
+            converted = 0
+            for cid, key, data in zip(group, keys, stored):
+                if not data:
+                    continue  # removed since the SCAN
+                target = _reencoded(cid, data, compact=compact)
+                if target == data:
+                    continue
+                pipe.hset(key, mapping=target)
+                stale = [f for f in data if f not in target]
+                if stale:
+                    pipe.hdel(key, *stale)
+                converted += 1
+            if not converted:
+                continue
+            try:
+                await pipe.execute()
+            except WatchError:
+                counts["conflicts"] += converted
+                continue
+            counts["records_converted"] += converted
+    return counts
+
+
+async def reencode_records(
+    redis: Redis,
+    *,
+    compact: bool,
+    batch_size: int = 500,
+    dry_run: bool = False,
+    on_progress: Callable[[dict[str, int]], None] | None = None,
+) -> dict[str, int]:
+    """
+    Rewrites every record hash (temp records included) in the compact or
+    the legacy encoding. With dry_run, only counts the hashes that differ.
+    """
+    report = on_progress or (lambda counts: None)
+    totals = {"records_scanned": 0, "records_converted": 0, "conflicts": 0}
+
+    async def flush(batch: list[str]) -> None:
+        if dry_run:
+            pipe = redis.pipeline(transaction=False)
+            for cid in batch:
+                pipe.hgetall(record_key(cid))
+            differ = sum(
+                1 for cid, data in zip(batch, await pipe.execute())
+                if data and _reencoded(cid, data, compact=compact) != data
+            )
+            counts = {"records_scanned": len(batch), "records_converted": differ, "conflicts": 0}
+        else:
+            counts = await _reencode_batch(redis, batch, compact=compact)
+        for k, v in counts.items():
+            totals[k] += v
+        report(counts)
+
+    batch: list[str] = []
+    async for key in redis.scan_iter(match=RECORD_KEY_PATTERN, count=batch_size):
+        case_id, kind = parse_record_key(key)
+        if kind != "meta":
+            continue
+        batch.append(case_id)
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    return totals
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import asyncio
+
+from redis.asyncio.client import Redis
+
+from app.config import settings
+from app.db.keys import (
+    ALL_INTERNS_KEY,
+    INTERNS_VERSION_KEY,
+    STATS_INTERNS,
+    STORAGE_INTERNS,
+    all_buckets,
+    intern_key,
+    intern_records_key,
+    intern_records_version_key,
+    intern_session_key,
+    intern_sessions_key,
+    record_blob_keys,
+    record_bucket,
+    record_key,
+    records_by_key,
+    stats_key,
+)
+from app.services import jobs
+from app.services.storage.images import thumb_sizes_of
+from app.services.storage.indexes import intern_record_ids
+from app.services.storage.record_cache import queue_record_invalidation
+from app.services.storage.record_codec import decode_record
+from app.services.storage.records import remove_dangling_records, remove_record_indexes
+from app.services.storage.versions import bump_versions, record_version_keys
+
+# Cascade purge for end-of-term cleanup. Everything is deleted with UNLINK
+# in pipelined batches, so Redis frees the image blobs off its main thread
+# and other users never wait behind a large DEL.
+
+
+class NothingToPurgeError(Exception):
+    pass
+
+
+async def purge_record_batch(
+    redis: Redis,
+    case_ids: list[str],
+    *,
+    student_id: str | None = None,
+) -> int:
+    """
+    Removes a batch of records (metadata, indexes, aggregates, blobs) in
+    two round-trips. Returns how many record hashes were removed.
+    """
+    if not case_ids:
+        return 0
+
+    # HGETALL + UNLINK per record; as in delete_record, only the caller whose
+    # UNLINK removed the hash updates the indexes and aggregates.
+    pipe = redis.pipeline(transaction=False)
+    for cid in case_ids:
+        pipe.hgetall(record_key(cid))
+        pipe.unlink(record_key(cid))
+    res = await pipe.execute()
+
+    pipe = redis.pipeline(transaction=False)
+    removed = 0
+    owners: set[str] = set()
+    dangling: list[str] = []
+    for cid, data, gone in zip(case_ids, res[::2], res[1::2]):
+        data = decode_record(data, cid)
+        if gone:
+            pipe.unlink(*record_blob_keys(cid, thumb_sizes_of(data)))
+            removed += 1
+            if data.get("is_temp") != "1":
+                remove_record_indexes(pipe, data)
+                queue_record_invalidation(pipe, cid)
+                owners.add(data.get("student_id", ""))
+        else:
+            dangling.append(cid)  # index entry whose hash was already gone
+    await pipe.execute()
+    if owners:
+        await bump_versions(redis, *record_version_keys(owners))
+    if dangling:
+        # reads what to undo from the blobs, so those go after it
+        await remove_dangling_records(redis, dangling)
+        pipe = redis.pipeline(transaction=False)
+        for cid in dangling:
+            pipe.unlink(*record_blob_keys(cid, settings.THUMBNAIL_SIZES))
+            if student_id:  # not in records:{b} any more, but still in the intern's set
+                pipe.srem(intern_records_key(student_id, record_bucket(cid)), cid)
+        await pipe.execute()
+    return removed
+
+
+async def _purge_ids(
+    redis: Redis,
+    case_ids: list[str],
+    *,
+    student_id: str | None,
+    batch_size: int,
+    job_id: str | None,
+) -> int:
+    purged = 0
+    for i in range(0, len(case_ids), batch_size):
+        n = await purge_record_batch(redis, case_ids[i:i + batch_size], student_id=student_id)
+        purged += n
+        if job_id is not None:
+            await jobs.update_job(redis, job_id, counters={"records_purged": n})
+        await asyncio.sleep(0)  # let request handlers run between batches
+    return purged
+
+
+async def revoke_intern_sessions(redis: Redis, *, student_id: str) -> int:
+    tokens = await redis.smembers(intern_sessions_key(student_id)) #type:ignore
+    # one UNLINK per session: the session keys hash to different slots
+    pipe = redis.pipeline(transaction=False)
+    for t in tokens:
+        pipe.unlink(intern_session_key(t))
+    revoked = sum(await pipe.execute()) if tokens else 0
+    await redis.unlink(intern_sessions_key(student_id))
+    return revoked
+
+
+async def purge_intern(
+    redis: Redis,
+    *,
+    student_id: str,
+    batch_size: int | None = None,
+    job_id: str | None = None,
+) -> int:
+    """
+    Deletes an intern together with all of their records and sessions.
+    The intern hash goes first so no new logins or records can race the purge.
+    Returns the number of records removed.
+    """
+    batch_size = batch_size or settings.PURGE_BATCH_SIZE
+
+    pipe = redis.pipeline(transaction=False)
+    pipe.unlink(intern_key(student_id))
+    pipe.srem(ALL_INTERNS_KEY, student_id)
+    await pipe.execute()
+
+    revoked = await revoke_intern_sessions(redis, student_id=student_id)
+
+    case_ids = await intern_record_ids(redis, student_id)
+    purged = await _purge_ids(
+        redis, case_ids,
+        student_id=student_id, batch_size=batch_size, job_id=job_id,
+    )
+
+    pipe = redis.pipeline(transaction=False)
+    for b in all_buckets():
+        pipe.unlink(intern_records_key(student_id, b))
+        pipe.hdel(stats_key(STATS_INTERNS, b), student_id)
+        pipe.hdel(stats_key(STORAGE_INTERNS, b), student_id)
+    await pipe.execute()
+    await bump_versions(redis, INTERNS_VERSION_KEY, intern_records_version_key(student_id))
+
+    if job_id is not None:
+        await jobs.update_job(redis, job_id, counters={"interns_purged": 1, "sessions_revoked": revoked})
+    return purged
+
+
+async def resolve_interns(
+    redis: Redis,
+    *,
+    student_ids: list[str] | None = None,
+    student_id_prefix: str | None = None,
+) -> list[str]:
+    selected = set(student_ids or [])
+    if student_id_prefix:
+        all_ids = await redis.smembers(ALL_INTERNS_KEY) #type:ignore
+        selected |= {sid for sid in all_ids if sid.startswith(student_id_prefix)}
+    return sorted(selected)
+
+
+async def purge(
+    redis: Redis,
+    *,
+    student_ids: list[str] | None = None,
+    student_id_prefix: str | None = None,
+    created_from: float | None = None,
+    created_to: float | None = None,
+    job_id: str | None = None,
+    batch_size: int | None = None,
+) -> dict[str, int]:
+    """
+    Without a date range: cascade-deletes the selected interns (explicit ids
+    and/or a student_id prefix for a whole cohort) with all their records.
+    With a date range: deletes the records created in that range, limited to
+    the selected interns if any; interns themselves are kept.
+    """
+    batch_size = batch_size or settings.PURGE_BATCH_SIZE
+    interns = await resolve_interns(redis, student_ids=student_ids, student_id_prefix=student_id_prefix)
+    by_intern = bool(student_ids) or bool(student_id_prefix)
+    by_date = created_from is not None or created_to is not None
+
+    # an intern selector that matches nobody selects nothing; it must not
+    # fall through to "no intern filter" and widen a date-range purge
+    if not interns and (by_intern or not by_date):
+        raise NothingToPurgeError("No interns selected")
+
+    if not by_date:
+
+        pipe = redis.pipeline(transaction=False)
+        for sid in interns:
+            for b in all_buckets():
+                pipe.scard(intern_records_key(sid, b))
+        total = sum(await pipe.execute())
+        if job_id is not None:
+            await jobs.update_job(redis, job_id, status="running", records_total=total, interns_total=len(interns))
+
+        purged = 0
+        for sid in interns:
+            purged += await purge_intern(redis, student_id=sid, batch_size=batch_size, job_id=job_id)
+        return {"records_purged": purged, "interns_purged": len(interns)}
+
+    lo = "-inf" if created_from is None else created_from
+    hi = "+inf" if created_to is None else created_to
+    pipe = redis.pipeline(transaction=False)
+    for b in all_buckets():
+        pipe.zrange(records_by_key("created_at", b), lo, hi, byscore=True)
+    case_ids = sorted(cid for ids in await pipe.execute() for cid in ids)
+    if by_intern:
+        pipe = redis.pipeline(transaction=False)
+        for sid in interns:
+            for b in all_buckets():
+                pipe.smembers(intern_records_key(sid, b))
+        allowed = set().union(*await pipe.execute())
+        case_ids = [cid for cid in case_ids if cid in allowed]
+
+    if job_id is not None:
+        await jobs.update_job(redis, job_id, status="running", records_total=len(case_ids))
+
+    purged = await _purge_ids(redis, case_ids, student_id=None, batch_size=batch_size, job_id=job_id)
+    return {"records_purged": purged, "interns_purged": 0}
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from redis.asyncio.client import Redis
+
+from app.db.keys import RECORD_INVALIDATION_CHANNEL
+
+# Per-worker LRU cache for promoted record metadata. A record hash only
+# changes when a re-inference job rewrites its prediction, or disappears,
+# so the one thing to get right is those two paths: both publish the
+# case_id on records:invalidated, and each worker's listener drops it from
+# its cache.
+#
+# The cache only serves while the listener is subscribed; after a dropped
+# subscription it is cleared (deletes may have been missed) and stays off
+# until the listener is back. Temp records are never cached.
+#
+# With read replicas a removed record can still be on a lagging replica
+# after its invalidation arrived, so removed ids are remembered for
+# `hold_seconds`: they aren't cached again and are read from the primary
+# (records.get_record) until the replicas have caught up.
+
+logger = logging.getLogger(__name__)
+
+LISTEN_POLL_SECONDS = 5.0
+RECONNECT_DELAY_SECONDS = 1.0
+
+
+class RecordCache:
+    def __init__(self, max_entries: int, *, hold_seconds: float = 0):
+        self.max_entries = max(0, max_entries)
+        self.hold_seconds = hold_seconds
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._removed: OrderedDict[str, float] = OrderedDict()  # case_id -> hold expiry, oldest first
+        self.listening = False
+        # bumped on every invalidation; a read that started before one
+        # doesn't store its (possibly deleted) result
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.listening and self.max_entries > 0
+
+    def get(self, case_id: str) -> dict | None:
+        if not self.enabled or case_id.startswith("temp-"):
+            return None
+        record = self._entries.get(case_id)
+        if record is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(case_id)
+        self.hits += 1
+        return record
+
+    def recently_removed(self, case_id: str) -> bool:
+        expiry = self._removed.get(case_id)
+        return expiry is not None and expiry > time.monotonic()
+
+    def put(self, case_id: str, record: dict, *, generation: int) -> None:
+        if not self.enabled or generation != self.generation or case_id.startswith("temp-"):
+            return
+        if self.recently_removed(case_id):
+            return
+        self._entries[case_id] = record
+        self._entries.move_to_end(case_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *case_ids: str) -> None:
+        self.generation += 1
+        for cid in case_ids:
+            if self._entries.pop(cid, None) is not None:
+                self.invalidations += 1
+        if self.hold_seconds > 0:
+            now = time.monotonic()
+            while self._removed and next(iter(self._removed.values())) <= now:
+                self._removed.popitem(last=False)
+            for cid in case_ids:
+                self._removed.pop(cid, None)
+                self._removed[cid] = now + self.hold_seconds
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+
+    def snapshot(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "listening": self.listening,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "held_removed": len(self._removed),
+        }
+
+
+def queue_record_invalidation(pipe, *case_ids: str) -> None:
+    """
+    Queues the cache invalidation broadcast for removed records on `pipe`
+    (a non-transactional one: PUBLISH can't join a cluster MULTI).
+    """
+    for cid in case_ids:
+        pipe.publish(RECORD_INVALIDATION_CHANNEL, cid)
+
+
+async def publish_record_invalidation(redis: Redis, *case_ids: str) -> None:
+    """Broadcasts removed records, right after the MULTI that removed them."""
+    pipe = redis.pipeline(transaction=False)
+    queue_record_invalidation(pipe, *case_ids)
+    await pipe.execute()
+
+
+async def run_invalidation_listener(cache: RecordCache, redis: Redis) -> None:
+    """
+    Lifespan background loop: applies records:invalidated to this worker's
+    cache, resubscribing (with an empty cache) after connection errors.
+    """
+    while True:
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(RECORD_INVALIDATION_CHANNEL)
+            cache.clear()
+            cache.listening = True
+            while True:
+                msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=LISTEN_POLL_SECONDS)
+                if msg is not None and msg["type"] == "message":
+                    cache.invalidate(msg["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Record cache invalidation listener failed; reconnecting")
+        finally:
+            cache.listening = False
+            cache.clear()
+            await pubsub.aclose()
+        await asyncio.sleep(RECONNECT_DELAY_SECONDS)
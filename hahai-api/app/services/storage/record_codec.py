@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+from typing import Iterable
+
+from app.config import settings
+
+# Record hash encodings. Metadata is small next to the images, but every
+# record carries the same ~20 long field names and a handful of repeated
+# strings, which at listpack sizes is most of the hash:
+#
+#   legacy   field names as used in code ("pred_accuracy": "93.1", ...)
+#   compact  1-2 character field codes, enum codes for pred_label and the
+#            content types, no case_id (it is already in the key)
+#
+# Values stay strings Redis can HINCRBY/HMGET/partially update, so writers
+# that touch a few fields (promote, re-inference) keep working, and floats
+# are written exactly as before: the aggregates are keyed by the stored
+# values and must come out the same when a record is removed.
+#
+# decode_record accepts either format, or a mix of both, and returns the
+# legacy shape every other module works with. Writers pick the format with
+# RECORD_COMPACT_ENCODING, except partial updates, which follow the hash
+# they update (is_compact). Unknown fields pass through unchanged.
+
+FIELD_CODES = {
+    "student_id": "s",
+    "notes": "n",
+    "pred_label": "l",
+    "pred_accuracy": "a",
+    "created_at": "c",
+    "saved_at": "v",
+    "is_temp": "t",
+    "model_version": "m",
+    "xray_content_type": "xc",
+    "gradcam_content_type": "gc",
+    "thumb_content_type": "tc",
+    "thumb_sizes": "ts",
+    "xray_bytes": "xb",
+    "gradcam_bytes": "gb",
+    "thumb_bytes": "tb",
+    "prev_pred_label": "pl",
+    "prev_pred_accuracy": "pa",
+    "prev_model_version": "pm",
+    "reinferred_at": "r",
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+_LABELS = {"negative": "0", "positive": "1"}
+_CONTENT_TYPES = {"image/jpeg": "j", "image/png": "p", "image/webp": "w"}
+VALUE_CODES = {
+    "pred_label": _LABELS,
+    "prev_pred_label": _LABELS,
+    "xray_content_type": _CONTENT_TYPES,
+    "gradcam_content_type": _CONTENT_TYPES,
+    "thumb_content_type": _CONTENT_TYPES,
+}
+_VALUE_NAMES = {field: {code: value for value, code in codes.items()} for field, codes in VALUE_CODES.items()}
+
+
+def is_compact(data: dict) -> bool:
+    return any(k in FIELD_NAMES for k in data)
+
+
+def encode_record(fields: dict, *, compact: bool | None = None) -> dict:
+    """The HSET mapping for `fields` (legacy names) in the chosen format."""
+    if not (settings.RECORD_COMPACT_ENCODING if compact is None else compact):
+        return fields
+    out = {}
+    for name, value in fields.items():
+        if name == "case_id":
+            continue
+        codes = VALUE_CODES.get(name)
+        if codes is not None and isinstance(value, str):
+            value = codes.get(value, value)
+        out[FIELD_CODES.get(name, name)] = value
+    return out
+
+
+def decode_record(data: dict, case_id: str | None = None) -> dict:
+    """
+    A record hash (either format) with legacy field names and values, plus
+    `case_id` when given. An empty hash stays empty.
+    """
+    if not data:
+        return data
+    out = {}
+    for key, value in data.items():
+        name = FIELD_NAMES.get(key, key)
+        names = _VALUE_NAMES.get(name)
+        out[name] = names.get(value, value) if names is not None else value
+    if case_id is not None:
+        out["case_id"] = case_id
+    return out
+
+
+def record_fields(names: Iterable[str]) -> list[str]:
+    """HMGET field list that reads `names` from either format (see pick_fields)."""
+    names = list(names)
+    return names + [FIELD_CODES.get(n, n) for n in names]
+
+
+def pick_fields(values: list, names: Iterable[str]) -> list:
+    """Values of an HMGET of record_fields(names), one per name, decoded."""
+    names = list(names)
+    out = []
+    for name, legacy, compact in zip(names, values, values[len(names):]):
+        value = compact if compact is not None else legacy
+        codes = _VALUE_NAMES.get(name)
+        out.append(codes.get(value, value) if codes is not None and value is not None else value)
+    return out
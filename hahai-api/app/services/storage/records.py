@@ -1,14 +1,46 @@
 from __future__ import annotations
 
+import logging
 import time
-import uuid
 import secrets
+from collections import defaultdict
+from collections.abc import AsyncIterator
 
 from redis.asyncio.client import Redis
-
-from app.db.keys import ALL_RECORDS_KEY, intern_key, intern_records_key, record_key, record_xray_key, record_gradcam_key
-from app.services.storage.images import delete_images, save_gradcam, save_xray
-
+from redis.exceptions import WatchError
+
+from app.config import settings
+from app.db.keys import (
+    intern_key,
+    intern_records_key,
+    intern_wrote_key,
+    make_case_id,
+    record_bucket,
+    record_embedding_key,
+    record_gradcam_key,
+    notes_term_key,
+    record_key,
+    record_thumb_key,
+    record_xray_key,
+    records_by_key,
+    records_key,
+    records_label_key,
+)
+from app.db.redis import is_cluster
+from app.schemas.inference import PredictionLabel
+from app.services.storage.indexes import SORT_FIELDS, index_record, intern_record_ids, query_record_ids, scan_record_ids, unindex_record
+from app.services.storage.search import index_notes, search_record_ids, unindex_notes
+from app.services.storage.images import delete_images, queue_record_blobs, thumb_sizes_of
+from app.services.ml.similarity import publish_embeddings_added
+from app.services.storage.record_cache import RecordCache, publish_record_invalidation
+from app.services.storage.record_codec import decode_record, encode_record, is_compact
+from app.services.storage.stats import track_record_added, track_record_removed
+from app.services.storage.usage import blob_sizes, check_quota, record_bytes, track_storage_added, track_storage_removed
+from app.services.storage.versions import bump_record_versions
+
+logger = logging.getLogger(__name__)
+
+DANGLING_WATCH_RETRIES = 3
 
 class RecordNotFoundError(Exception):
     pass
@@ -18,9 +50,34 @@ class InternNotFoundForRecordError(Exception):
     pass
 
 
+def add_record_indexes(pipe, record: dict) -> None:
+    """
+    Queues the index and aggregate writes for a permanent record on a pipeline.
+    `record` is the record hash (case_id, student_id, pred_label, ...). All of
+    them go to the record's own key bucket, so they can share its MULTI.
+    """
+    bucket = record_bucket(record["case_id"])
+    pipe.sadd(records_key(bucket), record["case_id"])
+    pipe.sadd(intern_records_key(record["student_id"], bucket), record["case_id"])
+    index_record(pipe, record)
+    index_notes(pipe, record)
+    track_record_added(pipe, record)
+    track_storage_added(pipe, record)
+
+
+def remove_record_indexes(pipe, record: dict) -> None:
+    bucket = record_bucket(record["case_id"])
+    pipe.srem(records_key(bucket), record["case_id"])
+    if record.get("student_id"):
+        pipe.srem(intern_records_key(record["student_id"], bucket), record["case_id"])
+    unindex_record(pipe, record)
+    unindex_notes(pipe, record)
+    track_record_removed(pipe, record)
+    track_storage_removed(pipe, record)
+
+
 async def create_record(
-    redis: Redis,          # text client
-    redis_bin: Redis,      # binary client
+    redis: Redis,
     *,
     student_id: str,
     notes: str,
@@ -30,16 +87,15 @@ async def create_record(
     xray_content_type: str,
     gradcam_bytes: bytes,
     gradcam_content_type: str,
+    model_version: str = "",
 ) -> str:
     if not await redis.exists(intern_key(student_id)):
         raise InternNotFoundForRecordError(f"Intern {student_id} not found")
 
-    case_id = str(uuid.uuid4())
+    case_id = make_case_id()
     now = int(time.time())
 
-    # 1) write metadata + indexes (text)
-    pipe = redis.pipeline()
-    pipe.hset(record_key(case_id), mapping={
+    meta = {
         "case_id": case_id,
         "student_id": student_id,
         "notes": notes,
@@ -48,29 +104,35 @@ async def create_record(
         "created_at": now,
         "xray_content_type": xray_content_type,
         "gradcam_content_type": gradcam_content_type,
-    })
-    pipe.sadd(ALL_RECORDS_KEY, case_id)
-    pipe.sadd(intern_records_key(student_id), case_id)
-    await pipe.execute()
+        "model_version": model_version,
+        **blob_sizes(xray=xray_bytes, gradcam=gradcam_bytes),
+    }
 
-    # 2) write images (binary)
-    try:
-        await save_xray(redis_bin, case_id=case_id, data=xray_bytes)
-        await save_gradcam(redis_bin, case_id=case_id, data=gradcam_bytes)
-    except Exception:
-        # cleanup to avoid dangling metadata without images
-        await delete_record(redis, redis_bin, case_id=case_id)
-        raise
+    # MULTI: metadata, images and indexes land together or not at all
+    pipe = redis.pipeline()
+    pipe.hset(record_key(case_id), mapping=encode_record(meta))
+    queue_record_blobs(pipe, case_id=case_id, xray=xray_bytes, gradcam=gradcam_bytes)
+    add_record_indexes(pipe, meta)
+    await pipe.execute()
+    await bump_record_versions(redis, [student_id])
+    await mark_intern_wrote(redis, student_id)
 
     return case_id
 
 
-async def get_record(redis: Redis, *, case_id: str) -> dict:
-    data = await redis.hgetall(record_key(case_id)) #type:ignore
-    if not data:
-        raise RecordNotFoundError(f"Record {case_id} not found")
+async def mark_intern_wrote(redis: Redis, student_id: str) -> None:
+    """
+    With read replicas, sends the intern's reads to the primary for a few
+    seconds, so their next listing already has the record they just saved
+    (require_intern checks the marker).
+    """
+    if settings.REDIS_REPLICA_URLS:
+        await redis.set(intern_wrote_key(student_id), "1", ex=settings.REDIS_READ_YOUR_WRITES_SECONDS)
+
 
-    # Ensure types are nice (redis returns str for everything in decode_responses=True)
+def _record_from_hash(case_id: str, data: dict) -> dict:
+    # Ensure types are nice (redis returns str for everything in decode_responses=True);
+    # `data` is already decode_record()ed
     return {
         "case_id": data.get("case_id", case_id),
         "student_id": data.get("student_id", ""),
@@ -80,53 +142,218 @@ async def get_record(redis: Redis, *, case_id: str) -> dict:
         "created_at": int(float(data.get("created_at", 0))),
         "xray_content_type": data.get("xray_content_type", "image/png"),
         "gradcam_content_type": data.get("gradcam_content_type", "image/png"),
+        "thumb_sizes": thumb_sizes_of(data),
+        "thumb_content_type": data.get("thumb_content_type", ""),
+        "model_version": data.get("model_version", ""),
     }
 
 
-async def list_records(redis: Redis) -> list[dict]:
-    ids = await redis.smembers(ALL_RECORDS_KEY) #type:ignore
-    case_ids = sorted(list(ids))
+def _cache_record(cache: RecordCache | None, case_id: str, data: dict, record: dict, *, generation: int) -> None:
+    if cache is not None and data.get("is_temp") != "1":
+        cache.put(case_id, record, generation=generation)
+
+
+def _reads_primary(redis: Redis, primary: Redis | None) -> bool:
+    return primary is None or primary is redis
+
+
+async def get_record(
+    redis: Redis,
+    *,
+    case_id: str,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+) -> dict:
+    """
+    `redis` may be a read replica. A record it doesn't have yet (just saved)
+    is looked up on `primary`, and so is one removed moments ago.
+    """
+    if cache is not None and (record := cache.get(case_id)) is not None:
+        return record
+    generation = cache.generation if cache is not None else 0
+    if primary is not None and cache is not None and cache.recently_removed(case_id):
+        redis = primary
+    data = await redis.hgetall(record_key(case_id)) #type:ignore
+    if not data and not _reads_primary(redis, primary):
+        data = await primary.hgetall(record_key(case_id)) #type:ignore
+    if not data:
+        raise RecordNotFoundError(f"Record {case_id} not found")
+    data = decode_record(data)
+    record = _record_from_hash(case_id, data)
+    _cache_record(cache, case_id, data, record, generation=generation)
+    return record
+
 
-    out: list[dict] = []
+async def _hgetall_records(redis: Redis, case_ids: list[str]) -> list[dict]:
+    pipe = redis.pipeline(transaction=False)
     for cid in case_ids:
-        try:
-            out.append(await get_record(redis, case_id=cid))
-        except RecordNotFoundError:
-            continue
-    return out
+        pipe.hgetall(record_key(cid))
+    return await pipe.execute()
+
+
+async def get_records(
+    redis: Redis,
+    case_ids: list[str],
+    *,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+) -> list[dict]:
+    """
+    Pipelined get_record for a page of ids; missing records are skipped.
+    Only the ids not in `cache` are fetched; with a replica as `redis`, the
+    ones it doesn't have or that were just removed come from `primary`.
+    """
+    if not case_ids:
+        return []
+    found = {}
+    if cache is not None:
+        for cid in case_ids:
+            if (record := cache.get(cid)) is not None:
+                found[cid] = record
+    missing = [cid for cid in case_ids if cid not in found]
+    if missing:
+        generation = cache.generation if cache is not None else 0
+        rows = dict(zip(missing, await _hgetall_records(redis, missing)))
+        if not _reads_primary(redis, primary):
+            recheck = [cid for cid in missing if not rows[cid] or (cache is not None and cache.recently_removed(cid))]
+            if recheck:
+                rows.update(zip(recheck, await _hgetall_records(primary, recheck)))
+        for cid, data in rows.items():
+            if data:
+                data = decode_record(data)
+                found[cid] = _record_from_hash(cid, data)
+                _cache_record(cache, cid, data, found[cid], generation=generation)
+    return [found[cid] for cid in case_ids if cid in found]
+
+
+async def iter_records(
+    redis: Redis,
+    case_ids: list[str],
+    *,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+    page_size: int | None = None,
+) -> AsyncIterator[list[dict]]:
+    """
+    get_records in pages of RECORD_LIST_PAGE_SIZE, one pipelined round trip
+    each, so a large listing can be sent while the rest is still being read.
+    """
+    page_size = page_size or settings.RECORD_LIST_PAGE_SIZE
+    for i in range(0, len(case_ids), page_size):
+        yield await get_records(redis, case_ids[i:i + page_size], cache=cache, primary=primary)
 
 
-async def list_records_for_intern(redis: Redis, *, student_id: str) -> list[dict]:
+async def query_records(
+    redis: Redis,
+    *,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+    **filters,
+) -> tuple[int, list[dict]]:
+    """
+    Filtered, paged listing over the secondary indexes (see indexes.query_record_ids).
+    Returns (total_matches, records for the page).
+    """
+    total, case_ids = await query_record_ids(redis, **filters)
+    return total, await get_records(redis, case_ids, cache=cache, primary=primary)
+
+
+async def query_record_pages(
+    redis: Redis,
+    *,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+    **filters,
+) -> tuple[int, AsyncIterator[list[dict]]]:
+    """query_records with the matches read page by page (see iter_records)."""
+    total, case_ids = await query_record_ids(redis, **filters)
+    return total, iter_records(redis, case_ids, cache=cache, primary=primary)
+
+
+async def search_records(
+    redis: Redis,
+    *,
+    query: str,
+    offset: int = 0,
+    limit: int = 20,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+) -> tuple[int, list[dict]]:
+    """
+    Ranked full-text search over notes. Returns (total_matches, records for the page).
+    """
+    total, case_ids = await search_record_ids(redis, query, offset=offset, limit=limit)
+    return total, await get_records(redis, case_ids, cache=cache, primary=primary)
+
+
+async def iter_all_records(
+    redis: Redis,
+    *,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+) -> AsyncIterator[list[dict]]:
+    """Every permanent record, sorted by case_id, page by page (see iter_records)."""
+    ids = sorted([cid async for page in scan_record_ids(redis) for cid in page])
+    async for page in iter_records(redis, ids, cache=cache, primary=primary):
+        yield page
+
+
+async def list_records(redis: Redis, *, cache: RecordCache | None = None, primary: Redis | None = None) -> list[dict]:
+    return [r async for page in iter_all_records(redis, cache=cache, primary=primary) for r in page]
+
+
+async def iter_records_for_intern(
+    redis: Redis,
+    *,
+    student_id: str,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+) -> AsyncIterator[list[dict]]:
+    """
+    An intern's records page by page (see iter_records). Raises
+    InternNotFoundForRecordError on the first page.
+    """
     if not await redis.exists(intern_key(student_id)):
-        raise InternNotFoundForRecordError(f"Intern {student_id} not found")
+        if _reads_primary(redis, primary) or not await primary.exists(intern_key(student_id)):
+            raise InternNotFoundForRecordError(f"Intern {student_id} not found")
+        redis = primary  # created moments ago; the replica hasn't got it yet
 
-    ids = await redis.smembers(intern_records_key(student_id)) #type:ignore
-    case_ids = sorted(list(ids))
+    ids = await intern_record_ids(redis, student_id)
+    async for page in iter_records(redis, ids, cache=cache, primary=primary):
+        yield page
 
-    out: list[dict] = []
-    for cid in case_ids:
-        try:
-            out.append(await get_record(redis, case_id=cid))
-        except RecordNotFoundError:
-            continue
-    return out
 
+async def list_records_for_intern(
+    redis: Redis,
+    *,
+    student_id: str,
+    cache: RecordCache | None = None,
+    primary: Redis | None = None,
+) -> list[dict]:
+    pages = iter_records_for_intern(redis, student_id=student_id, cache=cache, primary=primary)
+    return [r async for page in pages for r in page]
 
-async def delete_record(redis: Redis, redis_bin: Redis, *, case_id: str) -> None:
-    data = await redis.hgetall(record_key(case_id)) #type:ignore
+
+async def delete_record(redis: Redis, *, case_id: str, cache: RecordCache | None = None) -> None:
+    data = decode_record(await redis.hgetall(record_key(case_id)), case_id) #type:ignore
     if not data:
         raise RecordNotFoundError(f"Record {case_id} not found")
 
-    student_id = data.get("student_id", "")
+    # Only the caller whose UNLINK actually removed the hash updates the
+    # indexes, so concurrent deletes can't decrement aggregates twice.
+    if not await redis.unlink(record_key(case_id)):
+        raise RecordNotFoundError(f"Record {case_id} not found")
 
-    pipe = redis.pipeline()
-    pipe.delete(record_key(case_id))
-    pipe.srem(ALL_RECORDS_KEY, case_id)
-    if student_id:
-        pipe.srem(intern_records_key(student_id), case_id)
-    await pipe.execute()
+    if cache is not None:
+        cache.invalidate(case_id)  # this worker at once, the others via pub/sub
+    if data.get("is_temp") != "1":
+        pipe = redis.pipeline()
+        remove_record_indexes(pipe, data)
+        await pipe.execute()
+        await bump_record_versions(redis, [data.get("student_id", "")])
+        await publish_record_invalidation(redis, case_id)
 
-    await delete_images(redis_bin, case_id=case_id)
+    await delete_images(redis, case_id=case_id, thumb_sizes=thumb_sizes_of(data))
 
 
 
@@ -140,14 +367,114 @@ class TempRecordInvalidError(Exception):
     pass
 
 
+async def _remove_dangling_in_bucket(redis: Redis, bucket: int, ids: list[str]) -> int:
+    intern_sets = [k async for k in redis.scan_iter(match=intern_records_key("*", bucket), count=500)]
+    term_keys = [k async for k in redis.scan_iter(match=notes_term_key("*", bucket), count=500)]
+    labels = [label.value for label in PredictionLabel]
+    sizes = settings.THUMBNAIL_SIZES
+
+    for _ in range(DANGLING_WATCH_RETRIES):
+        async with redis.pipeline() as pipe:
+            try:
+                await pipe.watch(records_key(bucket))
+                read = redis.pipeline(transaction=False)
+                read.smismember(records_key(bucket), ids)
+                for cid in ids:
+                    read.exists(record_key(cid))
+                for label in labels:
+                    read.smismember(records_label_key(label, bucket), ids)
+                for field in SORT_FIELDS:
+                    read.zmscore(records_by_key(field, bucket), ids)
+                for key in intern_sets:
+                    read.smismember(key, ids)
+                for cid in ids:
+                    read.strlen(record_xray_key(cid))
+                    read.strlen(record_gradcam_key(cid))
+                    for size in sizes:
+                        read.strlen(record_thumb_key(cid, "xray", size))
+                        read.strlen(record_thumb_key(cid, "gradcam", size))
+                res = await read.execute()
+
+                member, res = res[0], res[1:]
+                exists, res = res[:len(ids)], res[len(ids):]
+                in_label, res = res[:len(labels)], res[len(labels):]
+                scores, res = res[:len(SORT_FIELDS)], res[len(SORT_FIELDS):]
+                in_intern, blob_lens = res[:len(intern_sets)], res[len(intern_sets):]
+                per_record = 2 + 2 * len(sizes)
+
+                pipe.multi()
+                ghosts = []
+                for i, cid in enumerate(ids):
+                    if not member[i] or exists[i]:
+                        continue  # removed by its delete meanwhile, or not dangling after all
+                    xray, gradcam, *thumbs = blob_lens[i * per_record:(i + 1) * per_record]
+                    ghost = {
+                        "case_id": cid,
+                        "student_id": next((k.split(":intern:", 1)[1] for k, m in zip(intern_sets, in_intern) if m[i]), ""),
+                        "pred_label": next((label for label, m in zip(labels, in_label) if m[i]), ""),
+                        **{field: score[i] for field, score in zip(SORT_FIELDS, scores)},
+                        "xray_bytes": xray,
+                        "gradcam_bytes": gradcam,
+                        "thumb_bytes": sum(thumbs),
+                    }
+                    if ghost["created_at"] is not None:
+                        # fully indexed (one MULTI with the aggregates), so it was counted
+                        remove_record_indexes(pipe, ghost)
+                    else:
+                        pipe.srem(records_key(bucket), cid)
+                        if ghost["student_id"]:
+                            pipe.srem(intern_records_key(ghost["student_id"], bucket), cid)
+                        for field in SORT_FIELDS:
+                            pipe.zrem(records_by_key(field, bucket), cid)
+                        for label in labels:
+                            pipe.srem(records_label_key(label, bucket), cid)
+                    ghosts.append(ghost)
+                if not ghosts:
+                    return 0
+                gone = [g["case_id"] for g in ghosts]
+                for key in term_keys:  # their notes are gone with the hash, so every posting list
+                    pipe.zrem(key, *gone)
+                await pipe.execute()
+            except WatchError:
+                continue
+
+        for cid in gone:
+            await publish_record_invalidation(redis, cid)
+        await bump_record_versions(redis, {g["student_id"] for g in ghosts})
+        return len(ghosts)
+
+    logger.info("Bucket %s kept changing, its dangling ids are left for the next run", bucket)
+    return 0
+
+
+async def remove_dangling_records(redis: Redis, case_ids: list[str]) -> int:
+    """
+    Removes ids whose record hash is gone (deleted behind our back, evicted)
+    from records:{b} and everything built from them: indexes, intern sets,
+    notes postings and aggregates, one MULTI per bucket. The hash is gone,
+    so what to undo is read back from the indexes themselves (label sets,
+    sort scores, intern sets) and from whatever blobs are left; the storage
+    bytes of blobs that are gone too can only be fixed by `rebuild-stats`.
+    records:{b} is WATCHed: a delete or purge finishing its own index
+    removal meanwhile aborts the MULTI (it is retried), so nothing is
+    decremented twice. Returns the number removed.
+    """
+    by_bucket: dict[int, list[str]] = defaultdict(list)
+    for cid in case_ids:
+        by_bucket[record_bucket(cid)].append(cid)
+    removed = 0
+    for bucket, ids in by_bucket.items():
+        removed += await _remove_dangling_in_bucket(redis, bucket, ids)
+    return removed
+
+
 def make_temp_id() -> str:
     # “md5-looking” but random and cheap
     return "temp-" + secrets.token_hex(16)
 
 
 async def create_temp_record(
-    redis: Redis,         # text
-    redis_bin: Redis,     # binary
+    redis: Redis,
     *,
     student_id: str,
     pred_label: str,
@@ -156,12 +483,19 @@ async def create_temp_record(
     xray_content_type: str,
     gradcam_bytes: bytes,
     gradcam_content_type: str,
+    xray_thumbs: dict[int, bytes] | None = None,
+    gradcam_thumbs: dict[int, bytes] | None = None,
+    thumb_content_type: str = "",
+    embedding: bytes | None = None,
+    model_version: str = "",
     ttl_seconds: int = 10 * 60,
 ) -> str:
     """
-    Creates a temporary record under record:{temp_id} plus image keys:
-      record:{temp_id}:xray
-      record:{temp_id}:gradcam
+    Creates a temporary record under record:{b}:{temp_id} plus image keys:
+      record:{b}:{temp_id}:xray
+      record:{b}:{temp_id}:gradcam
+      record:{b}:{temp_id}:{xray|gradcam}:{size}   (optional thumbnails)
+      record:{b}:{temp_id}:embedding               (optional, float16 bytes)
     """
     if not await redis.exists(intern_key(student_id)):
         raise TempRecordInvalidError(f"Intern {student_id} not found")
@@ -169,8 +503,13 @@ async def create_temp_record(
     temp_id = make_temp_id()
     now = int(time.time())
 
-    # store meta (text)
-    await redis.hset(record_key(temp_id), mapping={ # type:ignore
+    xray_thumbs = xray_thumbs or {}
+    gradcam_thumbs = gradcam_thumbs or {}
+    thumb_sizes = sorted(set(xray_thumbs) & set(gradcam_thumbs))
+
+    # MULTI: meta and images with the same TTL, so none outlives the others
+    pipe = redis.pipeline()
+    pipe.hset(record_key(temp_id), mapping=encode_record({
         "case_id": temp_id,
         "student_id": student_id,
         "notes": "",  # not saved yet
@@ -180,24 +519,38 @@ async def create_temp_record(
         "is_temp": "1",
         "xray_content_type": xray_content_type,
         "gradcam_content_type": gradcam_content_type,
-    })
-    await redis.expire(record_key(temp_id), ttl_seconds)
-
-    # store images (binary)
-    await redis_bin.set(record_xray_key(temp_id), xray_bytes, ex=ttl_seconds)
-    await redis_bin.set(record_gradcam_key(temp_id), gradcam_bytes, ex=ttl_seconds)
+        "thumb_sizes": ",".join(str(s) for s in thumb_sizes),
+        "thumb_content_type": thumb_content_type,
+        "model_version": model_version,
+        **blob_sizes(
+            xray=xray_bytes,
+            gradcam=gradcam_bytes,
+            thumbs=[xray_thumbs[s] for s in thumb_sizes] + [gradcam_thumbs[s] for s in thumb_sizes],
+        ),
+    }))
+    pipe.expire(record_key(temp_id), ttl_seconds)
+    queue_record_blobs(
+        pipe,
+        case_id=temp_id,
+        xray=xray_bytes,
+        gradcam=gradcam_bytes,
+        xray_thumbs={s: xray_thumbs[s] for s in thumb_sizes},
+        gradcam_thumbs={s: gradcam_thumbs[s] for s in thumb_sizes},
+        embedding=embedding,
+        ttl_seconds=ttl_seconds,
+    )
+    await pipe.execute()
 
     return temp_id
 
 
 async def cancel_temp_record(
     redis: Redis,
-    redis_bin: Redis,
     *,
     temp_id: str,
     student_id: str,
 ) -> None:
-    meta = await redis.hgetall(record_key(temp_id)) # type:ignore
+    meta = decode_record(await redis.hgetall(record_key(temp_id))) # type:ignore
     if not meta:
         return
 
@@ -205,96 +558,128 @@ async def cancel_temp_record(
         raise TempRecordOwnershipError("Not your temp record")
 
     # delete meta + images
-    await redis.delete(record_key(temp_id))
-    await redis_bin.delete(record_xray_key(temp_id), record_gradcam_key(temp_id))
+    await redis.unlink(record_key(temp_id))
+    await delete_images(redis, case_id=temp_id, thumb_sizes=thumb_sizes_of(meta))
 
 
 async def promote_temp_record(
     redis: Redis,
-    redis_bin: Redis,
     *,
     temp_id: str,
     student_id: str,
     notes: str,
 ) -> str:
     """
-    Promote:
-      record:{temp_id}           -> record:{case_id}
-      record:{temp_id}:xray      -> record:{case_id}:xray
-      record:{temp_id}:gradcam   -> record:{case_id}:gradcam
-
-    Then:
+    Promote, in one MULTI (the new case_id is drawn from the temp id's key
+    bucket, so every key involved is in one hash slot):
+      record:{b}:{temp_id}           -> record:{b}:{case_id}
+      record:{b}:{temp_id}:xray      -> record:{b}:{case_id}:xray
+      record:{b}:{temp_id}:gradcam   -> record:{b}:{case_id}:gradcam
+      thumbnails (best effort; a missing one falls back to the full image)
+      embedding, if any (announced to the similarity indexes afterwards)
       - persist (remove TTL)
       - set notes, case_id, is_temp
-      - add indexes (records set + intern:{id}:records)
+      - add indexes (records:{b} + records:{b}:intern:{id}, ...)
+
+    The temp keys are WATCHed while they are checked, so a concurrent save,
+    cancel or expiry makes the transaction abort instead of half-applying.
     """
     meta_key = record_key(temp_id)
-    meta = await redis.hgetall(meta_key) # type:ignore
-    if not meta:
-        raise TempRecordNotFoundError("Temp record not found")
-
-    if meta.get("student_id") != student_id:
-        raise TempRecordOwnershipError("Not your temp record")
-
-    if meta.get("is_temp") != "1" or not temp_id.startswith("temp-"):
-        raise TempRecordInvalidError("Not a temp record")
-
-    # Ensure temp images exist
-    if not await redis_bin.exists(record_xray_key(temp_id)):
-        raise TempRecordInvalidError("Temp xray image missing")
-    if not await redis_bin.exists(record_gradcam_key(temp_id)):
-        raise TempRecordInvalidError("Temp gradcam image missing")
-
-    case_id = str(uuid.uuid4())
-
-    # Rename images first (binary), then meta (text). Roll back if meta rename fails.
     xray_src = record_xray_key(temp_id)
     grad_src = record_gradcam_key(temp_id)
-    xray_dst = record_xray_key(case_id)
-    grad_dst = record_gradcam_key(case_id)
-
-    meta_dst = record_key(case_id)
-
-    # RENAMENX prevents overwriting if something crazy collides
-    ok1 = await redis_bin.renamenx(xray_src, xray_dst)
-    ok2 = await redis_bin.renamenx(grad_src, grad_dst)
-    if not ok1 or not ok2:
-        # attempt rollback if partial
-        if ok1 and not await redis_bin.exists(xray_src):
-            try: await redis_bin.renamenx(xray_dst, xray_src)
-            except Exception: pass
-        if ok2 and not await redis_bin.exists(grad_src):
-            try: await redis_bin.renamenx(grad_dst, grad_src)
-            except Exception: pass
-        raise TempRecordInvalidError("Failed renaming temp image keys")
-
-    ok_meta = await redis.renamenx(meta_key, meta_dst)
-    if not ok_meta:
-        # rollback images back to temp
-        try: await redis_bin.renamenx(xray_dst, xray_src)
-        except Exception: pass
-        try: await redis_bin.renamenx(grad_dst, grad_src)
-        except Exception: pass
-        raise TempRecordInvalidError("Failed promoting temp meta key")
-
-    # Now finalize the record hash
-    now = int(time.time())
-    await redis.hset(meta_dst, mapping={ # type:ignore
-        "case_id": case_id,
-        "notes": notes,
-        "is_temp": "0",
-        "saved_at": now,
-    })
-
-    # Remove TTLs so the final record persists
-    await redis.persist(meta_dst)
-    await redis_bin.persist(xray_dst)
-    await redis_bin.persist(grad_dst)
 
-    # Add indexes
-    pipe = redis.pipeline()
-    pipe.sadd(ALL_RECORDS_KEY, case_id)
-    pipe.sadd(intern_records_key(student_id), case_id)
-    await pipe.execute()
+    # purge_intern deletes the intern hash before it lists their records, so
+    # a save in flight must not commit once the hash is gone. The hash is
+    # WATCHed with the temp keys; a cluster transaction can't span its slot,
+    # so there it is checked again after EXEC and the record taken back out.
+    watch_intern = not is_cluster(redis)
+
+    async with redis.pipeline() as pipe:
+        await pipe.watch(meta_key, xray_src, grad_src, *([intern_key(student_id)] if watch_intern else []))
+        stored = await pipe.hgetall(meta_key) # type:ignore
+        if not stored:
+            raise TempRecordNotFoundError("Temp record not found")
+        meta = decode_record(stored, temp_id)
+
+        if meta.get("student_id") != student_id:
+            raise TempRecordOwnershipError("Not your temp record")
+
+        if meta.get("is_temp") != "1" or not temp_id.startswith("temp-"):
+            raise TempRecordInvalidError("Not a temp record")
+
+        if not await (pipe if watch_intern else redis).exists(intern_key(student_id)):
+            raise InternNotFoundForRecordError(f"Intern {student_id} not found")
+
+        await check_quota(
+            redis,
+            student_id=student_id,
+            incoming=record_bytes(meta),
+            per_intern_quota=settings.STORAGE_QUOTA_PER_INTERN_BYTES,
+            total_quota=settings.STORAGE_QUOTA_TOTAL_BYTES,
+        )
+
+        # Ensure temp images exist
+        if not await pipe.exists(xray_src):
+            raise TempRecordInvalidError("Temp xray image missing")
+        if not await pipe.exists(grad_src):
+            raise TempRecordInvalidError("Temp gradcam image missing")
+
+        # Thumbnails are derived data: move what's there, drop what isn't
+        thumb_sizes = thumb_sizes_of(meta)
+        kept = []
+        for size in thumb_sizes:
+            pair = [record_thumb_key(temp_id, kind, size) for kind in ("xray", "gradcam")]
+            if await pipe.exists(*pair) == 2:
+                kept.append(size)
+        if kept != thumb_sizes:
+            meta["thumb_bytes"] = 0
+            for size in kept:
+                meta["thumb_bytes"] += await pipe.strlen(record_thumb_key(temp_id, "xray", size))
+                meta["thumb_bytes"] += await pipe.strlen(record_thumb_key(temp_id, "gradcam", size))
+
+        has_embedding = bool(await pipe.exists(record_embedding_key(temp_id)))
+
+        case_id = make_case_id(record_bucket(temp_id))
+        moves = [(meta_key, record_key(case_id)), (xray_src, record_xray_key(case_id)), (grad_src, record_gradcam_key(case_id))]
+        if has_embedding:
+            moves.append((record_embedding_key(temp_id), record_embedding_key(case_id)))
+        for size in kept:
+            for kind in ("xray", "gradcam"):
+                moves.append((record_thumb_key(temp_id, kind, size), record_thumb_key(case_id, kind, size)))
+
+        now = int(time.time())
+        final = {
+            "case_id": case_id,
+            "notes": notes,
+            "is_temp": "0",
+            "saved_at": now,
+            "thumb_sizes": ",".join(str(s) for s in kept),
+            "thumb_bytes": int(meta.get("thumb_bytes") or 0),
+        }
+
+        pipe.multi()
+        for src, dst in moves:
+            pipe.rename(src, dst)
+            pipe.persist(dst)
+        pipe.hset(record_key(case_id), mapping=encode_record(final, compact=is_compact(stored)))
+        add_record_indexes(pipe, {**meta, **final})
+        try:
+            await pipe.execute()
+        except WatchError:
+            if watch_intern and not await redis.exists(intern_key(student_id)):
+                raise InternNotFoundForRecordError(f"Intern {student_id} not found")
+            raise TempRecordInvalidError("Temp record changed while saving, try again")
+
+    if not watch_intern and not await redis.exists(intern_key(student_id)):
+        # purged after the check above; its record listing may have missed this one
+        try:
+            await delete_record(redis, case_id=case_id)
+        except RecordNotFoundError:
+            pass
+        raise InternNotFoundForRecordError(f"Intern {student_id} not found")
 
+    await bump_record_versions(redis, [student_id])
+    await mark_intern_wrote(redis, student_id)
+    if has_embedding:
+        await publish_embeddings_added(redis, case_id)
     return case_id
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import heapq
+import math
+import re
+import secrets
+import unicodedata
+from collections import Counter
+
+from redis.asyncio.client import Redis
+
+from app.db.keys import STATS_TOTALS, all_buckets, notes_term_key, query_tmp_key, record_bucket, stats_key
+
+# Inverted index over record notes: notes:{b}:term:{term} is a zset of
+# case_id -> weighted term frequency, per key bucket. Queries AND all terms
+# together and rank by tf-idf, touching only the posting lists of the query
+# terms; document frequencies are summed over the buckets so scores are
+# comparable when the per-bucket pages are merged.
+#
+# Normalization targets the languages interns write in (Serbian, Latin or
+# Cyrillic, and English): lowercase, Cyrillic -> Latin, diacritics folded,
+# stopwords dropped and a light suffix stemmer applied.
+
+_CYR_TO_LAT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "ђ": "dj", "е": "e", "ж": "z",
+    "з": "z", "и": "i", "ј": "j", "к": "k", "л": "l", "љ": "lj", "м": "m", "н": "n",
+    "њ": "nj", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t", "ћ": "c", "у": "u",
+    "ф": "f", "х": "h", "ц": "c", "ч": "c", "џ": "dz", "ш": "s",
+}
+_SPECIAL = {"đ": "dj", "ß": "ss", "æ": "ae", "ø": "o"}
+
+_STOPWORDS = frozenset({
+    # en
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "in", "is", "it",
+    "of", "on", "or", "the", "to", "was", "with",
+    # sr
+    "i", "u", "na", "je", "sa", "se", "od", "za", "da", "su", "ili", "kao", "ali", "to",
+})
+
+# Longest suffix first; a suffix is only stripped if a stem of MIN_STEM chars remains
+_SUFFIXES = sorted({
+    # en
+    "ations", "ation", "ingly", "edly", "ness", "ment", "ing", "ies", "ed", "es", "ly", "s",
+    # sr (noun/adjective case endings)
+    "ovima", "evima", "ama", "ima", "oga", "ome", "omu", "ega", "emu", "ih", "im",
+    "om", "em", "og", "oj", "a", "e", "i", "o", "u",
+}, key=len, reverse=True)
+MIN_STEM = 4
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def normalize(text: str) -> str:
+    text = text.lower()
+    text = "".join(_CYR_TO_LAT.get(ch, _SPECIAL.get(ch, ch)) for ch in text)
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def stem(token: str) -> str:
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= MIN_STEM:
+            return token[: -len(suffix)]
+    return token
+
+
+def tokenize(text: str) -> list[str]:
+    return [
+        stem(tok)
+        for tok in _TOKEN_RE.findall(normalize(text or ""))
+        if len(tok) > 1 and tok not in _STOPWORDS
+    ]
+
+
+def _term_weights(notes: str) -> dict[str, float]:
+    return {term: 1.0 + math.log(tf) for term, tf in Counter(tokenize(notes)).items()}
+
+
+def index_notes(pipe, record: dict) -> None:
+    case_id = record["case_id"]
+    bucket = record_bucket(case_id)
+    for term, weight in _term_weights(record.get("notes", "")).items():
+        pipe.zadd(notes_term_key(term, bucket), {case_id: weight})
+
+
+def unindex_notes(pipe, record: dict) -> None:
+    case_id = record["case_id"]
+    bucket = record_bucket(case_id)
+    for term in _term_weights(record.get("notes", "")):
+        pipe.zrem(notes_term_key(term, bucket), case_id)
+
+
+def merge_pages(
+    pages: list[list[tuple[str, float]]],
+    *,
+    descending: bool,
+    offset: int,
+    limit: int | None,
+) -> list[str]:
+    """
+    Merges per-bucket (member, score) pages, each already in Redis order
+    (score, then member), and cuts the requested window out of the result.
+    """
+    merged = heapq.merge(*pages, key=lambda ms: (ms[1], ms[0]), reverse=descending)
+    stop = None if limit is None else offset + limit
+    out = []
+    for i, (member, _score) in enumerate(merged):
+        if stop is not None and i >= stop:
+            break
+        if i >= offset:
+            out.append(member)
+    return out
+
+
+async def search_record_ids(
+    redis: Redis,
+    query: str,
+    *,
+    offset: int = 0,
+    limit: int = 20,
+) -> tuple[int, list[str]]:
+    """
+    Returns (total_matches, case_ids ranked by relevance) for records whose
+    notes contain every term of `query`.
+    """
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return 0, []
+    buckets = list(all_buckets())
+
+    pipe = redis.pipeline(transaction=False)
+    for b in buckets:
+        pipe.hget(stats_key(STATS_TOTALS, b), "records")
+        for term in terms:
+            pipe.zcard(notes_term_key(term, b))
+    res = await pipe.execute()
+    per_bucket = [res[i:i + len(terms) + 1] for i in range(0, len(res), len(terms) + 1)]
+    n_docs = sum(int(r[0] or 0) for r in per_bucket)
+    dfs = [sum(r[1 + t] for r in per_bucket) for t in range(len(terms))]
+    if not all(dfs):
+        return 0, []
+
+    n = max(n_docs, max(dfs))
+    idf = {term: math.log(1.0 + n / df) for term, df in zip(terms, dfs)}
+    # buckets missing any of the terms can't match
+    hit = [b for b, r in zip(buckets, per_bucket) if all(r[1:])]
+    stop = offset + limit - 1
+
+    if len(terms) == 1:
+        pipe = redis.pipeline(transaction=False)
+        for b in hit:
+            pipe.zrange(notes_term_key(terms[0], b), 0, stop, desc=True, withscores=True)
+        pages = await pipe.execute()
+        total = sum(r[1] for r in per_bucket)
+        return total, merge_pages(pages, descending=True, offset=offset, limit=limit)
+
+    token = secrets.token_hex(8)
+    pipe = redis.pipeline(transaction=False)
+    for b in hit:
+        tmp = query_tmp_key(token, b)
+        pipe.zinterstore(tmp, {notes_term_key(term, b): w for term, w in idf.items()}, aggregate="SUM")
+        pipe.zrange(tmp, 0, stop, desc=True, withscores=True)
+        pipe.unlink(tmp)
+    res = await pipe.execute()
+    return sum(res[::3]), merge_pages(res[1::3], descending=True, offset=offset, limit=limit)
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import time
+from collections import Counter, defaultdict
+
+from redis.asyncio.client import Redis
+
+from app.db.keys import (
+    STATS_CONFIDENCE,
+    STATS_DAILY,
+    STATS_INTERNS,
+    STATS_TOTALS,
+    STORAGE_INTERNS,
+    STORAGE_TOTALS,
+    all_buckets,
+    record_bucket,
+    record_key,
+    stats_key,
+)
+from app.services.storage.indexes import scan_record_ids
+from app.services.storage.record_codec import decode_record, encode_record, is_compact
+from app.services.storage.usage import SIZE_FIELDS, measure_blob_sizes, storage_fields, sum_bucket_hashes
+
+# Aggregates maintained at write time so admin dashboards never have to
+# walk every record. Each key bucket keeps its own counters next to its
+# records (so they stay in the record's MULTI); readers sum the buckets:
+#   stats:{b}:totals      records, label:{pred_label}
+#   stats:{b}:interns     {student_id} -> record count
+#   stats:{b}:confidence  {range} -> record count (10-point pred_accuracy ranges)
+#   stats:{b}:daily       {YYYY-MM-DD} -> records saved that day (UTC)
+
+STATS_NAMES = (STATS_TOTALS, STATS_INTERNS, STATS_CONFIDENCE, STATS_DAILY)
+STORAGE_NAMES = (STORAGE_TOTALS, STORAGE_INTERNS)
+
+
+def confidence_bucket(pred_accuracy: float) -> str:
+    lo = min(max(int(float(pred_accuracy) // 10) * 10, 0), 90)
+    return f"{lo}-{lo + 10}"
+
+
+def _day(ts: int | float | str) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(int(float(ts))))
+
+
+def _stat_fields(record: dict) -> list[tuple[str, str]]:
+    ts = record.get("saved_at") or record.get("created_at") or 0
+    bucket = record_bucket(record["case_id"])
+    return [
+        (stats_key(STATS_TOTALS, bucket), "records"),
+        (stats_key(STATS_TOTALS, bucket), f"label:{record.get('pred_label', '')}"),
+        (stats_key(STATS_INTERNS, bucket), str(record.get("student_id", ""))),
+        (stats_key(STATS_CONFIDENCE, bucket), confidence_bucket(record.get("pred_accuracy", 0.0))),
+        (stats_key(STATS_DAILY, bucket), _day(ts)),
+    ]
+
+
+def track_record_added(pipe, record: dict) -> None:
+    for key, field in _stat_fields(record):
+        pipe.hincrby(key, field, 1)
+
+
+def track_record_removed(pipe, record: dict) -> None:
+    for key, field in _stat_fields(record):
+        pipe.hincrby(key, field, -1)
+
+
+def _ints(data: dict) -> dict[str, int]:
+    return {k: int(v) for k, v in data.items() if int(v) > 0}
+
+
+async def get_stats(redis: Redis) -> dict:
+    totals, per_intern, confidence, daily = [_ints(d) for d in await sum_bucket_hashes(redis, STATS_NAMES)]
+
+    return {
+        "total_records": totals.get("records", 0),
+        "per_label": {k[len("label:"):]: v for k, v in totals.items() if k.startswith("label:")},
+        "per_intern": per_intern,
+        "confidence_buckets": dict(sorted(confidence.items(), key=lambda kv: int(kv[0].split("-")[0]))),
+        "per_day": dict(sorted(daily.items())),
+    }
+
+
+async def rebuild_stats(redis: Redis, *, page_size: int = 500) -> dict:
+    """
+    Recomputes all aggregates (including storage accounting) from the record
+    hashes and swaps them in atomically. Records stored before size tracking
+    get their blob sizes measured and written back.
+    """
+    counts: dict[str, Counter] = defaultdict(Counter)
+
+    async def consume(case_ids: list[str]) -> None:
+        pipe = redis.pipeline(transaction=False)
+        for cid in case_ids:
+            pipe.hgetall(record_key(cid))
+        stored = dict(zip(case_ids, await pipe.execute()))
+        records = [
+            record
+            for cid, data in stored.items()
+            if (record := decode_record(data, cid)) and record.get("is_temp") != "1"
+        ]
+
+        unsized = [r for r in records if not all(f in r for f in SIZE_FIELDS)]
+        if unsized:
+            sizes = await measure_blob_sizes(redis, unsized)
+            pipe = redis.pipeline(transaction=False)
+            for r, s in zip(unsized, sizes):
+                r.update(s)
+                pipe.hset(record_key(r["case_id"]), mapping=encode_record(s, compact=is_compact(stored[r["case_id"]])))
+            await pipe.execute()
+
+        for data in records:
+            for key, field in _stat_fields(data):
+                counts[key][field] += 1
+            for key, field, amount in storage_fields(data):
+                counts[key][field] += amount
+
+    async for case_ids in scan_record_ids(redis, page_size=page_size):
+        await consume(case_ids)
+
+    # one MULTI per bucket: a bucket's counters are swapped in all at once
+    for b in all_buckets():
+        keys = [stats_key(name, b) for name in STATS_NAMES + STORAGE_NAMES]
+        pipe = redis.pipeline()
+        pipe.delete(*keys)
+        for key in keys:
+            if counts.get(key):
+                pipe.hset(key, mapping=dict(counts[key]))
+        await pipe.execute()
+
+    return await get_stats(redis)
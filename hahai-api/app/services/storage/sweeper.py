@@ -0,0 +1,319 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+from redis.asyncio.client import Redis
+
+from app.config import settings
+from app.db.keys import (
+    INTERN_RECORDS_KEY_PATTERN,
+    RECORD_KEY_PATTERN,
+    SWEEP_ORPHANS_KEY,
+    all_buckets,
+    lock_key,
+    parse_record_key,
+    record_blob_keys,
+    record_bucket,
+    record_key,
+    record_xray_key,
+    records_key,
+)
+from app.services import jobs
+from app.services.locks import acquire_lock, refresh_lock, release_lock
+from app.services.storage.images import thumb_sizes_of
+from app.services.storage.record_cache import queue_record_invalidation
+from app.services.storage.record_codec import decode_record, pick_fields, record_fields
+from app.services.storage.records import add_record_indexes, remove_dangling_records, remove_record_indexes
+from app.services.storage.versions import bump_record_versions
+
+# Incremental consistency sweep. Three passes, each in small batches with a
+# pause in between so it never competes with live traffic for long:
+#
+#   1. records:{b} sets    -> drop ids whose record hash is gone, with their
+#                             index entries, notes postings and aggregates
+#   2. records:{b}:intern:* -> drop ids whose record hash is gone
+#   3. SCAN record:{*}:*    -> re-index complete records missing from the
+#                             indexes, remove metadata left without images,
+#                             and UNLINK image blobs whose metadata is gone
+#
+# Anything younger than SWEEP_GRACE_SECONDS (or still carrying a TTL) is
+# left alone so in-flight creates/promotes/imports are never touched.
+# Dangling ids are removed with records.remove_dangling_records.
+#
+# A blob has no timestamp of its own once its metadata is gone (and OBJECT
+# IDLETIME is refused under the LFU maxmemory policies), so orphans are
+# marked and swept: the first sweep to see one records it in
+# sweeper:orphans, and a later sweep reclaims it if it is still orphaned
+# SWEEP_GRACE_SECONDS after it was first seen.
+#
+# lock:sweeper is held (and refreshed after every batch) for the length of
+# one sweep; lock:sweeper:last-run is left to expire after the interval, so
+# the periodic loop of N workers runs one sweep per interval, not N.
+
+SWEEP_LOCK_TTL_SECONDS = 10 * 60  # refreshed every batch
+SWEEP_FIELDS = ("is_temp", "created_at", "saved_at")
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = (
+    "records_checked",
+    "dangling_index_entries",
+    "dangling_intern_entries",
+    "keys_scanned",
+    "records_reindexed",
+    "incomplete_records_removed",
+    "orphan_blobs_reclaimed",
+)
+
+
+class SweepInProgressError(Exception):
+    pass
+
+
+async def _pause(seconds: float) -> None:
+    if seconds > 0:
+        await asyncio.sleep(seconds)
+
+
+async def _sweep_set(
+    redis: Redis,
+    set_key: str,
+    *,
+    batch_size: int,
+    pause: float,
+    counter: str,
+    also_unindex: bool,
+    report: Callable[[dict[str, int]], Awaitable[None]],
+) -> None:
+    batch: list[str] = []
+
+    async def check(ids: list[str]) -> None:
+        pipe = redis.pipeline(transaction=False)
+        for cid in ids:
+            pipe.exists(record_key(cid))
+        found = await pipe.execute()
+        dangling = [cid for cid, ok in zip(ids, found) if not ok]
+
+        removed = len(dangling)
+        if dangling and also_unindex:
+            # every id in a set is in that set's bucket
+            removed = await remove_dangling_records(redis, dangling)
+        elif dangling:
+            await redis.srem(set_key, *dangling)
+
+        counts = {counter: removed}
+        if also_unindex:
+            counts["records_checked"] = len(ids)
+        await report(counts)
+
+    async for cid in redis.sscan_iter(set_key, count=batch_size):
+        batch.append(cid)
+        if len(batch) >= batch_size:
+            await check(batch)
+            batch = []
+            await _pause(pause)
+    if batch:
+        await check(batch)
+
+
+async def _sweep_keys(
+    redis: Redis,
+    keys: list[str],
+    *,
+    grace_seconds: int,
+    report: Callable[[dict[str, int]], Awaitable[None]],
+) -> None:
+    by_case: dict[str, dict[str, str]] = defaultdict(dict)  # case_id -> {kind: key}
+    for key in keys:
+        case_id, kind = parse_record_key(key)
+        by_case[case_id][kind] = key
+
+    metas = [cid for cid, kinds in by_case.items() if "meta" in kinds]
+    blobs = [key for kinds in by_case.values() if "meta" not in kinds for key in kinds.values()]
+    owned_blobs = [key for kinds in by_case.values() if "meta" in kinds for k, key in kinds.items() if k != "meta"]
+
+    pipe = redis.pipeline(transaction=False)
+    for cid in metas:
+        pipe.hmget(record_key(cid), record_fields(SWEEP_FIELDS))
+        pipe.ttl(record_key(cid))
+        pipe.sismember(records_key(record_bucket(cid)), cid)
+        pipe.exists(record_xray_key(cid))
+    for key in blobs:
+        pipe.exists(record_key(parse_record_key(key)[0]))
+        pipe.ttl(key)
+    if blobs or owned_blobs:
+        pipe.zmscore(SWEEP_ORPHANS_KEY, blobs + owned_blobs)
+    res = await pipe.execute()
+    marks = res.pop() if blobs or owned_blobs else []
+
+    now = time.time()
+    reindex: list[str] = []
+    incomplete: list[str] = []
+    orphan_blobs: list[str] = []
+
+    i = 0
+    for cid in metas:
+        fields, ttl, indexed, has_xray = res[i:i + 4]
+        is_temp, created_at, saved_at = pick_fields(fields, SWEEP_FIELDS)
+        i += 4
+        age = now - float(saved_at or created_at or 0)
+        if ttl != -1 or age < grace_seconds:
+            continue  # temp record (expires on its own) or too fresh to judge
+        if is_temp == "1" or not has_xray:
+            incomplete.append(cid)
+        elif not indexed:
+            reindex.append(cid)
+
+    seen: list[str] = []  # orphaned now, not yet marked
+    owned = [key for key, first_seen in zip(owned_blobs, marks[len(blobs):]) if first_seen is not None]
+    for key, first_seen in zip(blobs, marks):
+        meta_exists, ttl = res[i:i + 2]
+        i += 2
+        if meta_exists or ttl != -1:
+            if first_seen is not None:  # marked earlier, but the metadata (or a TTL) is back
+                owned.append(key)
+        elif first_seen is None and grace_seconds > 0:
+            seen.append(key)
+        elif now - (first_seen or now) >= grace_seconds:
+            orphan_blobs.append(key)
+
+    if seen or owned:
+        pipe = redis.pipeline(transaction=False)
+        if seen:
+            pipe.zadd(SWEEP_ORPHANS_KEY, {key: int(now) for key in seen}, nx=True)
+        if owned:
+            pipe.zrem(SWEEP_ORPHANS_KEY, *owned)
+        await pipe.execute()
+
+    if reindex or incomplete:
+        pipe = redis.pipeline(transaction=False)
+        for cid in reindex + incomplete:
+            pipe.hgetall(record_key(cid))
+            pipe.sismember(records_key(record_bucket(cid)), cid)
+        res = await pipe.execute()
+        full = {
+            cid: (decode_record(data, cid), indexed)
+            for cid, data, indexed in zip(reindex + incomplete, res[::2], res[1::2])
+        }
+
+        pipe = redis.pipeline(transaction=False)
+        owners = set()  # interns whose listings change
+        for cid in reindex:
+            data, indexed = full[cid]
+            if data and data.get("student_id") and not indexed:
+                add_record_indexes(pipe, {**data, "case_id": cid})
+                owners.add(data["student_id"])
+        for cid in incomplete:
+            data, indexed = full[cid]
+            if data and indexed:
+                remove_record_indexes(pipe, {**data, "case_id": cid})
+                owners.add(data.get("student_id", ""))
+            # UNLINK frees the (possibly large) values off the main Redis thread
+            pipe.unlink(record_key(cid), *record_blob_keys(cid, thumb_sizes_of(data or {})))
+            queue_record_invalidation(pipe, cid)
+        await pipe.execute()
+        if owners:
+            await bump_record_versions(redis, owners)
+
+    if orphan_blobs:
+        pipe = redis.pipeline(transaction=False)
+        pipe.unlink(*orphan_blobs)
+        pipe.zrem(SWEEP_ORPHANS_KEY, *orphan_blobs)
+        await pipe.execute()
+
+    await report({
+        "keys_scanned": len(keys),
+        "records_reindexed": len(reindex),
+        "incomplete_records_removed": len(incomplete),
+        "orphan_blobs_reclaimed": len(orphan_blobs),
+    })
+
+
+async def sweep(
+    redis: Redis,
+    *,
+    batch_size: int | None = None,
+    pause: float | None = None,
+    grace_seconds: int | None = None,
+    job_id: str | None = None,
+) -> dict[str, int]:
+    """
+    Runs one full sweep and returns what it fixed, also reporting per-batch
+    progress into job:{job_id} if given. Only one sweep runs at a time across
+    all workers (lock:sweeper); a second caller gets SweepInProgressError.
+    """
+    batch_size = batch_size or settings.SWEEP_BATCH_SIZE
+    pause = settings.SWEEP_PAUSE_SECONDS if pause is None else pause
+    grace_seconds = settings.SWEEP_GRACE_SECONDS if grace_seconds is None else grace_seconds
+
+    token = await acquire_lock(redis, "sweeper", ttl_seconds=SWEEP_LOCK_TTL_SECONDS)
+    if token is None:
+        raise SweepInProgressError("A sweep is already running")
+
+    totals = {name: 0 for name in COUNTERS}
+    started = time.time()
+
+    async def report(counts: dict[str, int]) -> None:
+        for k, v in counts.items():
+            totals[k] += v
+        if job_id is not None:
+            await jobs.update_job(redis, job_id, counters=counts)
+        # called after every batch; stops the sweep if another one took over
+        await refresh_lock(redis, "sweeper", token, ttl_seconds=SWEEP_LOCK_TTL_SECONDS)
+
+    try:
+        for b in all_buckets():
+            await _sweep_set(
+                redis, records_key(b),
+                batch_size=batch_size, pause=pause,
+                counter="dangling_index_entries", also_unindex=True, report=report,
+            )
+
+        intern_sets = [key async for key in redis.scan_iter(match=INTERN_RECORDS_KEY_PATTERN, count=batch_size)]
+        for key in sorted(intern_sets):
+            await _sweep_set(
+                redis, key,
+                batch_size=batch_size, pause=pause,
+                counter="dangling_intern_entries", also_unindex=False, report=report,
+            )
+
+        batch: list[str] = []
+        async for key in redis.scan_iter(match=RECORD_KEY_PATTERN, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                await _sweep_keys(redis, batch, grace_seconds=grace_seconds, report=report)
+                batch = []
+                await _pause(pause)
+        if batch:
+            await _sweep_keys(redis, batch, grace_seconds=grace_seconds, report=report)
+
+        # marks this full scan would have reclaimed or cleared, had the key
+        # still existed: deleted by someone else since
+        await redis.zremrangebyscore(SWEEP_ORPHANS_KEY, "-inf", f"({started - grace_seconds}")
+    finally:
+        await release_lock(redis, "sweeper", token)
+
+    return totals
+
+
+async def run_periodic_sweeps(redis: Redis, *, interval_seconds: int) -> None:
+    """
+    Lifespan background loop; every worker runs it, and the first one to
+    wake in an interval claims it with lock:sweeper:last-run, which is left
+    to expire, so one sweep runs per interval.
+    """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            if not await redis.set(lock_key("sweeper:last-run"), int(time.time()), nx=True, ex=interval_seconds):
+                continue
+            totals = await sweep(redis)
+            logger.info("Index sweep finished: %s", totals)
+        except SweepInProgressError:
+            pass
+        except Exception:
+            logger.exception("Index sweep failed")
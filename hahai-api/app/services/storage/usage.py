@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import math
+from collections import Counter
+
+from redis.asyncio.client import Redis
+from redis.exceptions import RedisError
+
+from app.db.keys import (
+    STORAGE_INTERNS,
+    STORAGE_TOTALS,
+    all_buckets,
+    record_bucket,
+    record_image_keys,
+    record_key,
+    records_key,
+    stats_key,
+)
+from app.services.storage.images import thumb_sizes_of
+from app.services.storage.record_codec import decode_record
+
+# Image storage accounting, maintained at write time next to the other
+# aggregates (add_record_indexes / remove_record_indexes), per key bucket:
+#   stats:{b}:storage          total, xray, gradcam, thumbs -> bytes
+#   stats:{b}:storage:interns  {student_id} -> bytes
+# Sizes come from the record hash (xray_bytes, gradcam_bytes, thumb_bytes),
+# written when the blobs are, so removals subtract exactly what was added.
+# Only permanent records count; temp records expire on their own.
+
+SIZE_FIELDS = ("xray_bytes", "gradcam_bytes", "thumb_bytes")
+
+
+class StorageQuotaExceededError(Exception):
+    pass
+
+
+def blob_sizes(*, xray: bytes, gradcam: bytes, thumbs: list[bytes] | tuple[bytes, ...] = ()) -> dict[str, int]:
+    return {
+        "xray_bytes": len(xray),
+        "gradcam_bytes": len(gradcam),
+        "thumb_bytes": sum(len(t) for t in thumbs),
+    }
+
+
+def record_bytes(record: dict) -> int:
+    return sum(int(record.get(f) or 0) for f in SIZE_FIELDS)
+
+
+def storage_fields(record: dict) -> list[tuple[str, str, int]]:
+    xray = int(record.get("xray_bytes") or 0)
+    gradcam = int(record.get("gradcam_bytes") or 0)
+    thumbs = int(record.get("thumb_bytes") or 0)
+    bucket = record_bucket(record["case_id"])
+    totals, interns = stats_key(STORAGE_TOTALS, bucket), stats_key(STORAGE_INTERNS, bucket)
+    return [
+        (totals, "total", xray + gradcam + thumbs),
+        (totals, "xray", xray),
+        (totals, "gradcam", gradcam),
+        (totals, "thumbs", thumbs),
+        (interns, str(record.get("student_id", "")), xray + gradcam + thumbs),
+    ]
+
+
+def track_storage_added(pipe, record: dict) -> None:
+    for key, field, amount in storage_fields(record):
+        if amount:
+            pipe.hincrby(key, field, amount)
+
+
+def track_storage_removed(pipe, record: dict) -> None:
+    for key, field, amount in storage_fields(record):
+        if amount:
+            pipe.hincrby(key, field, -amount)
+
+
+async def sum_bucket_hashes(redis: Redis, names: tuple[str, ...]) -> list[dict[str, int]]:
+    """HGETALL of stats:{b}:{name} for every bucket, summed per name."""
+    pipe = redis.pipeline(transaction=False)
+    for b in all_buckets():
+        for name in names:
+            pipe.hgetall(stats_key(name, b))
+    res = await pipe.execute()
+
+    sums = [Counter() for _ in names]
+    for i, data in enumerate(res):
+        sums[i % len(names)].update({k: int(v) for k, v in data.items()})
+    return [dict(c) for c in sums]
+
+
+async def get_usage(redis: Redis, *, student_id: str) -> tuple[int, int]:
+    """(bytes used by this intern, bytes used in total), summed over the buckets."""
+    pipe = redis.pipeline(transaction=False)
+    for b in all_buckets():
+        pipe.hget(stats_key(STORAGE_INTERNS, b), student_id)
+        pipe.hget(stats_key(STORAGE_TOTALS, b), "total")
+    res = await pipe.execute()
+    return sum(int(v or 0) for v in res[::2]), sum(int(v or 0) for v in res[1::2])
+
+
+async def check_quota(
+    redis: Redis,
+    *,
+    student_id: str,
+    incoming: int,
+    per_intern_quota: int,
+    total_quota: int,
+) -> None:
+    """
+    Raises StorageQuotaExceededError if saving `incoming` more bytes would
+    exceed either quota (0 = unlimited). Soft limit: concurrent saves can
+    overshoot by at most one record each.
+    """
+    if not per_intern_quota and not total_quota:
+        return
+    mine, total = await get_usage(redis, student_id=student_id)
+    if per_intern_quota and mine + incoming > per_intern_quota:
+        raise StorageQuotaExceededError(
+            f"Storage quota exceeded for intern {student_id} ({mine + incoming} > {per_intern_quota} bytes)"
+        )
+    if total_quota and total + incoming > total_quota:
+        raise StorageQuotaExceededError(f"Storage capacity exceeded ({total + incoming} > {total_quota} bytes)")
+
+
+async def measure_blob_sizes(redis: Redis, records: list[dict]) -> list[dict[str, int]]:
+    """
+    STRLEN-based sizes for records stored before accounting existed
+    (one pipeline for the whole batch).
+    """
+    pipe = redis.pipeline(transaction=False)
+    layout = []
+    for r in records:
+        keys = record_image_keys(r["case_id"], thumb_sizes_of(r))
+        layout.append(len(keys))
+        for k in keys:
+            pipe.strlen(k)
+    lens = await pipe.execute()
+
+    out, i = [], 0
+    for n in layout:
+        xray, gradcam, *thumbs = lens[i:i + n]
+        i += n
+        out.append({"xray_bytes": xray, "gradcam_bytes": gradcam, "thumb_bytes": sum(thumbs)})
+    return out
+
+
+def estimate_hash_bytes(data: dict) -> int:
+    """
+    Listpack size of a small hash: per field and per value, its bytes plus
+    about 2 bytes of entry header and back-length; 7 bytes of list header
+    and terminator. Leaves out the key and object overhead, which is the
+    same for any encoding of the hash.
+    """
+    return 7 + sum(len(str(k).encode()) + len(str(v).encode()) + 4 for k, v in data.items())
+
+
+async def measure_hash_bytes(redis: Redis, keys: list[str]) -> tuple[list[int], str]:
+    """
+    Per-key MEMORY USAGE, or estimate_hash_bytes where the server has no
+    MEMORY command. Returns (sizes, "memory_usage" | "listpack_estimate").
+    """
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key, samples=0)
+    try:
+        usage = await pipe.execute(raise_on_error=False)
+    except RedisError:  # some servers and proxies drop the connection on an unknown command
+        usage = []
+    if usage and not any(isinstance(u, Exception) for u in usage):
+        return [int(u or 0) for u in usage], "memory_usage"
+
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    return [estimate_hash_bytes(d) for d in await pipe.execute()], "listpack_estimate"
+
+
+async def _memory_info(redis: Redis) -> dict:
+    """INFO memory; a cluster client answers per node, so those are summed."""
+    info = await redis.info("memory")
+    nodes = [v for v in info.values() if isinstance(v, dict)]
+    if not nodes:
+        return info
+    return {
+        "used_memory": sum(n.get("used_memory", 0) for n in nodes),
+        "maxmemory": sum(n.get("maxmemory", 0) for n in nodes),
+        "maxmemory_policy": nodes[0].get("maxmemory_policy"),
+    }
+
+
+async def storage_report(
+    redis: Redis,
+    *,
+    sample: int = 20,
+    top: int = 20,
+    per_intern_quota: int = 0,
+    total_quota: int = 0,
+) -> dict:
+    """
+    Tracked usage (global + heaviest interns), plus a MEMORY USAGE sample of
+    random records to check the tracked numbers against what Redis actually
+    allocates (key overhead, allocator rounding).
+    """
+    totals, per_intern = await sum_bucket_hashes(redis, (STORAGE_TOTALS, STORAGE_INTERNS))
+    heaviest = sorted(((sid, v) for sid, v in per_intern.items() if v > 0), key=lambda kv: -kv[1])
+
+    # a few random records from every bucket
+    per_bucket = math.ceil(sample / len(all_buckets())) if sample > 0 else 0
+    pipe = redis.pipeline(transaction=False)
+    for b in all_buckets():
+        pipe.srandmember(records_key(b), per_bucket)
+    sample_ids = [cid for ids in await pipe.execute() for cid in ids][:max(0, sample)]
+    info = await _memory_info(redis)
+
+    report = {
+        "tracked_bytes": totals.get("total", 0),
+        "by_kind": {k: totals.get(k, 0) for k in ("xray", "gradcam", "thumbs")},
+        "interns": [
+            {
+                "student_id": sid,
+                "bytes": used,
+                "quota_used_pct": round(100.0 * used / per_intern_quota, 1) if per_intern_quota else None,
+            }
+            for sid, used in heaviest[:top]
+        ],
+        "quotas": {"per_intern_bytes": per_intern_quota, "total_bytes": total_quota},
+        "redis": {
+            "used_memory": info.get("used_memory"),
+            "maxmemory": info.get("maxmemory"),
+            "maxmemory_policy": info.get("maxmemory_policy"),
+        },
+    }
+
+    if sample_ids:
+        pipe = redis.pipeline(transaction=False)
+        for cid in sample_ids:
+            pipe.hgetall(record_key(cid))
+        metas = [decode_record(m, cid) for cid, m in zip(sample_ids, await pipe.execute()) if m]
+
+        pipe = redis.pipeline(transaction=False)
+        layout = []
+        for m in metas:
+            keys = [record_key(m["case_id"])] + record_image_keys(m["case_id"], thumb_sizes_of(m))
+            layout.append(len(keys))
+            for k in keys:
+                pipe.memory_usage(k)
+        usage = await pipe.execute(raise_on_error=False)
+
+        tracked = measured = 0
+        i = 0
+        for m, n in zip(metas, layout):
+            tracked += record_bytes(m)
+            measured += sum(u for u in usage[i:i + n] if isinstance(u, int))
+            i += n
+        report["sample"] = {
+            "records": len(metas),
+            "tracked_bytes": tracked,
+            "memory_usage_bytes": measured,
+            "overhead_ratio": round(measured / tracked, 3) if tracked else None,
+        }
+
+    return report
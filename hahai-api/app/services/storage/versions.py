@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import hashlib
+import time
+from typing import Iterable
+
+from redis.asyncio.client import Redis
+
+from app.db.keys import INTERNS_VERSION_KEY, RECORDS_VERSION_KEY, intern_records_version_key
+
+# Collection versions, so pollers of the list endpoints can be answered with
+# 304 after one GET instead of a rebuilt listing:
+#
+#   version:records                    every permanent record (GET /records)
+#   version:records:intern:{id}        one intern's records (/records/me, /records/intern/{id})
+#   version:interns                    the intern list, including each
+#                                      intern's case_ids (GET /interns)
+#
+# Writers bump them right after their MULTI commits, never inside it: the
+# version keys live in their own hash slots (same reason invalidations are
+# published after EXEC). Readers GET the version before building the list
+# and from the same client, so a listing is never older than the ETag it is
+# sent with; at worst a poll that raced a write refetches once more. A
+# writer that dies between EXEC and the bump leaves that one change
+# unannounced until the collection's next bump.
+#
+# A counter is seeded with the current time in ms the first time it is
+# bumped, so one that is lost (flush, new server after migrate-keys) restarts
+# above any value it had and an old ETag cannot match again.
+
+
+def record_version_keys(student_ids: Iterable[str], *, membership: bool = True) -> list[str]:
+    """
+    Versions to bump after records of these interns changed. `membership`:
+    records were added or removed (not just updated), which also changes the
+    case_id lists in GET /interns.
+    """
+    keys = [RECORDS_VERSION_KEY]
+    if membership:
+        keys.append(INTERNS_VERSION_KEY)
+    keys.extend(intern_records_version_key(sid) for sid in sorted(set(student_ids)) if sid)
+    return keys
+
+
+async def bump_versions(redis: Redis, *keys: str) -> None:
+    """
+    Call after the writes have executed, not on their pipeline: in cluster
+    mode a pipeline is split per node and a bump could land first.
+    """
+    if not keys:
+        return
+    seed = int(time.time() * 1000)
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.set(key, seed, nx=True)
+        pipe.incr(key)
+    await pipe.execute()
+
+
+async def bump_record_versions(redis: Redis, student_ids: Iterable[str], *, membership: bool = True) -> None:
+    await bump_versions(redis, *record_version_keys(student_ids, membership=membership))
+
+
+async def collection_etag(redis: Redis, key: str) -> str:
+    """
+    Strong ETag for the collection's current version (0 if never bumped).
+    Opaque, and distinct per collection: two interns polling /records/me
+    from one browser never share one.
+    """
+    version = await redis.get(key) or "0"
+    digest = hashlib.blake2b(f"{key}:{version}".encode(), digest_size=10).hexdigest()
+    return f'"{digest}"'
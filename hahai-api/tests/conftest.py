@@ -0,0 +1,38 @@
+import fakeredis
+import pytest
+
+from app.services.storage import interns, records
+
+# Storage tests run against fakeredis (pip install -e .[test]); nothing here
+# imports TensorFlow. Async tests are marked with pytest.mark.anyio.
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def redis():
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    yield client
+    await client.aclose()
+
+
+async def add_intern(redis, student_id: str) -> str:
+    await interns.create_intern(redis, student_id=student_id, name="Ana", surname="Anić")
+    return student_id
+
+
+async def add_record(redis, student_id: str, *, notes: str = "", pred_label: str = "positive", pred_accuracy: float = 80.0) -> str:
+    return await records.create_record(
+        redis,
+        student_id=student_id,
+        notes=notes,
+        pred_label=pred_label,
+        pred_accuracy=pred_accuracy,
+        xray_bytes=b"xray",
+        xray_content_type="image/jpeg",
+        gradcam_bytes=b"gradcam",
+        gradcam_content_type="image/png",
+    )
@@ -0,0 +1,130 @@
+import gzip
+import json
+
+import fakeredis
+import pytest
+
+from app.db.keys import record_gradcam_key, record_xray_key
+from app.services import jobs
+from app.services.storage import records, stats
+from app.services.storage.archive import ArchiveFormatError, archive_header, import_archive_file, iter_archive_lines
+from tests.conftest import add_intern
+
+pytestmark = pytest.mark.anyio
+
+XRAY = b"\xff\xd8\xff\xe0not-utf8\x00"
+
+
+@pytest.fixture
+async def target():
+    client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    yield client
+    await client.aclose()
+
+
+async def _populate(redis) -> list[str]:
+    await add_intern(redis, "s1")
+    await add_intern(redis, "s2")
+    ids = []
+    for i, sid in enumerate(["s1", "s1", "s2"]):
+        ids.append(await records.create_record(
+            redis,
+            student_id=sid,
+            notes=f"note {i}",
+            pred_label="positive" if i % 2 else "negative",
+            pred_accuracy=60.0 + i * 7.5,
+            xray_bytes=XRAY + bytes([i]),
+            xray_content_type="image/jpeg",
+            gradcam_bytes=b"\x89PNG" + bytes([i]),
+            gradcam_content_type="image/png",
+            model_version="v1",
+        ))
+    return ids
+
+
+async def _export(redis, path, *, compress: bool = False) -> None:
+    data = b"".join([line async for line in iter_archive_lines(redis, page_size=2)])
+    path.write_bytes(gzip.compress(data) if compress else data)
+
+
+async def _import(redis, path) -> dict:
+    job_id = await jobs.create_job(redis, kind="import")
+    return await import_archive_file(redis, str(path), job_id=job_id, batch_size=2)
+
+
+async def _blob(redis, key: str) -> bytes:
+    return await redis.execute_command("GET", key, NEVER_DECODE=True)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+async def test_export_import_round_trip(redis, target, tmp_path, compress):
+    ids = await _populate(redis)
+    await add_intern(target, "s1")
+    await add_intern(target, "s2")
+    path = tmp_path / "records.ndjson"
+    await _export(redis, path, compress=compress)
+
+    job = await _import(target, path)
+
+    assert job["status"] == "completed" and job["imported"] == 3 and job["checkpoint_line"] == 3
+    for cid in ids:
+        assert await records.get_record(target, case_id=cid) == await records.get_record(redis, case_id=cid)
+        for key in (record_xray_key(cid), record_gradcam_key(cid)):
+            assert await _blob(target, key) == await _blob(redis, key)
+    assert await stats.get_stats(target) == await stats.get_stats(redis)
+
+
+async def test_import_is_idempotent(redis, tmp_path):
+    await _populate(redis)
+    before = await stats.get_stats(redis)
+    path = tmp_path / "records.ndjson"
+    await _export(redis, path)
+
+    job = await _import(redis, path)
+
+    assert job["skipped_existing"] == 3 and job.get("imported", 0) == 0
+    assert await stats.get_stats(redis) == before
+
+
+async def test_import_skips_unknown_interns_and_invalid_lines(redis, target, tmp_path):
+    await _populate(redis)
+    await add_intern(target, "s1")
+    path = tmp_path / "records.ndjson"
+    await _export(redis, path)
+    with path.open("ab") as fh:
+        fh.write(b"not json\n")
+        fh.write(json.dumps({"case_id": "temp-1", "student_id": "s1", "pred_label": "positive", "pred_accuracy": 1, "xray": ""}).encode() + b"\n")
+
+    job = await _import(target, path)
+
+    assert job["imported"] == 2 and job["skipped_unknown_intern"] == 1 and job["invalid"] == 2
+    assert (await stats.get_stats(target))["per_intern"] == {"s1": 2}
+
+
+async def test_import_resumes_after_the_checkpoint(redis, target, tmp_path):
+    await _populate(redis)
+    await add_intern(target, "s1")
+    await add_intern(target, "s2")
+    path = tmp_path / "records.ndjson"
+    await _export(redis, path)
+    job_id = await jobs.create_job(target, kind="import")
+    await jobs.update_job(target, job_id, status="interrupted", checkpoint_line=1)
+
+    job = await import_archive_file(target, str(path), job_id=job_id, batch_size=2)
+
+    assert job["status"] == "completed" and job["imported"] == 2 and job["lines_read"] == 2
+    assert (await stats.get_stats(target))["total_records"] == 2
+
+
+async def test_import_rejects_a_foreign_file(target, tmp_path):
+    path = tmp_path / "records.ndjson"
+    path.write_bytes(json.dumps({"format": "other"}).encode() + b"\n")
+    job_id = await jobs.create_job(target, kind="import")
+
+    with pytest.raises(ArchiveFormatError):
+        await import_archive_file(target, str(path), job_id=job_id)
+    assert (await jobs.get_job(target, job_id))["status"] == "failed"
+
+    path.write_bytes(archive_header().replace(b'"version": 1', b'"version": 2'))
+    with pytest.raises(ArchiveFormatError, match="version 2"):
+        await import_archive_file(target, str(path), job_id=job_id)
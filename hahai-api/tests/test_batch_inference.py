@@ -0,0 +1,100 @@
+import pytest
+
+pytest.importorskip("tensorflow")
+
+from app.db.keys import intern_records_key, job_items_key, make_case_id, record_bucket, record_key  # noqa: E402
+from app.services import batch_inference  # noqa: E402
+from app.services.storage import purge, records, stats  # noqa: E402
+from tests.conftest import add_intern  # noqa: E402
+
+pytestmark = pytest.mark.anyio
+
+
+def _item(student_id: str, path: str) -> dict:
+    case_id = make_case_id()
+    return {
+        "path": path,
+        "meta": {
+            "case_id": case_id,
+            "student_id": student_id,
+            "notes": "",
+            "pred_label": "positive",
+            "pred_accuracy": 90.0,
+            "created_at": 1_000,
+            "saved_at": 1_000,
+            "is_temp": "0",
+            "xray_content_type": "image/jpeg",
+            "gradcam_content_type": "image/png",
+            "thumb_sizes": "",
+            "thumb_content_type": "",
+            "model_version": "v1",
+            "xray_bytes": 4,
+            "gradcam_bytes": 7,
+        },
+        "xray": b"xray",
+        "gradcam": b"gradcam",
+        "thumb_sizes": [],
+        "xray_thumbs": {},
+        "gradcam_thumbs": {},
+        "embedding": None,
+    }
+
+
+async def _done(redis, job_id: str, items: list[dict]) -> set[str]:
+    found = set()
+    for it in items:
+        if await redis.sismember(job_items_key(job_id, record_bucket(it["meta"]["case_id"])), it["path"]):
+            found.add(it["path"])
+    return found
+
+
+async def test_write_batch_stores_records_and_done_set(redis):
+    await add_intern(redis, "s1")
+    items = [_item("s1", f"{i}.png") for i in range(5)]
+
+    assert await batch_inference._write_batch(redis, items, job_id="j", student_id="s1") == 5
+
+    assert {r["case_id"] for r in await records.list_records_for_intern(redis, student_id="s1")} == \
+        {it["meta"]["case_id"] for it in items}
+    assert await _done(redis, "j", items) == {it["path"] for it in items}
+    assert (await stats.get_stats(redis))["per_intern"] == {"s1": 5}
+
+
+async def test_write_batch_does_not_resurrect_a_purged_intern(redis):
+    await add_intern(redis, "s1")
+    await purge.purge(redis, student_ids=["s1"])
+    items = [_item("s1", f"{i}.png") for i in range(3)]
+
+    with pytest.raises(batch_inference.BatchInferenceError):
+        await batch_inference._write_batch(redis, items, job_id="j", student_id="s1")
+
+    assert not any([await redis.exists(record_key(it["meta"]["case_id"])) for it in items])
+    assert (await stats.get_stats(redis))["total_records"] == 0
+
+
+async def test_cluster_mode_takes_back_records_of_an_intern_purged_mid_write(redis, monkeypatch):
+    await add_intern(redis, "s1")
+    items = [_item("s1", f"{i}.png") for i in range(3)]
+    monkeypatch.setattr(batch_inference, "is_cluster", lambda _redis: True)
+
+    # the purge lands between the pre-write check and EXEC
+    exists = redis.exists
+    checks = 0
+
+    async def racing_exists(*keys):
+        nonlocal checks
+        checks += 1
+        if checks == 1:
+            await purge.purge(redis, student_ids=["s1"])
+            return 1
+        return await exists(*keys)
+
+    monkeypatch.setattr(redis, "exists", racing_exists)
+    with pytest.raises(batch_inference.BatchInferenceError):
+        await batch_inference._write_batch(redis, items, job_id="j", student_id="s1")
+    monkeypatch.undo()
+
+    assert not any([await redis.exists(record_key(it["meta"]["case_id"])) for it in items])
+    assert not any([await redis.scard(intern_records_key("s1", b)) for b in {record_bucket(it["meta"]["case_id"]) for it in items}])
+    assert await _done(redis, "j", items) == set()
+    assert (await stats.get_stats(redis))["total_records"] == 0
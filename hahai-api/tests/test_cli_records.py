@@ -0,0 +1,41 @@
+import argparse
+
+import fakeredis
+import pytest
+
+from app.cli import records as records_cli
+from app.config import settings
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = fakeredis.FakeServer()
+
+    async def create_redis(url, **kwargs):
+        return fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+
+    monkeypatch.setattr(records_cli, "create_redis", create_redis)
+    monkeypatch.setattr(settings, "RECORD_COMPACT_ENCODING", settings.RECORD_COMPACT_ENCODING)
+    return server
+
+
+def _bench_args(*, records: int, flush: bool = False) -> argparse.Namespace:
+    return argparse.Namespace(redis_url="redis://scratch", records=records, flush=flush, seed=0, batch_size=100)
+
+
+async def test_encoding_bench_leaves_a_non_empty_database_alone(server):
+    redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    await redis.set("someone-elses", "data")
+
+    assert await records_cli._encoding_bench(_bench_args(records=2)) == 2
+    assert await redis.get("someone-elses") == "data"
+
+
+async def test_encoding_bench_cleans_up_after_itself(server, capsys):
+    redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+
+    assert await records_cli._encoding_bench(_bench_args(records=4)) == 0
+    assert '"records_converted": 4' in capsys.readouterr().out
+    assert await redis.dbsize() == 0
@@ -0,0 +1,122 @@
+import httpx
+import pytest
+from fastapi import FastAPI, Request, Response
+
+from app.api.etags import check_etag
+from app.db.keys import INTERNS_VERSION_KEY, RECORDS_VERSION_KEY, intern_records_version_key
+from app.services.storage import interns, purge, records, versions
+from app.services.storage.versions import bump_versions, collection_etag, record_version_keys
+from tests.conftest import add_intern, add_record
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def client(redis):
+    app = FastAPI()
+
+    @app.get("/records")
+    async def list_records(request: Request, response: Response):
+        if not_modified := await check_etag(request, response, redis, RECORDS_VERSION_KEY):
+            return not_modified
+        return {"items": []}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as c:
+        yield c
+
+
+async def test_unchanged_poll_gets_304(client):
+    first = await client.get("/records")
+    etag = first.headers["etag"]
+    assert first.status_code == 200 and first.json() == {"items": []}
+    assert first.headers["cache-control"] == "private, no-cache"
+
+    for header in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+        again = await client.get("/records", headers={"If-None-Match": header})
+        assert again.status_code == 304, header
+        assert again.headers["etag"] == etag and again.content == b""
+
+    assert (await client.get("/records", headers={"If-None-Match": '"other"'})).status_code == 200
+
+
+async def test_a_write_changes_the_etag(client, redis):
+    etag = (await client.get("/records")).headers["etag"]
+    await add_intern(redis, "s1")
+    await add_record(redis, "s1")
+
+    after = await client.get("/records", headers={"If-None-Match": etag})
+
+    assert after.status_code == 200 and after.headers["etag"] != etag
+    assert (await client.get("/records", headers={"If-None-Match": after.headers["etag"]})).status_code == 304
+
+
+async def _etags(redis) -> dict[str, str]:
+    keys = (RECORDS_VERSION_KEY, INTERNS_VERSION_KEY, intern_records_version_key("s1"), intern_records_version_key("s2"))
+    return {key: await collection_etag(redis, key) for key in keys}
+
+
+def _changed(before: dict, after: dict) -> set[str]:
+    return {key for key in before if before[key] != after[key]}
+
+
+async def test_record_writes_bump_their_collections(redis):
+    await add_intern(redis, "s1")
+    await add_intern(redis, "s2")
+    all_s1 = {RECORDS_VERSION_KEY, INTERNS_VERSION_KEY, intern_records_version_key("s1")}
+
+    before = await _etags(redis)
+    case_id = await add_record(redis, "s1")
+    assert _changed(before, before := await _etags(redis)) == all_s1
+
+    await records.delete_record(redis, case_id=case_id)
+    assert _changed(before, before := await _etags(redis)) == all_s1
+
+    temp_id = await records.create_temp_record(
+        redis,
+        student_id="s1",
+        pred_label="positive",
+        pred_accuracy=90.0,
+        xray_bytes=b"xray",
+        xray_content_type="image/jpeg",
+        gradcam_bytes=b"gradcam",
+        gradcam_content_type="image/png",
+    )
+    assert _changed(before, before := await _etags(redis)) == set()  # not listed until saved
+    await records.promote_temp_record(redis, temp_id=temp_id, student_id="s1", notes="")
+    assert _changed(before, before := await _etags(redis)) == all_s1
+
+    await add_record(redis, "s2")
+    before = await _etags(redis)
+    await purge.purge(redis, student_ids=["s1"])
+    assert _changed(before, await _etags(redis)) == all_s1
+
+
+async def test_intern_writes_bump_the_intern_list(redis):
+    before = await _etags(redis)
+    await add_intern(redis, "s1")
+    assert _changed(before, before := await _etags(redis)) == {INTERNS_VERSION_KEY}
+
+    await interns.delete_intern(redis, student_id="s1")
+    assert _changed(before, await _etags(redis)) == {INTERNS_VERSION_KEY, intern_records_version_key("s1")}
+
+
+def test_updates_leave_the_intern_list_alone():
+    assert record_version_keys(["s1", "", "s1"]) == [RECORDS_VERSION_KEY, INTERNS_VERSION_KEY, intern_records_version_key("s1")]
+    assert record_version_keys(["s1"], membership=False) == [RECORDS_VERSION_KEY, intern_records_version_key("s1")]
+
+
+async def test_versions_are_seeded_so_a_lost_counter_cannot_reuse_an_etag(redis, monkeypatch):
+    assert await collection_etag(redis, RECORDS_VERSION_KEY) != await collection_etag(redis, INTERNS_VERSION_KEY)
+
+    monkeypatch.setattr(versions.time, "time", lambda: 1_000.0)
+    await bump_versions(redis, RECORDS_VERSION_KEY)
+    await bump_versions(redis, RECORDS_VERSION_KEY)
+    assert int(await redis.get(RECORDS_VERSION_KEY)) == 1_000_002
+    old = await collection_etag(redis, RECORDS_VERSION_KEY)
+
+    # the counter is lost (flush, new server) and bumped again later
+    await redis.flushall()
+    monkeypatch.setattr(versions.time, "time", lambda: 1_001.0)
+    await bump_versions(redis, RECORDS_VERSION_KEY)
+    assert int(await redis.get(RECORDS_VERSION_KEY)) == 1_001_001
+    assert await collection_etag(redis, RECORDS_VERSION_KEY) != old
@@ -0,0 +1,91 @@
+import pytest
+
+from app.services.storage import records
+from app.services.storage.indexes import InvalidQueryError, query_record_ids
+from tests.conftest import add_intern, add_record
+
+pytestmark = pytest.mark.anyio
+
+DAY = 86_400
+NOW = 1_704_067_200
+
+
+@pytest.fixture
+async def dataset(redis, monkeypatch):
+    """Ten records over ten days, newest last: ids[i] was created on day i."""
+    clock = {"t": NOW}
+    monkeypatch.setattr(records.time, "time", lambda: clock["t"])
+    await add_intern(redis, "s1")
+    await add_intern(redis, "s2")
+    ids = []
+    for i in range(10):
+        clock["t"] = NOW + i * DAY
+        ids.append(await add_record(
+            redis,
+            "s1" if i % 2 == 0 else "s2",
+            pred_label="positive" if i < 6 else "negative",
+            pred_accuracy=50.0 + i * 5,
+        ))
+    return ids
+
+
+async def test_unfiltered_listing_pages_across_buckets(redis, dataset):
+    total, newest = await query_record_ids(redis, limit=3)
+    assert total == 10 and newest == dataset[::-1][:3]
+
+    total, page = await query_record_ids(redis, offset=3, limit=4, descending=False)
+    assert total == 10 and page == dataset[3:7]
+
+    _, everything = await query_record_ids(redis, sort_by="pred_accuracy")
+    assert everything == dataset[::-1]
+
+
+async def test_range_on_the_sort_field(redis, dataset):
+    total, ids = await query_record_ids(redis, ranges={"pred_accuracy": (60.0, 75.0)}, sort_by="pred_accuracy", descending=False)
+    assert total == 4 and ids == dataset[2:6]
+
+    total, ids = await query_record_ids(redis, ranges={"created_at": (NOW + 8 * DAY, None)}, limit=1)
+    assert total == 2 and ids == [dataset[9]]
+
+
+async def test_label_range_and_intern_filters_intersect(redis, dataset):
+    # positive predictions below 70% confidence from the last week
+    total, ids = await query_record_ids(
+        redis,
+        pred_label="positive",
+        ranges={"pred_accuracy": (None, 69.9), "created_at": (NOW + 3 * DAY, None)},
+    )
+    assert total == 1 and ids == [dataset[3]]
+
+    total, ids = await query_record_ids(redis, student_id="s1", ranges={"saved_at": (NOW + 2 * DAY, NOW + 6 * DAY)}, descending=False)
+    assert total == 3 and ids == [dataset[2], dataset[4], dataset[6]]
+
+    total, ids = await query_record_ids(redis, pred_label="negative", student_id="s2", sort_by="pred_accuracy", offset=1, limit=5)
+    assert total == 2 and ids == [dataset[7]]
+
+    assert await query_record_ids(redis, student_id="nobody") == (0, [])
+    assert not [k async for k in redis.scan_iter(match="tmp:query:*")]
+
+
+async def test_deleted_and_temp_records_are_not_listed(redis, dataset):
+    await records.delete_record(redis, case_id=dataset[9])
+    await records.create_temp_record(
+        redis,
+        student_id="s1",
+        pred_label="negative",
+        pred_accuracy=99.0,
+        xray_bytes=b"xray",
+        xray_content_type="image/jpeg",
+        gradcam_bytes=b"gradcam",
+        gradcam_content_type="image/png",
+    )
+
+    total, ids = await query_record_ids(redis, pred_label="negative")
+    assert total == 3 and dataset[9] not in ids
+    assert (await query_record_ids(redis, ranges={"pred_accuracy": (95.0, None)}))[0] == 0
+
+
+@pytest.mark.parametrize("filters", [{"sort_by": "notes"}, {"ranges": {"student_id": (0, 1)}}])
+async def test_unknown_fields_are_rejected(redis, filters):
+    with pytest.raises(InvalidQueryError):
+        await query_record_ids(redis, **filters)
@@ -0,0 +1,139 @@
+import fakeredis
+import pytest
+
+from app.db.keys import (
+    ALL_INTERNS_KEY,
+    intern_key,
+    intern_sessions_key,
+    record_embedding_key,
+    record_gradcam_key,
+    record_key,
+    record_thumb_key,
+    record_xray_key,
+)
+from app.services.storage import interns, records, stats
+from app.services.storage.migrate import migrate_keys
+
+pytestmark = pytest.mark.anyio
+
+# The untagged layout the API used before key buckets: record:{case_id}...,
+# intern:{id}, plus global indexes and aggregates that are not migrated but
+# recomputed (the stale values below must not survive).
+LEGACY_RECORDS = {
+    "case-a": {"student_id": "s1", "notes": "left lobe opacity", "pred_label": "positive", "pred_accuracy": "91.5", "created_at": "1000"},
+    "case-b": {"student_id": "s1", "notes": "clear", "pred_label": "negative", "pred_accuracy": "64.0", "created_at": "2000"},
+    "case-c": {"student_id": "s2", "notes": "right lobe", "pred_label": "positive", "pred_accuracy": "77.0", "created_at": "3000"},
+}
+
+
+async def _legacy_layout(redis) -> None:
+    for sid in ("s1", "s2"):
+        await redis.hset(f"intern:{sid}", mapping={"student_id": sid, "name": "Ana", "surname": "Anić"})
+        await redis.sadd(ALL_INTERNS_KEY, sid)
+    await redis.sadd("intern:s1:sessions", "tok-1")
+    await redis.set("session:intern:tok-1", "s1")
+
+    for cid, meta in LEGACY_RECORDS.items():
+        await redis.hset(f"record:{cid}", mapping={
+            "case_id": cid,
+            "is_temp": "0",
+            "xray_content_type": "image/jpeg",
+            "gradcam_content_type": "image/png",
+            "xray_bytes": "4",
+            "gradcam_bytes": "7",
+            **meta,
+        })
+        await redis.set(f"record:{cid}:xray", b"xray")
+        await redis.set(f"record:{cid}:gradcam", b"gradcam")
+        await redis.sadd(f"intern:{meta['student_id']}:records", cid)
+        await redis.zadd("records", {cid: float(meta["created_at"])})
+    await redis.hset("record:case-a", mapping={"thumb_sizes": "64", "thumb_content_type": "image/webp", "thumb_bytes": "6"})
+    await redis.set("record:case-a:xray:64", b"x64")
+    await redis.set("record:case-a:gradcam:64", b"g64")
+    await redis.set("record:case-a:embedding", b"\x00\x01")
+
+    # an unsaved temp record keeps its TTL
+    await redis.hset("record:temp-1", mapping={"case_id": "temp-1", "student_id": "s1", "is_temp": "1", "pred_label": "positive"})
+    await redis.expire("record:temp-1", 600)
+    await redis.set("record:temp-1:xray", b"xray", ex=600)
+
+    await redis.zadd("records:by:pred_accuracy", {"case-a": 91.5})
+    await redis.sadd("notes:term:lobe", "case-a")
+    await redis.hset("stats:totals", mapping={"records": 99})
+
+
+async def _assert_migrated(redis) -> None:
+    assert not [k async for k in redis.scan_iter(match="record:case-*")]
+    assert not await redis.exists("intern:s1", "intern:s1:records", "intern:s1:sessions", "records", "stats:totals")
+
+    assert (await interns.get_intern(redis, student_id="s1"))["patient_records"] == ["case-a", "case-b"]
+    assert (await interns.get_intern(redis, student_id="s2"))["patient_records"] == ["case-c"]
+    assert await redis.smembers(intern_sessions_key("s1")) == {"tok-1"}
+
+    record = await records.get_record(redis, case_id="case-a")
+    assert record["notes"] == "left lobe opacity" and record["pred_label"] == "positive"
+    assert await redis.get(record_xray_key("case-a")) == "xray"
+    assert await redis.get(record_gradcam_key("case-c")) == "gradcam"
+    assert await redis.get(record_thumb_key("case-a", "gradcam", 64)) == "g64"
+    assert await redis.exists(record_embedding_key("case-a"))
+    assert 0 < await redis.ttl(record_key("temp-1")) <= 600
+    assert 0 < await redis.ttl(record_xray_key("temp-1")) <= 600
+
+    assert sorted(r["case_id"] for r in await records.list_records_for_intern(redis, student_id="s1")) == ["case-a", "case-b"]
+    total, page = await records.query_records(redis, pred_label="positive", sort_by="pred_accuracy")
+    assert total == 2 and [r["case_id"] for r in page] == ["case-a", "case-c"]
+    total, page = await records.search_records(redis, query="lobe")
+    assert total == 2 and {r["case_id"] for r in page} == {"case-a", "case-c"}
+
+    summary = await stats.get_stats(redis)
+    assert summary["total_records"] == 3
+    assert summary["per_intern"] == {"s1": 2, "s2": 1}
+    assert summary["per_label"] == {"positive": 2, "negative": 1}
+
+
+async def test_migrates_the_legacy_layout_in_place(redis):
+    await _legacy_layout(redis)
+
+    summary = await migrate_keys(redis, redis)
+
+    assert summary["intern_keys_moved"] == 3  # two hashes and a session set
+    assert summary["record_keys_moved"] == 14  # 3 records with images, thumbnails, an embedding, a temp record
+    assert summary["records"] == 3 and summary["records_indexed"] == 3
+    await _assert_migrated(redis)
+    assert await redis.get("session:intern:tok-1") == "s1"
+
+
+async def test_migration_is_idempotent(redis):
+    await _legacy_layout(redis)
+    await migrate_keys(redis, redis)
+
+    summary = await migrate_keys(redis, redis)
+
+    assert summary["intern_keys_moved"] == 0 and summary["record_keys_moved"] == 0
+    await _assert_migrated(redis)
+
+
+async def test_dry_run_changes_nothing(redis):
+    await _legacy_layout(redis)
+    before = sorted([k async for k in redis.scan_iter()])
+
+    summary = await migrate_keys(redis, redis, dry_run=True)
+
+    assert summary == {"intern_keys_moved": 3, "record_keys_moved": 14}
+    assert sorted([k async for k in redis.scan_iter()]) == before
+
+
+async def test_migrates_to_another_server(redis):
+    await _legacy_layout(redis)
+    target = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    try:
+        await migrate_keys(redis, target, keep_source=True)
+
+        await _assert_migrated(target)
+        assert await target.get("session:intern:tok-1") == "s1"
+        assert await target.smembers(ALL_INTERNS_KEY) == {"s1", "s2"}
+        # the source is left as it was
+        assert await redis.exists("intern:s1", "record:case-a", "record:case-a:xray") == 3
+        assert not await redis.exists(intern_key("s1"))
+    finally:
+        await target.aclose()
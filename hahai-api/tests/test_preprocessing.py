@@ -0,0 +1,63 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+from app.services.ml import preprocessing
+from app.services.ml.preprocessing import build_tta_batch, parse_tta_views
+
+
+def _image(h: int = 48, w: int = 40) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.random((1, h, w, 3), dtype=np.float32) * 255
+
+
+def _expected(x: np.ndarray, view: str) -> np.ndarray:
+    base = x[0]
+    if view == "identity":
+        return base
+    if view == "hflip":
+        return base[:, ::-1]
+    if view == "vflip":
+        return base[::-1]
+    raise AssertionError(view)
+
+
+@pytest.mark.parametrize("spec", ["nope", "flip", "hflip:1", "shift:0.1", "shift:1.5,0", "scale:0", "scale:x", "scale:nan"])
+def test_invalid_tta_views_are_rejected(spec):
+    with pytest.raises(ValueError, match="Invalid TTA view"):
+        parse_tta_views(["identity", spec])
+
+
+def test_exact_views_and_zero_fill():
+    x = _image()
+    out = build_tta_batch(x, ["identity", "hflip", "vflip", "shift:0.25,0", "scale:2"])
+    assert out.shape == (5,) + x.shape[1:] and out.dtype == x.dtype
+    for i, view in enumerate(["identity", "hflip", "vflip"]):
+        np.testing.assert_array_equal(out[i], _expected(x, view))
+    np.testing.assert_array_equal(out[3][:, 10:], x[0][:, :-10])  # 0.25 * 40 px to the right
+    assert not out[3][:, :10].any()
+    # zoom in: cv.resize to twice the size, then the center crop
+    zoomed = cv.resize(x[0], (80, 96), interpolation=cv.INTER_LINEAR)[24:72, 20:60]
+    np.testing.assert_allclose(out[4], zoomed, atol=0.05)
+
+
+@pytest.mark.parametrize("max_rows", [7, 48, 1000])
+def test_batches_larger_than_one_remap_call(monkeypatch, max_rows):
+    monkeypatch.setattr(preprocessing, "REMAP_MAX_ROWS", max_rows)
+    x = _image()
+    views = ["hflip", "identity", "scale:1.1", "vflip", "scale:0.9"] * 3
+    out = build_tta_batch(x, views)
+    monkeypatch.undo()
+    reference = build_tta_batch(x, views)
+    np.testing.assert_array_equal(out, reference)
+    for i, view in enumerate(views):
+        if not view.startswith("scale"):
+            np.testing.assert_array_equal(out[i], _expected(x, view))
+
+
+def test_view_count_times_height_above_shrt_max():
+    x = _image(64, 16)
+    views = ["identity", "hflip"] * 300  # 38400 stacked rows
+    out = build_tta_batch(x, views)
+    np.testing.assert_array_equal(out[-2], x[0])
+    np.testing.assert_array_equal(out[-1], x[0][:, ::-1])
@@ -0,0 +1,100 @@
+import time
+
+import pytest
+
+from app.db.keys import ALL_INTERNS_KEY, intern_key, record_key, record_xray_key
+from app.services.storage import purge, records, stats
+from tests.conftest import add_intern, add_record
+
+pytestmark = pytest.mark.anyio
+
+
+async def _records_at(redis, monkeypatch, student_id: str, *stamps: int) -> list[str]:
+    out = []
+    for ts in stamps:
+        monkeypatch.setattr(time, "time", lambda ts=ts: float(ts))
+        out.append(await add_record(redis, student_id))
+    monkeypatch.undo()
+    return out
+
+
+async def _existing(redis, case_ids: list[str]) -> set[str]:
+    return {cid for cid in case_ids if await redis.exists(record_key(cid))}
+
+
+async def test_purge_interns_by_id_cascades(redis):
+    await add_intern(redis, "2020-01")
+    await add_intern(redis, "2021-01")
+    gone = [await add_record(redis, "2020-01") for _ in range(3)]
+    kept = [await add_record(redis, "2021-01") for _ in range(2)]
+
+    result = await purge.purge(redis, student_ids=["2020-01"], batch_size=2)
+
+    assert result == {"records_purged": 3, "interns_purged": 1}
+    assert not await redis.exists(intern_key("2020-01"))
+    assert await redis.smembers(ALL_INTERNS_KEY) == {"2021-01"}
+    assert await _existing(redis, gone + kept) == set(kept)
+    assert not any([await redis.exists(record_xray_key(cid)) for cid in gone])
+    assert {r["case_id"] for r in await records.list_records(redis)} == set(kept)
+    s = await stats.get_stats(redis)
+    assert s["total_records"] == 2 and s["per_intern"] == {"2021-01": 2}
+
+
+async def test_purge_by_prefix_selects_a_cohort(redis):
+    for sid in ("2020-01", "2020-02", "2021-01"):
+        await add_intern(redis, sid)
+        await add_record(redis, sid)
+
+    result = await purge.purge(redis, student_id_prefix="2020-")
+
+    assert result == {"records_purged": 2, "interns_purged": 2}
+    assert await redis.smembers(ALL_INTERNS_KEY) == {"2021-01"}
+    assert (await stats.get_stats(redis))["per_intern"] == {"2021-01": 1}
+
+
+async def test_purge_without_selection_is_refused(redis):
+    await add_intern(redis, "2020-01")
+    with pytest.raises(purge.NothingToPurgeError):
+        await purge.purge(redis)
+    with pytest.raises(purge.NothingToPurgeError):
+        await purge.purge(redis, student_id_prefix="2019-")
+    assert await redis.exists(intern_key("2020-01"))
+
+
+async def test_purge_date_range_keeps_interns_and_other_records(redis, monkeypatch):
+    await add_intern(redis, "2020-01")
+    old = await _records_at(redis, monkeypatch, "2020-01", 1_000, 2_000)
+    new = await _records_at(redis, monkeypatch, "2020-01", 5_000)
+
+    result = await purge.purge(redis, created_from=0, created_to=3_000)
+
+    assert result == {"records_purged": 2, "interns_purged": 0}
+    assert await _existing(redis, old + new) == set(new)
+    assert await redis.exists(intern_key("2020-01"))
+
+
+async def test_purge_date_range_limited_to_selected_interns(redis, monkeypatch):
+    await add_intern(redis, "2020-01")
+    await add_intern(redis, "2021-01")
+    mine = await _records_at(redis, monkeypatch, "2020-01", 1_000)
+    theirs = await _records_at(redis, monkeypatch, "2021-01", 1_000)
+
+    result = await purge.purge(redis, student_id_prefix="2020-", created_from=0, created_to=3_000)
+
+    assert result["records_purged"] == 1
+    assert await _existing(redis, mine + theirs) == set(theirs)
+
+
+async def test_purge_date_range_with_unmatched_intern_selector_deletes_nothing(redis, monkeypatch):
+    await add_intern(redis, "2020-01")
+    in_range = await _records_at(redis, monkeypatch, "2020-01", 1_000, 2_000)
+
+    with pytest.raises(purge.NothingToPurgeError):
+        await purge.purge(redis, student_id_prefix="2019", created_from=0, created_to=3_000)
+
+    # explicit ids of unknown interns select their (empty) record sets
+    result = await purge.purge(redis, student_ids=["nobody"], created_from=0, created_to=3_000)
+    assert result["records_purged"] == 0
+
+    assert await _existing(redis, in_range) == set(in_range)
+    assert (await stats.get_stats(redis))["total_records"] == 2
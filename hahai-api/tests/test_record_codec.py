@@ -0,0 +1,222 @@
+import pytest
+
+from app.config import settings
+from app.db.keys import record_key
+from app.services.storage import records, stats
+from app.services.storage.migrate import reencode_records
+from app.services.storage.record_codec import FIELD_CODES, decode_record, encode_record, is_compact, pick_fields, record_fields
+from tests.conftest import add_intern, add_record
+
+pytestmark = pytest.mark.anyio
+
+META = {
+    "case_id": "c-1",
+    "student_id": "s1",
+    "notes": "left lobe",
+    "pred_label": "positive",
+    "pred_accuracy": 93.1,
+    "created_at": 1_000,
+    "saved_at": 1_010,
+    "is_temp": "0",
+    "model_version": "v2",
+    "xray_content_type": "image/jpeg",
+    "gradcam_content_type": "image/png",
+    "thumb_content_type": "image/webp",
+    "thumb_sizes": "64,256",
+    "xray_bytes": 4,
+    "gradcam_bytes": 7,
+    "thumb_bytes": 20,
+    "prev_pred_label": "negative",
+    "prev_pred_accuracy": 61.5,
+    "prev_model_version": "v1",
+    "reinferred_at": 1_020,
+    "extra": "kept",
+}
+# what comes back from a hash: strings, and no case_id
+STORED = {k: str(v) for k, v in META.items() if k != "case_id"}
+
+
+def _strings(mapping: dict) -> dict:
+    return {k: str(v) for k, v in mapping.items()}
+
+
+@pytest.fixture
+def compact(monkeypatch):
+    monkeypatch.setattr(settings, "RECORD_COMPACT_ENCODING", True)
+
+
+def test_legacy_encoding_is_unchanged():
+    assert encode_record(META, compact=False) == META
+    assert not is_compact(encode_record(META, compact=False))
+    assert decode_record(STORED, "c-1") == {**STORED, "case_id": "c-1"}
+
+
+def test_compact_round_trip():
+    encoded = _strings(encode_record(META, compact=True))
+
+    assert is_compact(encoded)
+    assert "case_id" not in encoded and "s" in encoded and "student_id" not in encoded
+    assert encoded["l"] == "1" and encoded["pl"] == "0"
+    assert (encoded["xc"], encoded["gc"], encoded["tc"]) == ("j", "p", "w")
+    assert encoded["a"] == "93.1" and encoded["extra"] == "kept"
+    assert decode_record(encoded, "c-1") == {**STORED, "case_id": "c-1"}
+
+
+def test_encoding_follows_the_setting(compact):
+    assert is_compact(encode_record(META))
+    assert encode_record(META, compact=False) == META
+
+
+def test_decode_accepts_a_mix_of_both_formats():
+    mixed = {**_strings(encode_record({"pred_label": "negative", "notes": "n"}, compact=True)), "student_id": "s1"}
+    assert decode_record(mixed) == {"pred_label": "negative", "notes": "n", "student_id": "s1"}
+    assert decode_record({}) == {}
+
+
+@pytest.mark.parametrize("use_compact", [False, True])
+def test_pick_fields_reads_either_format(use_compact):
+    stored = _strings(encode_record(META, compact=use_compact))
+    names = ["student_id", "pred_label", "thumb_sizes", "missing"]
+    values = [stored.get(f) for f in record_fields(names)]
+    assert pick_fields(values, names) == ["s1", "positive", "64,256", None]
+
+
+async def _stored_record(redis, case_id: str) -> tuple[dict, dict]:
+    data = await redis.hgetall(record_key(case_id))
+    return data, decode_record(data, case_id)
+
+
+async def _add_and_promote(redis, student_id: str) -> str:
+    temp_id = await records.create_temp_record(
+        redis,
+        student_id=student_id,
+        pred_label="positive",
+        pred_accuracy=88.25,
+        xray_bytes=b"xray",
+        xray_content_type="image/jpeg",
+        gradcam_bytes=b"gradcam",
+        gradcam_content_type="image/png",
+        xray_thumbs={64: b"x64"},
+        gradcam_thumbs={64: b"g64"},
+        thumb_content_type="image/webp",
+        model_version="v1",
+    )
+    return await records.promote_temp_record(redis, temp_id=temp_id, student_id=student_id, notes="saved notes")
+
+
+async def test_promote_gives_the_same_record_in_both_formats(redis, monkeypatch):
+    await add_intern(redis, "s1")
+    monkeypatch.setattr(records.time, "time", lambda: 1_000)
+
+    legacy_id = await _add_and_promote(redis, "s1")
+    monkeypatch.setattr(settings, "RECORD_COMPACT_ENCODING", True)
+    compact_id = await _add_and_promote(redis, "s1")
+
+    legacy_raw, legacy = await _stored_record(redis, legacy_id)
+    compact_raw, compacted = await _stored_record(redis, compact_id)
+    assert not is_compact(legacy_raw) and is_compact(compact_raw)
+    assert set(compact_raw) <= set(FIELD_CODES.values())
+    # promote's partial HSET followed each hash: no field is stored twice
+    # (the compact hash has no case_id)
+    assert len(legacy_raw) == len(compact_raw) + 1
+    assert {**compacted, "case_id": legacy_id} == legacy
+    assert legacy["is_temp"] == "0" and legacy["notes"] == "saved notes" and legacy["thumb_sizes"] == "64"
+
+    r1 = await records.get_record(redis, case_id=legacy_id)
+    r2 = await records.get_record(redis, case_id=compact_id)
+    assert {**r2, "case_id": legacy_id} == r1
+    assert (await stats.get_stats(redis))["per_label"] == {"positive": 2}
+
+
+async def test_promote_keeps_the_format_of_the_temp_hash(redis, monkeypatch):
+    await add_intern(redis, "s1")
+    temp_id = await records.create_temp_record(
+        redis,
+        student_id="s1",
+        pred_label="negative",
+        pred_accuracy=70.0,
+        xray_bytes=b"xray",
+        xray_content_type="image/jpeg",
+        gradcam_bytes=b"gradcam",
+        gradcam_content_type="image/png",
+    )
+    # switched on while the temp record was waiting to be saved
+    monkeypatch.setattr(settings, "RECORD_COMPACT_ENCODING", True)
+    case_id = await records.promote_temp_record(redis, temp_id=temp_id, student_id="s1", notes="n")
+
+    raw, record = await _stored_record(redis, case_id)
+    assert not is_compact(raw)
+    assert record["notes"] == "n" and record["is_temp"] == "0" and record["pred_label"] == "negative"
+
+
+@pytest.mark.parametrize("use_compact", [False, True])
+async def test_partial_update_follows_the_stored_format(redis, monkeypatch, use_compact):
+    # the HSET re-inference makes: only the changed fields, encoded like the hash
+    await add_intern(redis, "s1")
+    monkeypatch.setattr(settings, "RECORD_COMPACT_ENCODING", use_compact)
+    case_id = await add_record(redis, "s1", pred_label="positive", pred_accuracy=80.0)
+    monkeypatch.setattr(settings, "RECORD_COMPACT_ENCODING", not use_compact)
+
+    stored, before = await _stored_record(redis, case_id)
+    fields = {
+        "pred_label": "negative",
+        "pred_accuracy": 55.5,
+        "model_version": "v2",
+        "prev_pred_label": before["pred_label"],
+        "prev_pred_accuracy": before["pred_accuracy"],
+        "prev_model_version": before["model_version"],
+        "reinferred_at": 2_000,
+        "gradcam_content_type": "image/png",
+    }
+    await redis.hset(record_key(case_id), mapping=encode_record(fields, compact=is_compact(stored)))
+
+    raw, after = await _stored_record(redis, case_id)
+    assert is_compact(raw) == use_compact
+    assert len(raw) == len(stored) + 4  # the prev_* fields and reinferred_at
+    assert after == {**before, **_strings(fields)}
+
+
+async def test_reinference_update_keeps_a_compact_hash_compact(redis, compact):
+    pytest.importorskip("tensorflow")
+    np = pytest.importorskip("numpy")
+    from app.services import reinference
+
+    await add_intern(redis, "s1")
+    case_id = await add_record(redis, "s1", pred_label="positive", pred_accuracy=80.0)
+    stored, before = await _stored_record(redis, case_id)
+    update = reinference._update_for(
+        {"meta": before, "xray_thumb_bytes": {}},
+        0.1,
+        np.zeros(4, dtype=np.float32),
+        b"new-gradcam",
+        {},
+        version="v2",
+        now=2_000,
+    )
+
+    assert await reinference._write_updates(redis, [update]) == ([case_id], 0)
+    raw, after = await _stored_record(redis, case_id)
+    assert is_compact(raw) and not set(raw) - set(FIELD_CODES.values())
+    assert after == {**before, **_strings(update["fields"])}
+    assert (await stats.get_stats(redis))["per_label"] == {after["pred_label"]: 1}
+
+
+async def test_reencode_round_trip_keeps_records_and_stats(redis, monkeypatch):
+    await add_intern(redis, "s1")
+    ids = [await add_record(redis, "s1", notes=f"n{i}", pred_accuracy=70.0 + i / 3) for i in range(3)]
+    ids.append(await _add_and_promote(redis, "s1"))
+    before = [await records.get_record(redis, case_id=cid) for cid in ids]
+    before_stats = await stats.get_stats(redis)
+
+    counts = await reencode_records(redis, compact=True)
+    assert counts == {"records_scanned": 4, "records_converted": 4, "conflicts": 0}
+    for cid in ids:
+        assert is_compact(await redis.hgetall(record_key(cid)))
+    assert [await records.get_record(redis, case_id=cid) for cid in ids] == before
+    assert (await reencode_records(redis, compact=True))["records_converted"] == 0
+
+    await reencode_records(redis, compact=False)
+    for cid in ids:
+        assert not is_compact(await redis.hgetall(record_key(cid)))
+    assert [await records.get_record(redis, case_id=cid) for cid in ids] == before
+    assert await stats.get_stats(redis) == before_stats
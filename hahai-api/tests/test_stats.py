@@ -0,0 +1,97 @@
+import pytest
+
+from app.db.keys import all_buckets, stats_key
+from app.services.storage import records, stats
+from app.services.storage.stats import STATS_NAMES, confidence_bucket, rebuild_stats
+from tests.conftest import add_intern, add_record
+
+pytestmark = pytest.mark.anyio
+
+DAY = 86_400
+JAN_1 = 1_704_067_200  # 2024-01-01T00:00:00Z
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = {"t": JAN_1 + 3_600}
+    monkeypatch.setattr(records.time, "time", lambda: now["t"])
+    return now
+
+
+def test_confidence_buckets():
+    assert [confidence_bucket(v) for v in (0, 9.99, 10, 55.5, 99.9, 100)] == ["0-10", "0-10", "10-20", "50-60", "90-100", "90-100"]
+
+
+async def _dataset(redis, clock) -> list[str]:
+    await add_intern(redis, "s1")
+    await add_intern(redis, "s2")
+    ids = [
+        await add_record(redis, "s1", pred_label="positive", pred_accuracy=91.0),
+        await add_record(redis, "s1", pred_label="negative", pred_accuracy=55.5),
+    ]
+    clock["t"] += DAY
+    ids.append(await add_record(redis, "s2", pred_label="positive", pred_accuracy=100.0))
+    return ids
+
+
+async def test_counters_follow_creates_and_deletes(redis, clock):
+    ids = await _dataset(redis, clock)
+
+    assert await stats.get_stats(redis) == {
+        "total_records": 3,
+        "per_label": {"positive": 2, "negative": 1},
+        "per_intern": {"s1": 2, "s2": 1},
+        "confidence_buckets": {"50-60": 1, "90-100": 2},
+        "per_day": {"2024-01-01": 2, "2024-01-02": 1},
+    }
+
+    await records.delete_record(redis, case_id=ids[1])
+    await records.delete_record(redis, case_id=ids[2])
+
+    # emptied counters drop out of the summary
+    assert await stats.get_stats(redis) == {
+        "total_records": 1,
+        "per_label": {"positive": 1},
+        "per_intern": {"s1": 1},
+        "confidence_buckets": {"90-100": 1},
+        "per_day": {"2024-01-01": 1},
+    }
+
+
+async def test_saved_records_count_on_the_day_they_are_saved(redis, clock):
+    await add_intern(redis, "s1")
+    clock["t"] = JAN_1 + DAY - 60
+    temp_id = await records.create_temp_record(
+        redis,
+        student_id="s1",
+        pred_label="negative",
+        pred_accuracy=12.0,
+        xray_bytes=b"xray",
+        xray_content_type="image/jpeg",
+        gradcam_bytes=b"gradcam",
+        gradcam_content_type="image/png",
+    )
+    assert (await stats.get_stats(redis))["total_records"] == 0
+
+    clock["t"] += 120  # saved after midnight, within the temp record's TTL
+    case_id = await records.promote_temp_record(redis, temp_id=temp_id, student_id="s1", notes="")
+    summary = await stats.get_stats(redis)
+    assert summary["per_day"] == {"2024-01-02": 1}
+    assert summary["confidence_buckets"] == {"10-20": 1}
+
+    await records.delete_record(redis, case_id=case_id)
+    assert (await stats.get_stats(redis))["per_day"] == {}
+
+
+async def test_rebuild_matches_the_incremental_counters(redis, clock):
+    await _dataset(redis, clock)
+    incremental = await stats.get_stats(redis)
+
+    assert await rebuild_stats(redis, page_size=2) == incremental
+
+    # lost or drifted counters are recomputed from the record hashes
+    await redis.delete(*[stats_key(name, b) for name in STATS_NAMES for b in all_buckets()])
+    await redis.hset(stats_key(STATS_NAMES[0], 0), mapping={"records": 42, "label:stale": 7})
+    assert (await stats.get_stats(redis))["total_records"] != 3
+    assert await rebuild_stats(redis) == incremental
+    assert await stats.get_stats(redis) == incremental
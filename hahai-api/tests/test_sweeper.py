@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from app.db.keys import (
+    SWEEP_ORPHANS_KEY,
+    intern_records_key,
+    lock_key,
+    record_bucket,
+    record_gradcam_key,
+    record_key,
+    record_xray_key,
+    records_key,
+)
+from app.services.storage import indexes, records, stats, sweeper
+from app.services.storage.search import search_record_ids
+from tests.conftest import add_intern, add_record
+
+pytestmark = pytest.mark.anyio
+
+
+async def _sweep(redis, **kwargs) -> dict[str, int]:
+    return await sweeper.sweep(redis, pause=0, **{"grace_seconds": 0, **kwargs})
+
+
+async def test_dangling_record_ids_are_removed_with_their_indexes(redis):
+    await add_intern(redis, "s1")
+    lost = await add_record(redis, "s1", notes="distal radius fracture", pred_label="positive")
+    kept = await add_record(redis, "s1", notes="no fracture", pred_label="negative")
+    await redis.delete(record_key(lost))  # the hash is gone, the indexes still list it
+
+    totals = await _sweep(redis)
+
+    assert totals["dangling_index_entries"] == 1
+    assert not await redis.sismember(records_key(record_bucket(lost)), lost)
+    assert not await redis.sismember(intern_records_key("s1", record_bucket(lost)), lost)
+    assert (await indexes.query_record_ids(redis, pred_label="positive"))[1] == []
+    assert (await search_record_ids(redis, "radius"))[1] == []
+    assert (await search_record_ids(redis, "fracture"))[1] == [kept]
+    s = await stats.get_stats(redis)
+    assert s["total_records"] == 1 and s["per_label"] == {"negative": 1} and s["per_intern"] == {"s1": 1}
+
+    # a second sweep finds nothing left to fix
+    again = await _sweep(redis)
+    assert again["dangling_index_entries"] == again["dangling_intern_entries"] == 0
+    assert (await stats.get_stats(redis))["total_records"] == 1
+
+
+async def test_unindexed_record_is_reindexed(redis):
+    await add_intern(redis, "s1")
+    cid = await add_record(redis, "s1")
+    await redis.srem(records_key(record_bucket(cid)), cid)
+
+    assert (await _sweep(redis))["records_reindexed"] == 1
+    assert await redis.sismember(records_key(record_bucket(cid)), cid)
+    assert [r["case_id"] for r in await records.list_records(redis)] == [cid]
+
+
+async def test_record_without_image_is_removed(redis):
+    await add_intern(redis, "s1")
+    cid = await add_record(redis, "s1")
+    await redis.delete(record_xray_key(cid))
+
+    assert (await _sweep(redis))["incomplete_records_removed"] == 1
+    assert not await redis.exists(record_key(cid), record_gradcam_key(cid))
+    assert await records.list_records(redis) == []
+    assert (await stats.get_stats(redis))["total_records"] == 0
+
+
+async def test_orphan_blobs_are_reclaimed_after_the_grace_period(redis, monkeypatch):
+    await add_intern(redis, "s1")
+    cid = await add_record(redis, "s1")
+    await redis.delete(record_key(cid))
+    blobs = [record_xray_key(cid), record_gradcam_key(cid)]
+    now = time.time()
+
+    # first sighting only marks them
+    assert (await _sweep(redis, grace_seconds=60))["orphan_blobs_reclaimed"] == 0
+    assert await redis.exists(*blobs) == 2
+    assert await redis.zcard(SWEEP_ORPHANS_KEY) == 2
+
+    # still inside the grace period
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    assert (await _sweep(redis, grace_seconds=60))["orphan_blobs_reclaimed"] == 0
+
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert (await _sweep(redis, grace_seconds=60))["orphan_blobs_reclaimed"] == 2
+    assert await redis.exists(*blobs) == 0
+    assert await redis.zcard(SWEEP_ORPHANS_KEY) == 0
+
+
+async def test_orphan_mark_is_dropped_when_the_metadata_comes_back(redis):
+    await add_intern(redis, "s1")
+    cid = await add_record(redis, "s1")
+    data = await redis.hgetall(record_key(cid))
+    await redis.delete(record_key(cid))
+    await _sweep(redis, grace_seconds=60)
+    assert await redis.zcard(SWEEP_ORPHANS_KEY) == 2
+
+    await redis.hset(record_key(cid), mapping=data)
+    await _sweep(redis, grace_seconds=60)
+    assert await redis.zcard(SWEEP_ORPHANS_KEY) == 0
+    assert await redis.exists(record_xray_key(cid), record_gradcam_key(cid)) == 2
+
+
+async def test_one_sweep_at_a_time(redis):
+    await redis.set(lock_key("sweeper"), "someone-else")
+    with pytest.raises(sweeper.SweepInProgressError):
+        await _sweep(redis)
+    assert await redis.get(lock_key("sweeper")) == "someone-else"